@@ -0,0 +1,284 @@
+#################################################
+#   Author: Caleb Smith
+#   Student ID: 1027644
+#   November 9,2020
+#################################################
+"""
+Correlations, moments and conditional averages of avalanche observables.
+
+A HistoryAnalysis is fed the observables (topples, area, length, ...) of a
+run in chunks and keeps, for every observable, how often each value occurred
+and, for every pair of observables, how often each pair of values occurred.
+Avalanche observables are integers with far fewer distinct values than
+avalanches, so these counts are small whatever the length of the run. Every
+statistic is computed from them exactly, in a single pass over the data:
+
+- moments: mean, variance, skewness and excess kurtosis;
+- Spearman rank correlations between every pair: the average rank of each
+  value follows from the counts, so every observable is ranked once;
+- conditional averages, such as the mean number of topples of the
+  avalanches of a given area.
+
+The chunks can be the whole history of a pile at once, the chunks yielded by
+SandPile.iter_avalanches, or those of a Dataset read back from disk.
+
+Example usage:
+    stats = analyse(pile)
+    rho, pvalues = stats.correlations()
+    areas, topples, counts = stats.conditional_mean('topples', 'area')
+
+    stats = analyse(Dataset('runs/open100').iter_chunks(),
+                    observables=('topples', 'area', 'length', 'loss'))
+"""
+from itertools import combinations
+
+import numpy as np
+
+# Observables of SandPile histories: mass_change is the difference of
+# successive masses, which the pile's own analysis calls the mass loss
+OBSERVABLES = ('topples', 'area', 'length', 'mass_change')
+# Observables piles only keep once SandPile.track is called
+TRACKED = ('duration', 'waves')
+
+
+def _unique_rows(rows, counts=None):
+    """Distinct rows of an (m, d) array and how many times each occurs."""
+    if rows.shape[1] == 1:
+        keys, inverse = np.unique(rows[:, 0], return_inverse=True)
+        keys = keys[:, None]
+    else:
+        # Number the distinct values of each column and sort the pairs of
+        # numbers as single integers, much faster than np.unique(axis=0)
+        first, first_index = np.unique(rows[:, 0], return_inverse=True)
+        second, second_index = np.unique(rows[:, 1], return_inverse=True)
+        codes, inverse = np.unique(first_index.ravel() * len(second) + second_index.ravel(),
+                                   return_inverse=True)
+        keys = np.column_stack([first[codes // len(second)], second[codes % len(second)]])
+    inverse = inverse.ravel()
+    return keys, np.bincount(inverse, weights=counts, minlength=len(keys)).astype(np.int64)
+
+
+class _Counts:
+    """
+    Occurrence counts of integer tuples, merged lazily: new counts are kept
+    aside until they are about as large as the merged table.
+    """
+
+    def __init__(self, width):
+        self._keys = np.zeros((0, width), dtype=np.int64)
+        self._counts = np.zeros(0, dtype=np.int64)
+        self._pending = []
+        self._pending_rows = 0
+
+    def add(self, rows):
+        keys, counts = _unique_rows(rows)
+        self._pending.append((keys, counts))
+        self._pending_rows += len(keys)
+        if self._pending_rows > max(len(self._keys), 65536):
+            self._merge()
+
+    def _merge(self):
+        if self._pending:
+            keys = np.concatenate([self._keys] + [keys for keys, _ in self._pending])
+            counts = np.concatenate([self._counts] + [counts for _, counts in self._pending])
+            self._keys, self._counts = _unique_rows(keys, counts)
+            self._pending = []
+            self._pending_rows = 0
+
+    def table(self):
+        """The distinct tuples in sorted order, and their counts."""
+        self._merge()
+        return self._keys, self._counts
+
+
+class HistoryAnalysis:
+    """
+    Streaming statistics of a set of integer observables.
+    """
+
+    def __init__(self, observables=OBSERVABLES, marginals=()):
+        """
+        Parameters
+        ==========
+        observables: names of the observables to correlate; every chunk must
+            hold the same number of values of each
+        marginals: names of extra observables for which only the moments are
+            needed (such as the mass); they may have their own lengths
+        """
+        self.observables = tuple(observables)
+        self.marginals = tuple(marginals)
+        self.count = 0
+        self._single = {name: _Counts(1) for name in self.observables + self.marginals}
+        self._pairs = {pair: _Counts(2) for pair in combinations(self.observables, 2)}
+
+    def update(self, chunk):
+        """
+        Add a chunk of data: a dict of arrays or a structured array holding
+        a column for every observable and marginal.
+        """
+        columns = {name: np.asarray(chunk[name], dtype=np.int64).ravel()
+                   for name in self.observables + self.marginals}
+        lengths = {len(columns[name]) for name in self.observables}
+        if len(lengths) > 1:
+            raise ValueError('The observables {} have different lengths {}'.format(
+                ', '.join(self.observables), sorted(lengths)))
+        for name, values in columns.items():
+            if len(values) > 0:
+                self._single[name].add(values[:, None])
+        for (first, second), counts in self._pairs.items():
+            if len(columns[first]) > 0:
+                counts.add(np.column_stack([columns[first], columns[second]]))
+        self.count += lengths.pop() if lengths else 0
+        return self
+
+    def values(self, name):
+        """The distinct values of an observable and how often each occurred."""
+        keys, counts = self._single[name].table()
+        return keys[:, 0], counts
+
+    def ranks(self, name):
+        """
+        The distinct values of an observable and their average (1-based)
+        rank, as scipy.stats.rankdata would assign to tied values.
+        """
+        values, counts = self.values(name)
+        return values, np.cumsum(counts) - (counts - 1) / 2
+
+    def moments(self, name):
+        """
+        Return a dict with the number of values, mean, variance (population),
+        skewness, excess kurtosis, minimum and maximum of an observable.
+        """
+        values, counts = self.values(name)
+        total = counts.sum()
+        if total == 0:
+            return {'count': 0, 'mean': np.nan, 'variance': np.nan, 'skewness': np.nan,
+                    'kurtosis': np.nan, 'min': None, 'max': None}
+        mean = np.dot(counts, values.astype(np.float64)) / total
+        deviations = values - mean
+        central = [np.dot(counts, deviations ** power) / total for power in (2, 3, 4)]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            skewness = central[1] / central[0] ** 1.5
+            kurtosis = central[2] / central[0] ** 2 - 3
+        return {'count': int(total), 'mean': mean, 'variance': central[0],
+                'skewness': skewness, 'kurtosis': kurtosis,
+                'min': int(values[0]), 'max': int(values[-1])}
+
+    def _pair(self, first, second):
+        """Joint counts of (first, second), whichever order they were stored in."""
+        if (first, second) in self._pairs:
+            keys, counts = self._pairs[first, second].table()
+            return keys[:, 0], keys[:, 1], counts
+        if (second, first) in self._pairs:
+            keys, counts = self._pairs[second, first].table()
+            return keys[:, 1], keys[:, 0], counts
+        raise KeyError('No joint counts of {!r} and {!r}; both must be observables'.format(
+            first, second))
+
+    def correlations(self):
+        """
+        Spearman rank correlations between every pair of observables.
+        Returns the correlation matrix and the matrix of two-sided p-values,
+        both indexed in the order of `observables`.
+        """
+        size = len(self.observables)
+        rho = np.eye(size)
+        # Ranks centered on their mean, (count + 1) / 2, and their spread
+        centered = {}
+        spread = {}
+        for name in self.observables:
+            values, ranks = self.ranks(name)
+            _, counts = self.values(name)
+            centered[name] = (values, ranks - (self.count + 1) / 2)
+            spread[name] = np.dot(counts, centered[name][1] ** 2)
+        for i, j in combinations(range(size), 2):
+            first, second = self.observables[i], self.observables[j]
+            x, y, counts = self._pair(first, second)
+            values_x, ranks_x = centered[first]
+            values_y, ranks_y = centered[second]
+            covariance = np.dot(counts, ranks_x[np.searchsorted(values_x, x)] *
+                                ranks_y[np.searchsorted(values_y, y)])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                rho[i, j] = rho[j, i] = covariance / np.sqrt(spread[first] * spread[second])
+        for i in range(size):
+            if spread[self.observables[i]] == 0:
+                rho[i, i] = np.nan
+        return rho, self._pvalues(rho)
+
+    def _pvalues(self, rho):
+        """Two-sided p-values of the correlations, as scipy.stats.spearmanr."""
+        from scipy.stats import t
+        dof = self.count - 2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            statistic = rho * np.sqrt(dof / ((rho + 1.0) * (1.0 - rho)))
+        return 2 * t.sf(np.abs(statistic), dof)
+
+    def correlation(self, first, second):
+        """Spearman correlation and p-value between two observables."""
+        rho, pvalues = self.correlations()
+        i, j = self.observables.index(first), self.observables.index(second)
+        return rho[i, j], pvalues[i, j]
+
+    def conditional_mean(self, name, given):
+        """
+        The mean of observable `name` over the avalanches sharing each value
+        of observable `given` (e.g. the mean topples at each area).
+        Returns the values of `given`, the means and the number of avalanches.
+        """
+        x, y, counts = self._pair(given, name)
+        values, inverse = np.unique(x, return_inverse=True)
+        totals = np.bincount(inverse, weights=counts * y.astype(np.float64))
+        occurrences = np.bincount(inverse, weights=counts).astype(np.int64)
+        return values, totals / occurrences, occurrences
+
+
+def pile_columns(pile, start=None):
+    """
+    The history of a pile from `start` (by default the pile's own start
+    index, past any burn-in) as a dict of arrays: its observables, the
+    duration and number of waves if the pile tracks them (see
+    SandPile.track; they leave out the avalanches before it started) and
+    the mass, which has one more value than the others.
+    """
+    start = pile.get_start_index() if start is None else start
+    mass = np.asarray(pile.mass_history, dtype=np.int64)
+    columns = {'topples': np.asarray(pile.topples_history[start:], dtype=np.int64),
+               'area': np.asarray(pile.area_history[start:], dtype=np.int64),
+               'length': np.asarray(pile.length_history[start:], dtype=np.int64),
+               'mass_change': np.diff(mass)[start:],
+               'mass': mass[start:]}
+    for name in TRACKED:
+        if getattr(pile, name + '_history') is not None:
+            columns[name] = pile.tracked_history(name, start)
+    return columns
+
+
+def analyse(source, observables=None, marginals=None, start=None):
+    """
+    Return the HistoryAnalysis of a pile's history, of one chunk, or of an
+    iterable of chunks (dicts of arrays or structured arrays).
+
+    Parameters
+    ==========
+    source: SandPile, chunk or iterable of chunks
+    observables: names of the observables to correlate; defaults to
+        OBSERVABLES for piles and to the topples, area and length otherwise
+    marginals: names of observables to take only the moments of; defaults
+        to the mass for piles
+    start: for piles, index of the first avalanche to include (by default
+        the pile's start index, or the first tracked avalanche if later and
+        tracked observables are asked for)
+    """
+    if hasattr(source, 'mass_history'):
+        if start is None and set(TRACKED) & set(observables or ()):
+            start = max(source.get_start_index(), source.tracked_from or 0)
+        stats = HistoryAnalysis(OBSERVABLES if observables is None else observables,
+                                ('mass',) if marginals is None else marginals)
+        return stats.update(pile_columns(source, start))
+    stats = HistoryAnalysis(('topples', 'area', 'length') if observables is None
+                            else observables, () if marginals is None else marginals)
+    if isinstance(source, (dict, np.ndarray)):
+        return stats.update(source)
+    for chunk in source:
+        stats.update(chunk)
+    return stats
@@ -1,17 +1,248 @@
 # Flask endpoints for our react fron-end
-from flask import Flask, json, jsonify
+import threading
+import time
+
+from flask import Flask, Response, g, json, jsonify, request, stream_with_context
 from flask_cors import CORS
-from main import main_grid
+from main import central_pile, grid_list
+from metrics import BYTES, CONTENT_TYPE, Registry
+from scaling import EXTRA_OBSERVABLES, OBSERVABLES, ScalingSweep
+from statepool import StatePool
+from streaming import ensemble_records, sweep_records, to_ndjson
+from topologies import TOPOLOGIES
 app = Flask(__name__)
 CORS(app)
 
+# Critical states are checked out of a pool shared with the other workers
+POOL = StatePool()
+POOL_SIZE = 4         # States kept ready per topology and size
+MAX_SIZE = 500        # Largest width or height served
+MAX_RUNS = 100000     # Most members of a streamed ensemble
+MAX_SIZES = 8         # Most lattice sizes of a streamed sweep
+STARTED = time.time()
+
+# Grids served by /plots, keyed by (iterations, width, height); the drops
+# are on fixed sites, so the same request always gives the same grid
+PLOTS = {}
+_plots_lock = threading.Lock()
+
+
+def _hit_ratios():
+    ratios = {}
+    for cache in ('plots', 'state_pool'):
+        hits = CACHE.value(cache=cache, result='hit')
+        total = hits + CACHE.value(cache=cache, result='miss')
+        if total > 0:
+            ratios[(cache,)] = hits / total
+    return ratios
+
+
+def _pool_states():
+    return {(topology, '{}x{}'.format(width, height)): POOL.available(topology, width, height)
+            for topology, width, height in POOL.keys()}
+
+
+def _refills_running():
+    return {(): POOL.refilling()}
+
+
+# Operational metrics, scraped from /metrics in the Prometheus text format
+METRICS = Registry()
+REQUESTS = METRICS.counter('sandpile_requests_total', 'HTTP requests served',
+                           ('endpoint', 'status'))
+REQUEST_SECONDS = METRICS.histogram('sandpile_request_seconds', 'Time taken to serve a request',
+                                    ('endpoint',))
+IN_PROGRESS = METRICS.gauge('sandpile_requests_in_progress',
+                            'Requests being served by this process (its queue depth)',
+                            ('endpoint',))
+RESPONSE_BYTES = METRICS.histogram('sandpile_response_bytes', 'Size of the response bodies',
+                                   ('endpoint',), buckets=BYTES)
+SIMULATION_SECONDS = METRICS.histogram(
+    'sandpile_simulation_seconds',
+    'Time taken to produce a pile: drive drops sand, pool checks a critical state out '
+    'of the pool, recurrent samples one when the pool is empty and ensemble runs one '
+    'member of a streamed ensemble',
+    ('topology', 'size', 'method'))
+TOPPLES = METRICS.counter('sandpile_topples_total', 'Topples simulated', ('topology',))
+TOPPLES_PER_SECOND = METRICS.gauge('sandpile_topples_per_second',
+                                   'Topples per second of the last simulation', ('topology',))
+CACHE = METRICS.counter('sandpile_cache_requests_total',
+                        'Lookups in the plot cache and the state pool', ('cache', 'result'))
+METRICS.gauge('sandpile_cache_hit_ratio', 'Fraction of the lookups which hit', ('cache',),
+              function=_hit_ratios)
+METRICS.gauge('sandpile_pool_states', 'Critical states waiting in the pool',
+              ('topology', 'size'), function=_pool_states)
+METRICS.gauge('sandpile_pool_refills_running', 'Pool refills running in the background',
+              function=_refills_running)
+
+
+def _endpoint():
+    return request.endpoint or 'unknown'
+
+
+@app.before_request
+def start_request():
+    g.started = time.perf_counter()
+    IN_PROGRESS.inc(endpoint=_endpoint())
+
+
+@app.after_request
+def record_request(response):
+    endpoint = _endpoint()
+    REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+    REQUEST_SECONDS.observe(time.perf_counter() - g.started, endpoint=endpoint)
+    # Measuring a streamed body would read it all before sending any of it
+    if not response.is_streamed:
+        RESPONSE_BYTES.observe(response.calculate_content_length(), endpoint=endpoint)
+    elif g.pop('started', None) is not None:
+        # The request is in progress until the stream is done or dropped
+        response.call_on_close(lambda: IN_PROGRESS.dec(endpoint=endpoint))
+    return response
+
+
+@app.teardown_request
+def finish_request(error=None):
+    if g.pop('started', None) is not None:
+        IN_PROGRESS.dec(endpoint=_endpoint())
+
+
+def plot_grid(iterations=1000, width=100, height=100):
+    """The grid of central_pile, simulated once and then cached."""
+    key = (iterations, width, height)
+    with _plots_lock:
+        grid = PLOTS.get(key)
+    if grid is not None:
+        CACHE.inc(cache='plots', result='hit')
+        return grid
+    CACHE.inc(cache='plots', result='miss')
+    start = time.perf_counter()
+    pile = central_pile(iterations, width, height)
+    seconds = time.perf_counter() - start
+    topology = pile.topology
+    SIMULATION_SECONDS.observe(seconds, topology=topology, method='drive',
+                               size='{}x{}'.format(width, height))
+    topples = int(sum(pile.topples_history))
+    TOPPLES.inc(topples, topology=topology)
+    TOPPLES_PER_SECOND.set(topples / seconds if seconds > 0 else 0, topology=topology)
+    grid = grid_list(pile)
+    with _plots_lock:
+        PLOTS[key] = grid
+    return grid
+
 
 @app.route('/plots', methods=['GET'])
 def send_plot():
-    grid = main_grid(iterations=1000, width=100, height=100)
+    grid = plot_grid(iterations=1000, width=100, height=100)
 
     return jsonify(grid)
 
 
+@app.route('/critical', methods=['GET'])
+def send_critical():
+    topology = request.args.get('topology', 'open')
+    width = request.args.get('width', 100, type=int)
+    height = request.args.get('height', 100, type=int)
+    if topology not in TOPOLOGIES:
+        return jsonify(error='Unknown topology {!r}'.format(topology)), 400
+    if not (0 < width <= MAX_SIZE and 0 < height <= MAX_SIZE):
+        return jsonify(error='width and height must be between 1 and {}'.format(MAX_SIZE)), 400
+
+    start = time.perf_counter()
+    try:
+        pile = POOL.checkout(topology, width, height, generate=False)
+        CACHE.inc(cache='state_pool', result='hit')
+        method = 'pool'
+    except LookupError:
+        CACHE.inc(cache='state_pool', result='miss')
+        pile = POOL.checkout(topology, width, height)
+        method = 'recurrent'
+    SIMULATION_SECONDS.observe(time.perf_counter() - start, topology=topology,
+                               size='{}x{}'.format(width, height), method=method)
+    # Top the pool back up without making this request wait for it
+    POOL.refill_async(topology, width, height, POOL_SIZE)
+    return jsonify(grid=pile.grid.tolist(), origin=pile.origin)
+
+
+def _stream(records):
+    """A chunked response sending the records as newline-delimited JSON."""
+    return Response(stream_with_context(to_ndjson(records)), mimetype='application/x-ndjson',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def _observed(records, topology, size):
+    """The records, with the simulation of every ensemble member measured."""
+    for record in records:
+        if record['type'] == 'member':
+            SIMULATION_SECONDS.observe(record['seconds'], topology=topology, size=size,
+                                       method='ensemble')
+            TOPPLES.inc(record['topples'], topology=topology)
+        yield record
+
+
+@app.route('/ensemble', methods=['GET'])
+def send_ensemble():
+    topology = request.args.get('topology', 'open')
+    width = request.args.get('width', 50, type=int)
+    height = request.args.get('height', 50, type=int)
+    runs = request.args.get('runs', 100, type=int)
+    n = request.args.get('n', 1, type=int)
+    every = request.args.get('every', 10, type=int)
+    tolerance = request.args.get('tolerance', None, type=float)
+    if topology not in TOPOLOGIES:
+        return jsonify(error='Unknown topology {!r}'.format(topology)), 400
+    if not (0 < width <= MAX_SIZE and 0 < height <= MAX_SIZE):
+        return jsonify(error='width and height must be between 1 and {}'.format(MAX_SIZE)), 400
+    if not (0 < runs <= MAX_RUNS and n > 0 and every > 0):
+        return jsonify(error='runs must be between 1 and {}, n and every positive'.format(
+            MAX_RUNS)), 400
+
+    records = ensemble_records(topology, width, height, runs, n,
+                               seed=request.args.get('seed', 0, type=int), every=every,
+                               tolerance=tolerance)
+    return _stream(_observed(records, topology, '{}x{}'.format(width, height)))
+
+
+@app.route('/sweep', methods=['GET'])
+def send_sweep():
+    topology = request.args.get('topology', 'open')
+    try:
+        sizes = [int(size) for size in request.args.get('sizes', '8,16,32').split(',')]
+    except ValueError:
+        return jsonify(error='sizes must be a comma separated list of integers'), 400
+    observables = request.args.get('observables', ','.join(OBSERVABLES)).split(',')
+    if topology not in TOPOLOGIES:
+        return jsonify(error='Unknown topology {!r}'.format(topology)), 400
+    if not (0 < len(sizes) <= MAX_SIZES and all(0 < size <= MAX_SIZE for size in sizes)):
+        return jsonify(error='Up to {} sizes between 1 and {}'.format(MAX_SIZES, MAX_SIZE)), 400
+    unknown = set(observables) - set(OBSERVABLES + EXTRA_OBSERVABLES)
+    if unknown:
+        return jsonify(error='Unknown observables {}'.format(', '.join(sorted(unknown)))), 400
+
+    try:
+        # Chunks run in this request's thread, one after the other
+        sweep = ScalingSweep(topology, sizes, observables,
+                             chunk_drops=request.args.get('drops', None, type=int),
+                             tolerance=request.args.get('tolerance', 0.05, type=float),
+                             min_chunks=request.args.get('min_chunks', 4, type=int),
+                             max_chunks=request.args.get('max_chunks', 64, type=int),
+                             n_jobs=1, seed=request.args.get('seed', 0, type=int))
+    except ValueError as error:
+        return jsonify(error=str(error)), 400
+    every = max(request.args.get('every', 1, type=int), 1)
+    bootstrap = min(max(request.args.get('bootstrap', 0, type=int), 0), 20)
+    return _stream(sweep_records(sweep, every, bootstrap))
+
+
+@app.route('/metrics', methods=['GET'])
+def send_metrics():
+    return Response(METRICS.render(), content_type=CONTENT_TYPE)
+
+
+@app.route('/healthz', methods=['GET'])
+def send_health():
+    return jsonify(status='ok', uptime_seconds=time.time() - STARTED,
+                   in_progress=IN_PROGRESS.total())
+
+
 if __name__ == '__main__':
     app.run(debug=False)
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+#################################################
+#   Author: Caleb Smith
+#   Student ID: 1027644
+#   November 9,2020
+#################################################
+"""Sandpile benchmarks
+Measures drops/sec, topples/sec and peak memory for each simulation engine
+over a ladder of lattice sizes, in both the pre-critical (empty grid) and
+critical (stabilized) states. The stabilization state instead times the
+engine's own stabilize() on an over-full grid; it is not run by default, as
+the reference engines relax one site at a time and take very long on the
+largest lattices. Results are appended to a JSON history file so that later
+runs can be compared against earlier ones.
+
+Example usage:
+    python benchmark.py run --sizes 20 50 --drops 500
+    python benchmark.py run --sizes 20 50 100 --states stabilization
+    python benchmark.py compare
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import numpy as np
+
+from topologies import TOPOLOGIES
+
+ENGINES = ('open', 'cylindrical', 'hourglass', 'numba')
+STATES = ('pre-critical', 'critical', 'stabilization')
+DEFAULT_STATES = ('pre-critical', 'critical')
+DEFAULT_SIZES = (20, 50, 100, 200, 500, 1000)
+DEFAULT_HISTORY = 'benchmark_history.json'
+
+# Metrics compared between runs, and whether a larger value is better
+METRICS = {
+    'drops_per_sec': True,
+    'topples_per_sec': True,
+    'peak_memory_bytes': False,
+    'stabilization_seconds': False,
+}
+
+
+def _pile_class(engine):
+    if engine == 'numba':
+        from sandpilenumba import SandPile as NumbaSandPile, warmup
+        # Keep compilation out of the measurements
+        warmup()
+        return NumbaSandPile
+    return TOPOLOGIES[engine]
+
+
+def overfull_pile(engine, size, seed):
+    """
+    The unstable pile critical states are made from, as in
+    ensemble_simulate: a random grid with heights up to the threshold.
+    """
+    np.random.seed(seed)
+    pile = _pile_class(engine)(size, size, threshold=5, random=True)
+    pile.threshold = 4
+    return pile
+
+
+def make_pile(engine, size, state, seed):
+    """
+    Build the pile a benchmark case starts from: an empty grid, or for the
+    critical state the over-full grid of overfull_pile relaxed by the bulk
+    stabilizer, which is fast at every size. The time the engine's own
+    stabilizer takes is measured by the stabilization case instead.
+    """
+    if state == 'pre-critical':
+        np.random.seed(seed)
+        return _pile_class(engine)(size, size)
+
+    pile = overfull_pile(engine, size, seed)
+    if engine == 'numba':
+        # The numba engine cannot relax an arbitrary grid; it has open
+        # boundaries, so borrow the open pile's bulk stabilizer
+        reference = TOPOLOGIES['open'](size, size)
+        reference.grid = pile.grid
+        reference.stabilize(engine='bulk')
+        pile.grid = reference.grid
+    else:
+        pile.stabilize(engine='bulk')
+    return pile
+
+
+def time_stabilization(engine, size, seed):
+    """
+    Seconds the engine's own stabilize() takes to relax the over-full grid
+    of overfull_pile, or None if the engine has no stabilizer.
+    """
+    pile = overfull_pile(engine, size, seed)
+    if not hasattr(pile, 'stabilize'):
+        return None
+    start = time.perf_counter()
+    pile.stabilize()
+    return time.perf_counter() - start
+
+
+def run_drops(pile, drops, budget):
+    """
+    Drop sand on random sites until `drops` grains have been dropped or
+    `budget` seconds have passed. Returns the number of drops made.
+    """
+    batch = max(1, drops // 20)
+    done = 0
+    start = time.perf_counter()
+    while done < drops:
+        count = min(batch, drops - done)
+        pile.simulate(count)
+        done += count
+        if budget is not None and time.perf_counter() - start > budget:
+            break
+    return done
+
+
+def run_case(engine, size, state, drops, seed=0, budget=None, memory=True):
+    """
+    Benchmark a single (engine, size, state) combination.
+
+    Parameters
+    ==========
+    engine: str, one of ENGINES
+    size: int, width and height of the lattice
+    state: str, one of STATES
+    drops: int, number of grains to drop
+    seed: int, seed for numpy's global random state
+    budget: float or None, maximum seconds to spend dropping sand
+    memory: bool, whether to repeat the run under tracemalloc to find the
+        peak memory; tracing slows the run down, so it is never timed
+    """
+    if state == 'stabilization':
+        return {'engine': engine, 'size': size, 'state': state, 'seed': seed,
+                'drops': 0, 'seconds': None, 'topples': None, 'drops_per_sec': None,
+                'topples_per_sec': None, 'peak_memory_bytes': None,
+                'stabilization_seconds': time_stabilization(engine, size, seed)}
+
+    pile = make_pile(engine, size, state, seed)
+    # Trigger any just-in-time compilation outside of the timed region
+    pile.simulate(0)
+    topples_before = int(sum(pile.topples_history))
+
+    np.random.seed(seed + 1)
+    start = time.perf_counter()
+    done = run_drops(pile, drops, budget)
+    elapsed = time.perf_counter() - start
+    topples = int(sum(pile.topples_history)) - topples_before
+
+    peak = None
+    if memory:
+        pile = make_pile(engine, size, state, seed)
+        np.random.seed(seed + 1)
+        tracemalloc.start()
+        pile.simulate(done)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {
+        'engine': engine,
+        'size': size,
+        'state': state,
+        'seed': seed,
+        'drops': done,
+        'seconds': elapsed,
+        'topples': topples,
+        'drops_per_sec': done / elapsed if elapsed > 0 else None,
+        'topples_per_sec': topples / elapsed if elapsed > 0 else None,
+        'peak_memory_bytes': peak,
+        'stabilization_seconds': None,
+    }
+
+
+def run_suite(engines=ENGINES, sizes=DEFAULT_SIZES, states=DEFAULT_STATES, drops=200,
+              seed=0, budget=None, memory=True, log=None):
+    """Run every combination of engine, size and state; return the results."""
+    results = []
+    for size in sizes:
+        for engine in engines:
+            for state in states:
+                result = run_case(engine, size, state, drops, seed=seed,
+                                  budget=budget, memory=memory)
+                if log is not None and state == 'stabilization':
+                    seconds = result['stabilization_seconds']
+                    log.write('{engine:>12} {size:>5} {state:>13}: {}\n'.format(
+                        'no stabilizer' if seconds is None else '{:10.3f} s'.format(seconds),
+                        **result))
+                elif log is not None:
+                    log.write('{engine:>12} {size:>5} {state:>13}: '
+                              '{drops_per_sec:10.1f} drops/s\n'.format(**result))
+                results.append(result)
+    return results
+
+
+def load_history(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'runs': []}
+
+
+def append_history(path, results, label=None):
+    """Append a run of results, with information about the machine, to `path`."""
+    history = load_history(path)
+    history['runs'].append({
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'label': label,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.platform(),
+        'results': results,
+    })
+    with open(path, 'w') as f:
+        json.dump(history, f, indent=2)
+    return history
+
+
+def compare(history, baseline=-2, current=-1, tolerance=0.1):
+    """
+    Compare two runs of a history and return the regressions found.
+    A metric regresses when it is worse than the baseline by more than
+    `tolerance` (a fraction of the baseline value). Only cases present in both
+    runs are compared.
+    """
+    runs = history['runs']
+    if len(runs) < 2:
+        return []
+
+    def key(result):
+        return (result['engine'], result['size'], result['state'])
+
+    old = {key(result): result for result in runs[baseline]['results']}
+    regressions = []
+    for result in runs[current]['results']:
+        previous = old.get(key(result))
+        if previous is None:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            before, after = previous.get(metric), result.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            if (higher_is_better and change < -tolerance) or \
+                    (not higher_is_better and change > tolerance):
+                regressions.append({
+                    'engine': result['engine'],
+                    'size': result['size'],
+                    'state': result['state'],
+                    'metric': metric,
+                    'baseline': before,
+                    'current': after,
+                    'change': change,
+                })
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help='run the benchmarks')
+    run.add_argument('--engines', nargs='+', choices=ENGINES, default=ENGINES)
+    run.add_argument('--sizes', nargs='+', type=int, default=DEFAULT_SIZES)
+    run.add_argument('--states', nargs='+', choices=STATES, default=DEFAULT_STATES)
+    run.add_argument('--drops', type=int, default=200)
+    run.add_argument('--seed', type=int, default=0)
+    run.add_argument('--budget', type=float, default=None,
+                     help='maximum seconds of dropping per case')
+    run.add_argument('--no-memory', action='store_true',
+                     help='skip the tracemalloc pass')
+    run.add_argument('--label', default=None)
+    run.add_argument('--history', default=DEFAULT_HISTORY)
+
+    cmp = commands.add_parser('compare', help='flag regressions between runs')
+    cmp.add_argument('--history', default=DEFAULT_HISTORY)
+    cmp.add_argument('--baseline', type=int, default=-2)
+    cmp.add_argument('--current', type=int, default=-1)
+    cmp.add_argument('--tolerance', type=float, default=0.1)
+
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        results = run_suite(args.engines, args.sizes, args.states, args.drops,
+                            seed=args.seed, budget=args.budget,
+                            memory=not args.no_memory, log=sys.stdout)
+        append_history(args.history, results, label=args.label)
+        return 0
+
+    regressions = compare(load_history(args.history), args.baseline,
+                          args.current, args.tolerance)
+    for regression in regressions:
+        print('{engine} {size}x{size} {state}: {metric} {baseline:.4g} -> '
+              '{current:.4g} ({change:+.1%})'.format(**regression))
+    if not regressions:
+        print('No regressions')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
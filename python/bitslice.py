@@ -0,0 +1,271 @@
+#################################################
+#   Author: Caleb Smith
+#   Student ID: 1027644
+#   November 9,2020
+#################################################
+"""
+Bit-sliced stabilization of whole grids.
+
+Relaxing a grid ends with many sweeps in which every site is small: below
+TALL times the threshold after the first stages of the bulk engine (see
+bulk.py), and below 8 once stable. Here those sweeps run on bit-planes:
+plane p holds bit p of every height (in two's complement, as the first
+stages can leave a few sites slightly negative), packed 64 sites to a
+uint64 word along the height axis. A sweep then works on whole words:
+
+- a site is unstable when its height, read from the planes, is at least the
+  threshold: a comparison with a constant, one plane at a time;
+- the grains it receives are the unstable neighbors, found by shifting the
+  unstable mask by a row (width axis) or by a bit with the carry into the
+  next word (height axis), and counted into 3 bits with adders;
+- the new heights are the old ones minus 4 times the unstable mask plus
+  that count, with ripple-carry adders over the planes.
+
+Every sweep topples each unstable site once, as the last stage of the bulk
+engine does, so the final grid is the same. Boundaries may be open or
+periodic along either axis, and sink sites are cleared after every sweep.
+
+Example usage:
+    grid = stabilize(np.full((100, 100), 6), periodic=(True, False))
+"""
+import numpy as np
+
+from bulk import LOST, topple_tall
+
+WORD = 64
+ONE = np.uint64(1)
+TOP = np.uint64(WORD - 1)
+
+
+def _planes_needed(low, high):
+    """Number of bits holding every value in [low, high] in two's complement."""
+    bits = 2
+    while not (-2 ** (bits - 1) <= low and high < 2 ** (bits - 1)):
+        bits += 1
+    return bits
+
+
+def _words(size):
+    """Words per row: always at least one padding bit after the last site."""
+    return size // WORD + 1
+
+
+def pack(heights, planes):
+    """
+    Pack integer heights of shape (..., width, height) into bit-planes of
+    shape (planes, ..., width, words).
+    """
+    size = heights.shape[-1]
+    padded = np.zeros(heights.shape[:-1] + (_words(size) * WORD,), dtype=np.int64)
+    padded[..., :size] = heights
+    packed = [np.packbits(((padded >> p) & 1).astype(np.uint8), axis=-1,
+                          bitorder='little').view('<u8') for p in range(planes)]
+    return np.array(packed, dtype=np.uint64)
+
+
+def unpack(packed, size):
+    """Inverse of pack: the heights of the first `size` sites of every row."""
+    planes = len(packed)
+    heights = 0
+    for p in range(planes):
+        bits = np.unpackbits(packed[p].astype('<u8').view(np.uint8), axis=-1,
+                             bitorder='little')[..., :size].astype(np.int64)
+        # The top plane is the sign bit
+        heights = heights + (bits << p) * (-1 if p == planes - 1 else 1)
+    return heights
+
+
+def _at_least(planes, value):
+    """Mask of the packed heights which are at least the constant `value`."""
+    sign = planes[-1]
+    greater = np.zeros_like(sign)
+    equal = ~sign
+    # Compare the magnitude bits from the top one down
+    for p in range(len(planes) - 2, -1, -1):
+        if (value >> p) & 1:
+            equal &= planes[p]
+        else:
+            greater |= equal & planes[p]
+            equal &= ~planes[p]
+    return (greater | equal) & ~sign
+
+
+class _Shifter:
+    """
+    Moves a packed mask of shape (batch, width, words) by one site in each
+    direction, in buffers reused from sweep to sweep.
+
+    The mask is written into `mask`, a view of a buffer with an extra row
+    above and below, so moving it along the width axis is just a view of the
+    buffer. Each row ends with padding bits, so shifting the whole buffer as
+    one stream of words moves the bits within each row, and only padding
+    bits are moved into or out of the neighboring rows. The padding bits of
+    the mask must be cleared (with `valid`) before it is moved.
+    """
+
+    def __init__(self, shape, size, periodic):
+        batch, width, words = shape
+        self.periodic = periodic
+        self.last_word = np.intp((size - 1) // WORD)
+        self.last_bit = np.uint64((size - 1) % WORD)
+        # Bits of each word of a row which are real sites
+        self.valid = np.zeros(words, dtype=np.uint64)
+        self.valid[:size // WORD] = ~np.uint64(0)
+        self.valid[size // WORD] = np.uint64(2 ** (size % WORD) - 1)
+        self._padded = np.zeros((batch, width + 2, words), dtype=np.uint64)
+        self._left = np.empty_like(self._padded)
+        self._right = np.empty_like(self._padded)
+        self._carry = np.empty(self._padded.size, dtype=np.uint64)
+        self.mask = self._padded[:, 1:-1]
+
+    def neighbors(self):
+        """
+        The sites whose neighbor above, below, left and right is set in
+        `mask`, as 4 masks.
+        """
+        padded = self._padded
+        if self.periodic[0]:
+            padded[:, 0], padded[:, -1] = padded[:, -2], padded[:, 1]
+        stream, carry = padded.reshape(-1), self._carry
+        left, right = self._left.reshape(-1), self._right.reshape(-1)
+        np.left_shift(stream, ONE, out=left)
+        np.right_shift(stream[:-1], TOP, out=carry[1:])
+        left[1:] |= carry[1:]
+        np.right_shift(stream, ONE, out=right)
+        np.left_shift(stream[1:], TOP, out=carry[:-1])
+        right[:-1] |= carry[:-1]
+        left, right = self._left[:, 1:-1], self._right[:, 1:-1]
+        if self.periodic[1]:
+            mask = self.mask
+            left[..., 0] |= (mask[..., self.last_word] >> self.last_bit) & ONE
+            right[..., self.last_word] |= (mask[..., 0] & ONE) << self.last_bit
+        return padded[:, :-2], padded[:, 2:], left, right
+
+
+def _count(a, b, c, d, out):
+    """
+    The number of set masks among a, b, c and d, as 3 bit masks written to
+    `out` (a list of 6 arrays, the last 3 used as scratch space).
+    """
+    ones, twos, fours, ab, cd, both = out
+    np.bitwise_xor(a, b, out=ab)
+    np.bitwise_xor(c, d, out=cd)
+    np.bitwise_xor(ab, cd, out=ones)
+    np.bitwise_and(ab, cd, out=both)
+    np.bitwise_and(a, b, out=ab)
+    np.bitwise_and(c, d, out=cd)
+    np.bitwise_xor(ab, cd, out=twos)
+    twos ^= both
+    # Both pairs set means 4, and then neither pair has an odd sum
+    np.bitwise_and(ab, cd, out=fours)
+    return ones, twos, fours
+
+
+def _relax(planes, shifter, threshold, sinks):
+    """Topple every unstable site once per sweep until all are stable."""
+    count = len(planes)
+    valid = shifter.valid
+    scratch = [np.empty_like(planes[0]) for _ in range(6)]
+    sweeps = 0
+    while True:
+        if threshold == LOST and sweeps % 8 == 0 and count > 3 and \
+                not (planes[3:] & valid).any():
+            # Every height is between 0 and 7 from now on
+            planes[:3] = _relax_small(planes[:3], shifter, sinks, scratch)
+            return planes
+        sweeps += 1
+        unstable = _at_least(planes, threshold)
+        unstable &= valid
+        if not unstable.any():
+            return planes
+        # Grains received: the number of unstable neighbors, in 3 bits
+        shifter.mask[...] = unstable
+        received = _count(*shifter.neighbors(), scratch)
+
+        # Heights minus LOST on the unstable sites: borrow from plane 2 up
+        borrow = unstable
+        for p in range(2, count):
+            plane = planes[p]
+            borrow, planes[p] = borrow & ~plane, plane ^ borrow
+        # Plus the grains received
+        carry = None
+        for p in range(count):
+            plane = planes[p]
+            if p < 3:
+                total = plane ^ received[p]
+                new_carry = plane & received[p]
+                if carry is not None:
+                    new_carry |= total & carry
+                    total ^= carry
+            else:
+                total = plane ^ carry
+                new_carry = plane & carry
+            planes[p] = total
+            carry = new_carry
+        if sinks is not None:
+            planes &= sinks
+
+
+def _relax_small(planes, shifter, sinks, scratch):
+    """
+    _relax for a threshold of 4 once every height is between 0 and 7, on 3
+    planes: the unstable sites are those of the top plane, which toppling
+    clears, so a sweep only adds the grains received to the 2 lower planes.
+    """
+    low, middle = planes[0].copy(), planes[1].copy()
+    high = shifter.mask
+    high[...] = planes[2]
+    valid = shifter.valid
+    carry, temp = np.empty_like(low), np.empty_like(low)
+    while True:
+        high &= valid
+        if not high.any():
+            break
+        ones, twos, fours = _count(*shifter.neighbors(), scratch)
+        # low + 2 middle + the grains received, at most 7
+        np.bitwise_and(low, ones, out=carry)
+        low ^= ones
+        np.bitwise_xor(middle, twos, out=temp)
+        np.bitwise_and(middle, twos, out=high)
+        temp &= carry
+        high |= temp
+        middle ^= twos
+        middle ^= carry
+        # 4 grains received leave the lower planes unchanged
+        high |= fours
+        if sinks is not None:
+            low &= sinks
+            middle &= sinks
+            high &= sinks
+    return np.array([low, middle, high])
+
+
+def stabilize(grids, periodic=(False, False), sinks=None, threshold=4):
+    """
+    Return the stable grid(s) reached from `grids`, as bulk.stabilize. The
+    input is not modified.
+
+    Parameters
+    ==========
+    grids: array of shape (..., width, height)
+    periodic: pair of bools, whether the width and height axes wrap around;
+        grains leaving through a non-periodic boundary are lost
+    sinks: optional boolean (width, height) array of sites which belong to
+        the sink: grains reaching them are removed and they never topple
+    threshold: int, grains needed for a site to topple; every topple sends
+        one grain to each of the 4 directions
+    """
+    grids, sinks, _ = topple_tall(grids, periodic, sinks, threshold)
+    if grids.size == 0:
+        return grids
+    # As in bulk.stabilize, relaxing one topple per sweep never takes a site
+    # past threshold + LOST - 1, and negative heights only increase
+    count = _planes_needed(min(grids.min(), 0), max(grids.max(), threshold + LOST - 1))
+    shape, size = grids.shape, grids.shape[-1]
+    planes = pack(grids.reshape((-1,) + shape[-2:]), count)
+    keep = None
+    if sinks is not None:
+        # Mask of the sites which are not sinks, packed like one plane
+        keep = pack(~sinks, 1)[0]
+    shifter = _Shifter(planes.shape[1:], size, periodic)
+    return unpack(_relax(planes, shifter, threshold, keep), size).reshape(shape)
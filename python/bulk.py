@@ -0,0 +1,202 @@
+#################################################
+#   Author: Caleb Smith
+#   Student ID: 1027644
+#   November 9,2020
+#################################################
+"""
+Vectorized stabilization of whole grids.
+
+Instead of toppling one site at a time from a queue, every unstable site of
+the grid topples as many times as it can at once and the grains are moved
+with a handful of shifted array additions per sweep. By the abelian property
+the final grid and the odometer are the same as for the queue. This is the
+engine behind the sandpile group operations of SandPile (identity, addition,
+inverses), which start from grids where every site is unstable.
+
+The last two axes of the grids are the lattice; any leading axes are batch
+dimensions, so many grids of the same shape are stabilized together.
+
+Example usage:
+    grid = stabilize(np.full((2, 100, 100), 6), periodic=(True, False))
+"""
+import numpy as np
+
+# Grains a site loses when it topples, one to each of the 4 directions
+LOST = 2 * 2
+# Sites holding this many times the threshold topple several times per sweep
+TALL = 4
+
+
+def _shift_add(grids, topples, axis, periodic):
+    """Send one grain per topple to both neighbors along `axis`."""
+    forward = [slice(None)] * grids.ndim
+    backward = [slice(None)] * grids.ndim
+    forward[axis] = slice(1, None)
+    backward[axis] = slice(None, -1)
+    forward, backward = tuple(forward), tuple(backward)
+    grids[forward] += topples[backward]
+    grids[backward] += topples[forward]
+    if periodic:
+        first = [slice(None)] * grids.ndim
+        last = [slice(None)] * grids.ndim
+        first[axis] = 0
+        last[axis] = -1
+        first, last = tuple(first), tuple(last)
+        grids[first] += topples[last]
+        grids[last] += topples[first]
+
+
+def _dst(values, axis):
+    """Type-I discrete sine transform along `axis`, computed with an FFT."""
+    if np.iscomplexobj(values):
+        return _dst(values.real, axis) + 1j * _dst(values.imag, axis)
+    n = values.shape[axis]
+    values = np.moveaxis(values, axis, -1)
+    zeros = np.zeros(values.shape[:-1] + (1,))
+    # Odd extension of length 2(n + 1), whose FFT is -2i times the transform
+    extended = np.concatenate([zeros, values, zeros, -values[..., ::-1]], axis=-1)
+    transform = -np.fft.rfft(extended, axis=-1).imag[..., 1:n + 1] / 2
+    return np.moveaxis(transform, -1, axis)
+
+
+def _poisson(rhs, periodic):
+    """
+    Solve L w = rhs for the toppling Laplacian L of a grid without sinks
+    (four minus the neighbors, grains leaving through non-periodic
+    boundaries are lost). Periodic axes are diagonalized with an FFT and
+    open ones with a sine transform.
+    """
+    transform = np.asarray(rhs, dtype=np.float64)
+    eigenvalues = 0
+    for axis, wraps in zip((-2, -1), periodic):
+        n = rhs.shape[axis]
+        shape = [1, 1]
+        shape[axis] = n
+        if wraps:
+            transform = np.fft.fft(transform, axis=axis)
+            frequencies = 2 * np.pi * np.arange(n) / n
+        else:
+            transform = _dst(transform, axis)
+            frequencies = np.pi * np.arange(1, n + 1) / (n + 1)
+        eigenvalues = eigenvalues + (2 - 2 * np.cos(frequencies)).reshape(shape)
+    transform = transform / eigenvalues
+    for axis, wraps in zip((-2, -1), periodic):
+        if wraps:
+            transform = np.fft.ifft(transform, axis=axis)
+        else:
+            n = rhs.shape[axis]
+            transform = _dst(transform, axis) * 2 / (n + 1)
+    return transform.real
+
+
+def laplacian(topples, periodic=(False, False)):
+    """Return the change of heights, with the sign flipped, when every
+    site topples the given number of times: L applied to `topples`."""
+    change = LOST * topples
+    _shift_add(change, -topples, -2, periodic[0])
+    _shift_add(change, -topples, -1, periodic[1])
+    return change
+
+
+def lower_odometer(grids, periodic=(False, False), threshold=4):
+    """
+    A lower bound on the odometer of stabilizing `grids` on a grid without
+    sinks. The stable grid is at most threshold - 1 everywhere, so the
+    odometer u satisfies L u >= grids - (threshold - 1), and since L^-1 has
+    no negative entries, u >= L^-1 (grids - (threshold - 1)).
+    """
+    solution = _poisson(grids - (threshold - 1), periodic)
+    # Leave room for the rounding errors of the transforms
+    margin = 1e-9 * np.abs(solution).max() + 1e-6
+    return np.maximum(np.floor(solution - margin), 0).astype(np.int64)
+
+
+def topple_tall(grids, periodic=(False, False), sinks=None, threshold=4):
+    """
+    The first stages of stabilize: topple by the lower bound on the odometer
+    (without sinks), then topple the tall stacks several times per sweep
+    until every site holds less than TALL times the threshold. Returns a new
+    int64 array of the grids, the sinks (None if there are none) and the
+    topples so far.
+    """
+    grids = np.array(grids, dtype=np.int64)
+    if sinks is not None and not sinks.any():
+        sinks = None
+    if sinks is not None:
+        grids[..., sinks] = 0
+        total = np.zeros_like(grids)
+    else:
+        # Topple straight away by a lower bound on the odometer. By the least
+        # action principle, relaxing what is left legally then gives exactly
+        # the same grid as relaxing from the start, in far fewer sweeps
+        total = lower_odometer(grids, periodic, threshold)
+        grids -= laplacian(total, periodic)
+
+    # While there are tall stacks, topple every site as often as it can at once
+    while grids.max(initial=0) >= TALL * threshold:
+        unstable = grids >= threshold
+        topples = (grids - threshold) // LOST + 1
+        topples *= unstable
+        grids -= LOST * topples
+        _shift_add(grids, topples, -2, periodic[0])
+        _shift_add(grids, topples, -1, periodic[1])
+        if sinks is not None:
+            grids[..., sinks] = 0
+        total += topples
+
+    return grids, sinks, total
+
+
+def stabilize(grids, periodic=(False, False), sinks=None, threshold=4,
+              odometer=False):
+    """
+    Return the stable grid(s) reached from `grids`, and the odometer (number
+    of topples of every site) if asked for. The input is not modified.
+
+    Parameters
+    ==========
+    grids: array of shape (..., width, height)
+    periodic: pair of bools, whether the width and height axes wrap around;
+        grains leaving through a non-periodic boundary are lost
+    sinks: optional boolean (width, height) array of sites which belong to
+        the sink: grains reaching them are removed and they never topple
+    threshold: int, grains needed for a site to topple; every topple sends
+        one grain to each of the 4 directions
+    odometer: bool, whether to also return the topples of every site
+    """
+    grids, sinks, total = topple_tall(grids, periodic, sinks, threshold)
+
+    # Then topple each unstable site once per sweep, on the smallest integer
+    # type which can hold the heights: a site never grows past
+    # threshold + LOST - 1 that way, and negative heights only increase
+    heights = grids.astype(_compact_dtype(grids, threshold))
+    unstable = np.empty(heights.shape, dtype=bool)
+    topples = unstable.view(np.int8)
+    lost = np.empty_like(heights)
+    while True:
+        np.greater_equal(heights, threshold, out=unstable)
+        if not unstable.any():
+            break
+        np.multiply(topples, LOST, out=lost)
+        heights -= lost
+        _shift_add(heights, topples, -2, periodic[0])
+        _shift_add(heights, topples, -1, periodic[1])
+        if sinks is not None:
+            heights[..., sinks] = 0
+        if odometer:
+            total += topples
+
+    grids = heights.astype(np.int64)
+    if odometer:
+        return grids, total
+    return grids
+
+
+def _compact_dtype(grids, threshold):
+    """Smallest signed integer type holding the heights while relaxing."""
+    low = min(grids.min(initial=0), 0)
+    high = max(grids.max(initial=0), threshold + LOST - 1)
+    for dtype in (np.int8, np.int16, np.int32):
+        if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+#################################################
+#   Author: Caleb Smith
+#   Student ID: 1027644
+#   November 9,2020
+#################################################
+"""Differential conformance
+Runs every simulation engine on the same random inputs and checks that they
+agree. A case is a topology, a starting grid (possibly unstable), a
+threshold, a number of grains per drop and a sequence of drop sites. Each
+engine stabilizes the starting grid and drops the grains, and must end with
+the same grid and the same mass, topples, area and length history as the
+reference SandPile classes:
+
+    reference   SandPile.stabilize() and drop_sand, one site at a time
+    stream      bulk stabilizer, then SandPile.iter_avalanches
+    sweeps      bit-sliced stabilizer, then synchronous sweeps
+                (iter_avalanches(duration=True))
+    waves       bulk stabilizer, then wave by wave relaxation
+                (iter_avalanches(waves=True)), whose wave sizes must add
+                up to the topples
+    graph       graphpile.GraphSandPile, vectorized sweeps on a graph
+    forks       forks.ForkedPiles, two identical branches relaxed together
+    numba       sandpilenumba.SandPile (open boundaries only)
+    infinite    infinite.InfiniteSandPile, on the cases where the reference
+                lost no grain at the boundary
+
+When engines disagree, the case is shrunk: drops, rows, columns and grains
+are removed for as long as the disagreement remains, so the case reported
+is small enough to follow by hand.
+
+Example usage:
+    failures = check_random(200, seed=1)
+    timings = compare_timings(timing_case('open', 50, 2000))
+
+    python conformance.py --cases 200 --seed 1
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from bitslice import WORD
+from topologies import TOPOLOGIES, get_topology
+
+FIELDS = ('mass', 'topples', 'area', 'length')
+# Grains a site loses when it topples, one to each of the 4 directions
+LOST = 4
+
+
+class Case:
+    """
+    One input: every engine starts from `grid` on the given topology, relaxes
+    it, then drops `n` grains on each site of `drops` in turn.
+    """
+
+    def __init__(self, topology, grid, drops=(), n=1, threshold=LOST):
+        cls = get_topology(topology)
+        self.topology = str(topology)
+        self.grid = np.array(grid, dtype=np.int64)
+        # Grains reaching a sink leave the pile, so none starts there
+        self.grid[cls(*self.grid.shape).sink_mask()] = 0
+        self.drops = [tuple(int(c) for c in site) for site in drops]
+        self.n = n
+        self.threshold = threshold
+
+    @property
+    def width(self):
+        return self.grid.shape[0]
+
+    @property
+    def height(self):
+        return self.grid.shape[1]
+
+    def replace(self, **changes):
+        """A copy of the case with some of its attributes changed."""
+        arguments = dict(topology=self.topology, grid=self.grid, drops=self.drops,
+                         n=self.n, threshold=self.threshold)
+        arguments.update(changes)
+        return Case(**arguments)
+
+    def pile(self):
+        """A pile of the case's topology holding its starting grid."""
+        pile = get_topology(self.topology)(self.width, self.height, threshold=self.threshold)
+        pile.grid = self.grid.copy()
+        return pile
+
+    def __repr__(self):
+        return 'Case({!r}, {}, drops={}, n={}, threshold={})'.format(
+            self.topology, self.grid.tolist(), self.drops, self.n, self.threshold)
+
+
+def _outcome(grid, histories):
+    """The result of an engine: final grid and one array per history."""
+    outcome = {name: np.asarray(values, dtype=np.int64) for name, values in histories.items()}
+    outcome['grid'] = np.asarray(grid, dtype=np.int64)
+    return outcome
+
+
+def run_reference(case):
+    pile = case.pile()
+    pile.stabilize()
+    for site in case.drops:
+        pile.drop_sand(case.n, site)
+    return _outcome(pile.grid, {name: getattr(pile, name + '_history')[-len(case.drops):]
+                                if case.drops else [] for name in FIELDS})
+
+
+def _run_stream(case, engine, duration=False, waves=False):
+    pile = case.pile()
+    pile.stabilize(engine=engine)
+    if waves:
+        pile.track(waves=True)
+    for site in case.drops:
+        for _ in pile.iter_avalanches(1, case.n, site, duration=duration, waves=waves,
+                                      record=True):
+            pass
+    if waves:
+        # The avalanche each wave belongs to
+        owners = np.repeat(np.arange(len(pile.waves_history)), pile.waves_history)
+        sizes = np.bincount(owners, weights=pile.wave_size_history,
+                            minlength=len(pile.waves_history))
+        if not np.array_equal(sizes, pile.topples_history):
+            raise AssertionError('The wave sizes do not add up to the topples')
+    return _outcome(pile.grid, {name: getattr(pile, name + '_history')[1:] if name == 'mass'
+                                else getattr(pile, name + '_history') for name in FIELDS})
+
+
+def run_stream(case):
+    return _run_stream(case, 'bulk')
+
+
+def run_sweeps(case):
+    return _run_stream(case, 'bitslice', duration=True)
+
+
+def run_waves(case):
+    return _run_stream(case, 'bulk', waves=True)
+
+
+def run_graph(case):
+    from graphpile import GraphSandPile
+    pile = GraphSandPile.from_pile(case.pile())
+    pile.stabilize()
+    for site in case.drops:
+        pile.drop_sand(case.n, site)
+    return _outcome(pile.grid, {name: getattr(pile, name + '_history')[1:] if name == 'mass'
+                                else getattr(pile, name + '_history') for name in FIELDS})
+
+
+def run_forks(case):
+    pile = case.pile()
+    pile.stabilize(engine='bulk')
+    forks = pile.fork(2)
+    for site in case.drops:
+        forks.drop_sand(case.n, site)
+    if not np.array_equal(forks.grid(0), forks.grid(1)):
+        raise AssertionError('The branches of identical drops differ')
+    return _outcome(forks.grid(0), {name: forks.history(name)[:, 0] for name in FIELDS})
+
+
+def run_numba(case):
+    from sandpilenumba import SandPile as NumbaSandPile
+    reference = case.pile()
+    reference.stabilize(engine='bulk')
+    pile = NumbaSandPile(case.width, case.height, threshold=case.threshold)
+    pile.grid = reference.grid.astype(np.int64)
+    for site in case.drops:
+        pile.simulate(1, case.n, site)
+    return _outcome(pile.grid, {name: list(getattr(pile, name + '_history'))
+                                for name in FIELDS})
+
+
+def run_infinite(case):
+    from infinite import InfiniteSandPile
+    pile = InfiniteSandPile(threshold=case.threshold)
+    for x, y in zip(*np.nonzero(case.grid)):
+        pile.add_sand((x, y), case.grid[x, y])
+    pile.stabilize()
+    offset = pile.mass_history[-1]
+    for site in case.drops:
+        pile.drop_sand(case.n, site)
+    grid = [[pile[x, y] for y in range(case.height)] for x in range(case.width)]
+    histories = {name: getattr(pile, name + '_history') for name in FIELDS}
+    # The pile's mass history starts from 0, not from the grid it was given
+    histories['mass'] = np.asarray(histories['mass'][1:]) - offset + case.grid.sum()
+    return _outcome(grid, histories)
+
+
+def _lossless(case, reference):
+    """Whether no grain left the grid in the reference run."""
+    total = case.grid.sum() + case.n * len(case.drops)
+    return reference['grid'].sum() == total
+
+
+class Engine:
+    """
+    A way of running cases. `applies(case)` tells whether the engine
+    supports the case at all, and `comparable(case, reference)` whether its
+    result should equal the reference outcome.
+    """
+
+    def __init__(self, name, run, applies=None, comparable=None):
+        self.name = name
+        self.run = run
+        self.applies = applies or (lambda case: True)
+        self.comparable = comparable or (lambda case, reference: True)
+
+
+ENGINES = {engine.name: engine for engine in (
+    Engine('reference', run_reference),
+    Engine('stream', run_stream),
+    Engine('sweeps', run_sweeps),
+    Engine('waves', run_waves),
+    Engine('graph', run_graph),
+    Engine('forks', run_forks),
+    Engine('numba', run_numba, lambda case: case.topology == 'open'),
+    Engine('infinite', run_infinite, lambda case: case.topology == 'open', _lossless),
+)}
+
+
+def differences(reference, outcome):
+    """The fields (grid or histories) in which two outcomes differ."""
+    return [name for name in ('grid',) + FIELDS
+            if not np.array_equal(reference[name], outcome[name])]
+
+
+def check(case, engines=None):
+    """
+    Run a case on every engine and compare each with the reference.
+    Returns a dict mapping the engines which disagree to the fields they
+    disagree on (or to the exception they raised).
+    """
+    engines = [ENGINES[name] for name in (engines or ENGINES) if name != 'reference']
+    reference = run_reference(case)
+    mismatches = {}
+    for engine in engines:
+        if not engine.applies(case) or not engine.comparable(case, reference):
+            continue
+        try:
+            fields = differences(reference, engine.run(case))
+        except Exception as error:
+            fields = ['{}: {}'.format(type(error).__name__, error)]
+        if fields:
+            mismatches[engine.name] = fields
+    return mismatches
+
+
+def _smaller(case):
+    """Cases simpler than `case`, roughly the biggest reductions first."""
+    drops = case.drops
+    # Fewer drops: halves, then one at a time
+    if len(drops) > 1:
+        half = len(drops) // 2
+        yield case.replace(drops=drops[:half])
+        yield case.replace(drops=drops[half:])
+    for i in range(len(drops)):
+        yield case.replace(drops=drops[:i] + drops[i + 1:])
+    if case.n > 1:
+        yield case.replace(n=1)
+        yield case.replace(n=case.n - 1)
+    if case.threshold != LOST:
+        yield case.replace(threshold=LOST)
+    # Fewer rows and columns, moving the drops along with the grid
+    for axis, size in enumerate(case.grid.shape):
+        if size == 1:
+            continue
+        for first in (True, False):
+            kept = slice(1, None) if first else slice(None, -1)
+            grid = case.grid[kept] if axis == 0 else case.grid[:, kept]
+            moved = [(x - first * (axis == 0), y - first * (axis == 1)) for x, y in drops]
+            moved = [site for site in moved if 0 <= site[axis] < size - 1]
+            yield case.replace(grid=grid, drops=moved)
+    # Fewer grains: everywhere, then one site at a time
+    if case.grid.any():
+        yield case.replace(grid=np.zeros_like(case.grid))
+        yield case.replace(grid=case.grid // 2)
+        for site in zip(*np.nonzero(case.grid)):
+            grid = case.grid.copy()
+            grid[site] -= 1
+            yield case.replace(grid=grid)
+
+
+def shrink(case, fails, limit=10000):
+    """
+    Reduce a failing case to a minimal one: keep taking the first simpler
+    case which still fails until none does.
+
+    Parameters
+    ==========
+    case: Case for which `fails(case)` is true
+    fails: function of a Case, true if it shows the problem
+    limit: int, largest number of cases to try
+    """
+    tried = 0
+    progress = True
+    while progress and tried < limit:
+        progress = False
+        for smaller in _smaller(case):
+            tried += 1
+            if fails(smaller):
+                case = smaller
+                progress = True
+                break
+            if tried >= limit:
+                break
+    return case
+
+
+def random_case(rng, max_size=10, max_drops=20, tall=0.125):
+    """
+    A random case, drawn with the numpy Generator `rng`. A fraction `tall`
+    of the cases are at most 3 sites wide and between WORD - 2 and
+    2 * WORD + 2 high, so that the bit-sliced stabilizer packs the rows into
+    one, two or three words.
+    """
+    topology = rng.choice(sorted(TOPOLOGIES))
+    width, height = rng.integers(1, max_size + 1, size=2)
+    high = rng.random() < tall
+    if high:
+        # Narrow, and never far from stable, or the reference takes long
+        width, height = rng.integers(1, 4), rng.integers(WORD - 2, 2 * WORD + 3)
+    threshold = int(rng.choice([LOST, LOST, LOST, LOST + 1, LOST + 3]))
+    # Stable grids most of the time, some of them far from it
+    scale = rng.choice([1, 2] if high else [1, 1, 2, 5])
+    grid = rng.integers(0, threshold * scale, size=(width, height))
+    sites = rng.integers(0, [width, height], size=(rng.integers(0, max_drops + 1), 2))
+    n = int(rng.choice([1, 1, 1, 2, 3, 8]))
+    return Case(topology, grid, sites, n, threshold)
+
+
+def check_random(cases, seed=0, engines=None, max_size=10, max_drops=20, log=None):
+    """
+    Check `cases` random cases. Returns a list of (case, mismatches) with
+    each failing case shrunk and the mismatches of the shrunk case.
+    """
+    rng = np.random.default_rng(seed)
+    failures = []
+    for index in range(cases):
+        case = random_case(rng, max_size, max_drops)
+        mismatches = check(case, engines)
+        if mismatches:
+            names = sorted(mismatches)
+            case = shrink(case, lambda smaller: any(
+                name in check(smaller, names) for name in names))
+            mismatches = check(case, names)
+            failures.append((case, mismatches))
+            if log is not None:
+                log.write('case {}: {}\n    {!r}\n'.format(index, mismatches, case))
+                log.flush()
+    return failures
+
+
+def timing_case(topology='open', size=50, drops=2000, seed=0):
+    """A case for timing: a recurrent state of an L x L lattice and random drops."""
+    cls = get_topology(topology)
+    grid = cls.recurrent(size, size, seed=seed).grid
+    sites = np.random.default_rng(seed).integers(0, size, size=(drops, 2))
+    return Case(topology, grid, sites)
+
+
+def compare_timings(case, engines=None, repeat=3):
+    """
+    Seconds taken by the reference and every engine which supports `case`
+    (the best of `repeat` runs), checking that each one agrees with the
+    reference.
+    """
+    reference = run_reference(case)
+    timings = {}
+    names = ['reference'] + [name for name in engines or ENGINES if name != 'reference']
+    for name in names:
+        engine = ENGINES[name]
+        if not engine.applies(case) or not engine.comparable(case, reference):
+            continue
+        best = np.inf
+        for _ in range(repeat):
+            start = time.perf_counter()
+            outcome = engine.run(case)
+            best = min(best, time.perf_counter() - start)
+        if differences(reference, outcome):
+            raise AssertionError('{} disagrees with the reference on the timing case'.format(name))
+        timings[name] = best
+    return timings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--cases', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--engines', nargs='+', choices=sorted(ENGINES), default=None)
+    parser.add_argument('--max-size', type=int, default=10)
+    parser.add_argument('--max-drops', type=int, default=20)
+    parser.add_argument('--timing-size', type=int, default=50,
+                        help='lattice size of the timing comparison (0 to skip it)')
+    parser.add_argument('--timing-drops', type=int, default=2000)
+    args = parser.parse_args(argv)
+
+    failures = check_random(args.cases, args.seed, args.engines, args.max_size,
+                            args.max_drops, log=sys.stdout)
+    print('{} of {} cases failed'.format(len(failures), args.cases))
+    if args.timing_size > 0:
+        for topology in sorted(TOPOLOGIES):
+            case = timing_case(topology, args.timing_size, args.timing_drops, args.seed)
+            timings = compare_timings(case, args.engines)
+            print('{} {}x{}, {} drops:'.format(topology, case.width, case.height, len(case.drops)))
+            for name, seconds in timings.items():
+                print('    {:<10} {:8.3f}s  {:6.2f}x'.format(
+                    name, seconds, timings['reference'] / seconds))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
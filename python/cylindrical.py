@@ -4,9 +4,6 @@
 #   November 9,2020
 #################################################
 import numpy as np
-import scipy as sp
-import scipy.stats
-from matplotlib import pyplot
 from sandpile import SandPile
 
 
@@ -16,6 +13,8 @@ class CylindricalSandPile(SandPile):
     the x-direction wraps together, so grains can only fall off
     the y-direction
     """
+    topology = 'cylindrical'
+    periodic = (True, False)
 
     def __init__(self, width, height, threshold=4, random=False):
         SandPile.__init__(self, width, height, threshold=threshold, random=random)
@@ -0,0 +1,252 @@
+#################################################
+#   Author: Caleb Smith
+#   Student ID: 1027644
+#   November 9,2020
+#################################################
+"""
+On-disk datasets of simulation runs.
+
+A DatasetWriter passed to SandPile.simulate streams the avalanche history
+(drop site, topples, area, length, grains lost, mass and optionally the
+duration or the waves) to disk in chunks of a fixed number of drops,
+optionally with a snapshot of the grid at the end of each chunk, instead of
+keeping it in the pile's history lists. A dataset is a directory:
+
+    metadata.json        the pile and run parameters
+    index.json           the chunks written so far: file, first row, rows
+    chunk_000000.npz     one compressed array per column (and the snapshot)
+
+The index is rewritten after every chunk, so a run which is still going (or
+which crashed) can be read up to its last complete chunk. Dataset reads the
+chunks back lazily, and can unpack a column once into an uncompressed .npy
+file to memory-map it.
+
+Example usage:
+    with DatasetWriter('runs/open100') as writer:
+        pile.simulate(10**8, writer=writer)
+    data = Dataset('runs/open100')
+    areas = data.column('area')
+"""
+import json
+import os
+from datetime import datetime, timezone
+
+import numpy as np
+
+from sandpile import avalanche_dtype
+
+FORMAT_VERSION = 1
+
+
+def _write_json(path, data):
+    """Write `data` to `path` atomically."""
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+class DatasetWriter:
+    """
+    Writes the avalanches of one or more simulate calls to a dataset
+    directory in chunks of `chunk_size` drops.
+    """
+
+    def __init__(self, path, chunk_size=65536, snapshots=False, duration=False,
+                 waves=False, metadata=None):
+        """
+        Parameters
+        ==========
+        path: directory of the dataset, created if needed; must not already
+            hold a dataset
+        chunk_size: int, number of drops per chunk
+        snapshots: bool, whether to store the grid at the end of each chunk
+        duration: bool, whether to relax in parallel sweeps and also store
+            the duration of every avalanche
+        waves: bool, whether to relax wave by wave and also store the number
+            of waves of every avalanche and the size of its last wave
+        metadata: dict of extra information to store with the run
+        """
+        if os.path.exists(os.path.join(path, 'metadata.json')):
+            raise FileExistsError('{} already holds a dataset'.format(path))
+        self.path = path
+        self.chunk_size = chunk_size
+        self.snapshots = snapshots
+        self.duration = duration
+        self.waves = waves
+        self.extra = dict(metadata or {})
+        self.dtype = avalanche_dtype(duration, waves)
+        self.rows = 0
+        self.metadata = None
+        self.index = []
+        self._buffer = np.empty(chunk_size, dtype=self.dtype)
+        self._filled = 0
+        self._appended = 0          # Rows given to write so far
+        self._grid = None           # Latest snapshot and the row count it follows
+        self._grid_row = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def open(self, pile):
+        """
+        Start the dataset of `pile`, from its current grid; called by
+        SandPile.simulate before the first drop. Does nothing once started.
+        """
+        if self.metadata is not None:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        self.metadata = dict(
+            self.extra, format=FORMAT_VERSION, topology=pile.topology,
+            width=pile.width, height=pile.height, threshold=pile.threshold,
+            chunk_size=self.chunk_size, columns=list(self.dtype.names),
+            snapshots=self.snapshots, pre_critical=pile.pre_critical,
+            started=datetime.now(timezone.utc).isoformat(),
+            initial_mass=int(pile.mass()), rows=0, finished=None)
+        _write_json(os.path.join(self.path, 'metadata.json'), self.metadata)
+
+    def write(self, pile, records):
+        """
+        Append avalanche records (as yielded by SandPile.iter_avalanches) of
+        `pile`, which was given to `open` before they were dropped.
+        """
+        if self.metadata is None:
+            raise RuntimeError('open the writer with the pile before its first drop')
+        self._appended += len(records)
+        if self.snapshots:
+            # The grid as it is after the last of these records
+            self._grid = pile.grid.astype(np.uint8)
+            self._grid_row = self._appended
+        done = 0
+        while done < len(records):
+            count = min(self.chunk_size - self._filled, len(records) - done)
+            self._buffer[self._filled:self._filled + count] = records[done:done + count]
+            self._filled += count
+            done += count
+            if self._filled == self.chunk_size:
+                self.flush()
+
+    def space(self):
+        """Number of drops which still fit in the current chunk."""
+        return self.chunk_size - self._filled
+
+    def flush(self):
+        """Write out the buffered drops as a chunk, even if it is not full."""
+        if self._filled == 0:
+            return
+        name = 'chunk_{:06d}.npz'.format(len(self.index))
+        columns = {field: self._buffer[field][:self._filled] for field in self.dtype.names}
+        if self._grid is not None:
+            columns['grid'] = self._grid
+        with open(os.path.join(self.path, name), 'wb') as f:
+            np.savez_compressed(f, **columns)
+        self.index.append({'file': name, 'start': self.rows, 'rows': self._filled,
+                           'snapshot_row': self._grid_row})
+        self._grid = None
+        self.rows += self._filled
+        self._filled = 0
+        _write_json(os.path.join(self.path, 'index.json'), self.index)
+
+    def close(self):
+        """Flush the last partial chunk and record the end of the run."""
+        if self.metadata is None:
+            return
+        self.flush()
+        self.metadata['rows'] = self.rows
+        self.metadata['finished'] = datetime.now(timezone.utc).isoformat()
+        _write_json(os.path.join(self.path, 'metadata.json'), self.metadata)
+
+
+class Dataset:
+    """
+    Read access to a dataset written by DatasetWriter.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'metadata.json')) as f:
+            self.metadata = json.load(f)
+        try:
+            with open(os.path.join(path, 'index.json')) as f:
+                self.index = json.load(f)
+        except FileNotFoundError:
+            self.index = []
+
+    def __len__(self):
+        return sum(chunk['rows'] for chunk in self.index)
+
+    @property
+    def columns(self):
+        return self.metadata['columns']
+
+    def _load(self, chunk, names):
+        with np.load(os.path.join(self.path, chunk['file'])) as data:
+            return {name: data[name] for name in names}
+
+    def iter_chunks(self, columns=None):
+        """
+        Yield the chunks one at a time, as dicts of column arrays.
+
+        Parameters
+        ==========
+        columns: list of column names to read; defaults to all of them
+        """
+        names = self.columns if columns is None else list(columns)
+        for chunk in self.index:
+            yield self._load(chunk, names)
+
+    def column(self, name, mmap=True):
+        """
+        Return a whole column. With `mmap`, the column is unpacked once into
+        columns/<name>.npy next to the chunks and memory-mapped from there.
+        """
+        if name not in self.columns:
+            raise KeyError('No column {!r}; expected one of {}'.format(
+                name, ', '.join(self.columns)))
+        if not mmap:
+            return np.concatenate([chunk[name] for chunk in self.iter_chunks([name])])
+
+        directory = os.path.join(self.path, 'columns')
+        path = os.path.join(directory, name + '.npy')
+        # Unpack again if more chunks were written since the last time
+        if not os.path.exists(path) or np.load(path, mmap_mode='r').shape[0] != len(self):
+            os.makedirs(directory, exist_ok=True)
+            out = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=np.int64,
+                                            shape=(len(self),))
+            for chunk in self.index:
+                out[chunk['start']:chunk['start'] + chunk['rows']] = \
+                    self._load(chunk, [name])[name]
+            out.flush()
+            del out
+            os.replace(path + '.tmp', path)
+        return np.load(path, mmap_mode='r')
+
+    def snapshots(self):
+        """
+        Yield (row, grid) for every snapshot, where the grid is the one left
+        after the first `row` drops of the dataset.
+        """
+        for chunk in self.index:
+            if chunk['snapshot_row'] is not None:
+                yield chunk['snapshot_row'], self._load(chunk, ['grid'])['grid']
+
+    def to_pile(self):
+        """
+        A pile of the dataset's topology holding the recorded history (and
+        the last snapshot, if any), so the analysis and graphing methods can
+        be run again without simulating.
+        """
+        from topologies import get_topology
+        meta = self.metadata
+        pile = get_topology(meta['topology'])(meta['width'], meta['height'],
+                                              threshold=meta['threshold'])
+        pile.pre_critical = meta.get('pre_critical', pile.pre_critical)
+        pile.mass_history = [meta['initial_mass']] + self.column('mass', mmap=False).tolist()
+        pile.topples_history = self.column('topples', mmap=False).tolist()
+        pile.area_history = self.column('area', mmap=False).tolist()
+        pile.length_history = self.column('length', mmap=False).tolist()
+        for _, grid in self.snapshots():
+            pile.grid = grid.astype(pile.grid.dtype)
+        return pile
@@ -0,0 +1,273 @@
+#################################################
+#   Author: Caleb Smith
+#   Student ID: 1027644
+#   November 9,2020
+#################################################
+"""
+Compact storage of avalanche footprints and spatial analyses on top of them.
+
+The footprint of an avalanche is the set of sites which toppled, together with
+its odometer (how many times each of those sites toppled). Footprints are
+stored column-wise in CSR style: avalanche i owns the entries
+indptr[i]:indptr[i+1] of the `indices` (1D site coordinates) and `counts`
+(topples) columns, so memory grows with the number of sites that toppled
+rather than with the grid size times the number of avalanches.
+
+Example usage:
+    pile = SandPile(100, 100, random=True)
+    store = pile.record_footprints()
+    pile.simulate(10000)
+    radius, anisotropy = gyration(store)
+"""
+import numpy as np
+
+
+class GrowableArray:
+    """
+    One-dimensional array which can be appended to in amortized constant
+    time by doubling its capacity when full.
+    """
+
+    def __init__(self, dtype, capacity=1024):
+        self._data = np.empty(capacity, dtype=dtype)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def _reserve(self, size):
+        if size > len(self._data):
+            data = np.empty(max(size, 2 * len(self._data)), dtype=self._data.dtype)
+            data[:self._size] = self._data[:self._size]
+            self._data = data
+
+    def append(self, value):
+        self._reserve(self._size + 1)
+        self._data[self._size] = value
+        self._size += 1
+
+    def extend(self, values):
+        values = np.asarray(values)
+        self._reserve(self._size + len(values))
+        self._data[self._size:self._size + len(values)] = values
+        self._size += len(values)
+
+    @property
+    def array(self):
+        """A view of the filled part of the array."""
+        return self._data[:self._size]
+
+    @property
+    def nbytes(self):
+        return self._data.nbytes
+
+
+class FootprintStore:
+    """
+    Columnar store of avalanche footprints, filled by SandPile when it is one
+    of the pile's recorders (see SandPile.record_footprints).
+    """
+
+    def __init__(self, width, height, periodic=(False, False), sinks=None):
+        """
+        Parameters
+        ==========
+        width, height: int, size of the grid
+        periodic: pair of bools, whether the width and height axes wrap around
+        sinks: optional boolean (width, height) array of the sink sites
+        """
+        self.width = width
+        self.height = height
+        self.boundary = boundary_sites(width, height, periodic, sinks)
+        self._indptr = GrowableArray(np.int64)
+        self._indptr.append(0)
+        self._starts = GrowableArray(np.int64)   # 1D coordinate of the drop site
+        self._indices = GrowableArray(np.int32)
+        self._counts = GrowableArray(np.int32)
+
+    def record(self, pile, start, odometer):
+        """Store the footprint of one avalanche given its odometer dict."""
+        self._starts.append(pile.get_1D_coord(start))
+        if len(odometer) > 0:
+            indices = np.fromiter(odometer.keys(), dtype=np.int32, count=len(odometer))
+            counts = np.fromiter(odometer.values(), dtype=np.int32, count=len(odometer))
+            order = np.argsort(indices)
+            self._indices.extend(indices[order])
+            self._counts.extend(counts[order])
+        self._indptr.append(len(self._indices))
+
+    def __len__(self):
+        return len(self._starts)
+
+    @property
+    def indptr(self):
+        return self._indptr.array
+
+    @property
+    def indices(self):
+        return self._indices.array
+
+    @property
+    def counts(self):
+        return self._counts.array
+
+    @property
+    def starts(self):
+        return self._starts.array
+
+    @property
+    def nbytes(self):
+        """Memory used by the store's columns."""
+        return sum(column.nbytes for column in
+                   (self._indptr, self._starts, self._indices, self._counts))
+
+    def footprint(self, i):
+        """Return the 1D coordinates and topple counts of avalanche `i`."""
+        begin, end = self.indptr[i], self.indptr[i + 1]
+        return self.indices[begin:end], self.counts[begin:end]
+
+    def odometer(self, i):
+        """Return the odometer of avalanche `i` as a dense width x height grid."""
+        grid = np.zeros(self.width * self.height, dtype=np.int64)
+        indices, counts = self.footprint(i)
+        grid[indices] = counts
+        return grid.reshape(self.width, self.height)
+
+    def sizes(self):
+        """Number of distinct sites which toppled in each avalanche."""
+        return np.diff(self.indptr)
+
+    def topples(self):
+        """Total number of topples of each avalanche."""
+        owner = np.repeat(np.arange(len(self)), self.sizes())
+        return np.bincount(owner, weights=self.counts,
+                           minlength=len(self)).astype(np.int64)
+
+    def coordinates(self):
+        """
+        Return the avalanche number, x and y of every stored entry, so that
+        analyses can work on all footprints at once.
+        """
+        owner = np.repeat(np.arange(len(self)), self.sizes())
+        x, y = np.divmod(self.indices.astype(np.int64), self.height)
+        return owner, x, y
+
+
+def gyration(store, weighted=False):
+    """
+    Radius of gyration and shape anisotropy of every avalanche footprint.
+    The anisotropy is (l1 - l2) / (l1 + l2) for the eigenvalues l1 >= l2 of
+    the gyration tensor: 0 for round footprints and 1 for straight lines.
+    Coordinates are not unwrapped across periodic boundaries. Avalanches with
+    no topples get nan.
+
+    Parameters
+    ==========
+    store: FootprintStore
+    weighted: bool, whether to weight each site by how often it toppled
+    """
+    owner, x, y = store.coordinates()
+    weights = store.counts.astype(np.float64) if weighted else np.ones(len(x))
+    n = len(store)
+    total = np.bincount(owner, weights=weights, minlength=n)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_x = np.bincount(owner, weights=weights * x, minlength=n) / total
+        mean_y = np.bincount(owner, weights=weights * y, minlength=n) / total
+        dx = x - mean_x[owner]
+        dy = y - mean_y[owner]
+        sxx = np.bincount(owner, weights=weights * dx * dx, minlength=n) / total
+        syy = np.bincount(owner, weights=weights * dy * dy, minlength=n) / total
+        sxy = np.bincount(owner, weights=weights * dx * dy, minlength=n) / total
+
+        trace = sxx + syy
+        spread = np.sqrt((sxx - syy) ** 2 + 4 * sxy ** 2)
+        anisotropy = np.where(trace > 0, spread / trace, 0.0)
+    radius = np.sqrt(trace)
+    anisotropy[np.isnan(radius)] = np.nan
+    return radius, anisotropy
+
+
+def box_counts(store, box_sizes=None):
+    """
+    Number of boxes of each size needed to cover every avalanche footprint.
+    Returns the box sizes and an array of shape (len(store), len(box_sizes)).
+
+    Parameters
+    ==========
+    store: FootprintStore
+    box_sizes: sequence of ints; defaults to the powers of two up to the
+        size of the grid
+    """
+    if box_sizes is None:
+        largest = max(store.width, store.height)
+        box_sizes = 2 ** np.arange(int(np.log2(largest)) + 1)
+    box_sizes = np.asarray(box_sizes, dtype=np.int64)
+
+    owner, x, y = store.coordinates()
+    counts = np.zeros((len(store), len(box_sizes)), dtype=np.int64)
+    for column, size in enumerate(box_sizes):
+        # Number of boxes along each axis, rounding up
+        boxes_x = -(-store.width // size)
+        boxes_y = -(-store.height // size)
+        boxes = (x // size) * boxes_y + y // size
+        # Unique (avalanche, box) pairs, counted per avalanche
+        keys = np.unique(owner * (boxes_x * boxes_y) + boxes)
+        counts[:, column] = np.bincount(keys // (boxes_x * boxes_y),
+                                        minlength=len(store))
+    return box_sizes, counts
+
+
+def box_counting_dimension(store, box_sizes=None, min_sites=16):
+    """
+    Box-counting (fractal) dimension of every avalanche footprint, from a
+    least squares fit of log(boxes) against -log(box size). Footprints with
+    fewer than `min_sites` sites are too small to fit and get nan.
+    """
+    box_sizes, counts = box_counts(store, box_sizes)
+    log_size = -np.log(box_sizes)
+    # Only fit over box sizes which split the footprint into several boxes
+    usable = counts > 1
+    log_counts = np.log(np.maximum(counts, 1))
+    n = usable.sum(axis=1)
+    sx = (usable * log_size).sum(axis=1)
+    sy = (usable * log_counts).sum(axis=1)
+    sxx = (usable * log_size ** 2).sum(axis=1)
+    sxy = (usable * log_counts * log_size).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = (n * sxy - sx * sy) / (n * sxx - sx ** 2)
+    slope[(store.sizes() < min_sites) | (n < 2)] = np.nan
+    return slope
+
+
+def boundary_sites(width, height, periodic=(False, False), sinks=None):
+    """
+    Boolean (width, height) grid of the sites which lose grains when they
+    topple: those next to a non-periodic edge or to a sink site.
+    """
+    boundary = np.zeros((width, height), dtype=bool)
+    if not periodic[0]:
+        boundary[[0, -1], :] = True
+    if not periodic[1]:
+        boundary[:, [0, -1]] = True
+    if sinks is not None and sinks.any():
+        for axis in (0, 1):
+            for shift in (-1, 1):
+                next_to = np.roll(sinks, shift, axis=axis)
+                if not periodic[axis]:
+                    # No wrapping: the row rolled in from the far side is not a neighbor
+                    index = [slice(None), slice(None)]
+                    index[axis] = 0 if shift == 1 else -1
+                    next_to[tuple(index)] = False
+                boundary |= next_to
+        boundary &= ~sinks
+    return boundary
+
+
+def boundary_hits(store):
+    """
+    Whether each avalanche toppled a site which loses grains: next to an
+    open edge of the grid or to the sink (see boundary_sites).
+    """
+    edge = store.boundary.ravel()[store.indices]
+    owner = np.repeat(np.arange(len(store)), store.sizes())
+    return np.bincount(owner, weights=edge, minlength=len(store)) > 0
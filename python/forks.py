@@ -0,0 +1,272 @@
+#################################################
+#   Author: Caleb Smith
+#   Student ID: 1027644
+#   November 9,2020
+#################################################
+"""
+Many futures branching from one pile.
+
+SandPile.fork(k) returns a ForkedPiles holding k branches which all start
+from the parent's current grid. The branches share a single read-only
+snapshot of that grid, and each branch gets its own copy only when it is
+written to: add_sand copies the one branch it perturbs, while drop_sand,
+which writes to every branch, gathers them into one k x sites array. The
+parent's history lists are referenced, never copied: each branch only
+stores what happened after the fork.
+
+All the branches are evolved together: one call to drop_sand drops a grain
+on every branch and relaxes all of them at once in vectorized sweeps over
+the stacked grid (see graphpile.GraphSandPile, whose relaxation this
+batches), so the cost per step is that of the toppling, not of k separate
+piles.
+
+Example usage (damage spreading):
+    forks = pile.fork(2)
+    forks.add_sand(1, (10, 10))
+    forks.simulate(1000, site=None, same_site=True)
+    forks.differences()
+"""
+import numpy as np
+
+FIELDS = ('mass', 'topples', 'area', 'length')
+# Lattices of the piles forked so far, keyed by (topology, width, height,
+# threshold); building one walks every site of the grid
+_lattices = {}
+
+
+class ForkedPiles:
+    """
+    k branches of a SandPile, evolved together on a stacked grid.
+    """
+
+    def __init__(self, parent, k):
+        """
+        Parameters
+        ==========
+        parent: SandPile (or subclass) to branch from
+        k: int, number of branches
+        """
+        from graphpile import from_pile
+        self.parent = parent
+        self.k = k
+        self.width = parent.width
+        self.height = parent.height
+        key = (parent.topology, parent.width, parent.height, parent.threshold)
+        if key not in _lattices:
+            _lattices[key] = from_pile(parent)
+        self.lattice = _lattices[key]
+        self.n = self.lattice.n
+        # One snapshot of the grid, shared by every branch until written to
+        snapshot = np.array(parent.grid, dtype=np.int64).ravel()
+        snapshot.flags.writeable = False
+        self._snapshot = snapshot
+        self._rows = [snapshot] * k     # The heights of each branch
+        self._stack = None              # (k, n) array of all rows, once gathered
+        # The parent's history up to the fork, referenced read-only
+        self.offset = len(parent.topples_history)
+        self._history = {field: [] for field in FIELDS}
+
+    @property
+    def shared(self):
+        """Whether every branch still shares the parent's grid."""
+        return all(row is self._snapshot for row in self._rows)
+
+    def _branch(self, branch):
+        """The heights of one branch as a writable (1, n) array, copied
+        out of the shared snapshot if not done yet."""
+        if self._rows[branch] is self._snapshot:
+            self._rows[branch] = self._snapshot.copy()
+        return self._rows[branch][None]
+
+    def _stacked(self):
+        """The heights of every branch as one writable (k, n) array."""
+        if self._stack is None:
+            self._stack = np.array(self._rows)
+            self._rows = list(self._stack)
+        return self._stack
+
+    @property
+    def grids(self):
+        """
+        The grids of all branches, as a read-only (k, width, height) array.
+        While some but not all branches have their own copy, this is a new
+        array rather than a view.
+        """
+        if self._stack is not None:
+            grids = self._stack.view()
+        elif self.shared:
+            grids = np.broadcast_to(self._snapshot, (self.k, self.n))
+        else:
+            grids = np.array(self._rows)
+        grids = grids.reshape(self.k, self.width, self.height)
+        grids.flags.writeable = False
+        return grids
+
+    def grid(self, branch):
+        """The grid of one branch, read-only."""
+        grid = self._rows[branch].reshape(self.width, self.height)
+        grid.flags.writeable = False
+        return grid
+
+    def mass(self):
+        """Return the mass of every branch."""
+        if self._stack is not None:
+            return self._stack.sum(axis=1)
+        return np.array([row.sum() for row in self._rows])
+
+    def _vertices(self, sites, same_site):
+        """Flat (branch, site) indices of the drop sites of every branch."""
+        if sites is None:
+            count = 1 if same_site else self.k
+            x = np.random.randint(0, self.width, count)
+            y = np.random.randint(0, self.height, count)
+            sites = np.broadcast_to(x * self.height + y, (self.k,))
+        else:
+            sites = np.asarray(sites)
+            sites = sites[..., 0] * self.height + sites[..., 1]
+            sites = np.broadcast_to(sites, (self.k,))
+        return np.arange(self.k) * self.n + sites
+
+    def add_sand(self, branch, site, n=1):
+        """
+        Add `n` grains to `site` of a single branch and relax it, without
+        recording an avalanche. Use this to perturb one branch.
+        """
+        heights = self._branch(branch)
+        vertex = self.lattice.index(site)
+        heights[0, vertex] += n
+        if self.lattice.sinks[vertex]:
+            heights[0, vertex] = 0
+        self._relax(heights, np.array([vertex]))
+
+    def drop_sand(self, n=1, sites=None, same_site=False):
+        """
+        Add `n` grains to every branch and relax them all together.
+
+        Parameters
+        ==========
+        n: int, number of grains to drop on each branch
+        sites: None for random sites, the coordinates of one site for all
+            branches, or a (k, 2) array with the site of each branch
+        same_site: bool, with random sites, whether every branch gets the
+            same one (the same drop sequence in every future)
+        """
+        stack = self._stacked()
+        heights = stack.ravel()
+        vertices = self._vertices(sites, same_site)
+        heights[vertices] += n
+        sink_drops = self.lattice.sinks[vertices % self.n]
+        heights[vertices[sink_drops]] = 0
+
+        topples, reached = self._relax(stack, vertices)
+        area = np.zeros(self.k, dtype=np.int64)
+        length = np.zeros(self.k, dtype=np.int64)
+        moved = np.flatnonzero(topples > 0)
+        if len(moved) > 0:
+            affected = np.union1d(reached, vertices[moved])
+            area = np.bincount(affected // self.n, minlength=self.k).astype(np.int64)
+            coords = self.lattice.coords
+            branches = reached // self.n
+            for branch in moved:
+                targets = reached[branches == branch] % self.n
+                start = coords[vertices[branch] % self.n]
+                length[branch] = np.max(self.lattice.distance(start, coords[targets]),
+                                        initial=0)
+
+        self._history['mass'].append(self.mass())
+        self._history['topples'].append(topples)
+        self._history['area'].append(area)
+        self._history['length'].append(length)
+
+    def _relax(self, stack, vertices):
+        """
+        Topple every row of the C-contiguous (branches, n) array `stack`
+        until it is stable, starting from the flat (branch, site) indices
+        `vertices`. Returns the number of topples of every branch and the
+        flat indices which received grains.
+        """
+        heights = stack.ravel()
+        branches = len(stack)
+        lattice = self.lattice
+        thresholds, losses = lattice.thresholds, lattice.losses
+        sinks = lattice.sinks if lattice.sinks.any() else None
+        active = np.unique(vertices)
+
+        total = np.zeros(branches, dtype=np.int64)
+        reached = []
+        while len(active) > 0:
+            sites = active % self.n
+            unstable = heights[active] >= thresholds[sites]
+            active, sites = active[unstable], sites[unstable]
+            if len(active) == 0:
+                break
+            # Topple every unstable site as often as it can at once
+            topples = (heights[active] - thresholds[sites]) // losses[sites] + 1
+            heights[active] -= topples * losses[sites]
+            total += np.bincount(active // self.n, weights=topples,
+                                 minlength=branches).astype(np.int64)
+            starts = lattice.indptr[sites]
+            lengths = lattice.indptr[sites + 1] - starts
+            edges = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + \
+                np.arange(lengths.sum())
+            # Same site in the same branch: shift the targets by the branch
+            targets = lattice.indices[edges] + np.repeat(active - sites, lengths)
+            targets, inverse = np.unique(targets, return_inverse=True)
+            heights[targets] += np.bincount(
+                inverse, weights=lattice.weights[edges] * np.repeat(topples, lengths),
+                minlength=len(targets)).astype(np.int64)
+            if sinks is not None:
+                # Grains sent to sink sites leave the pile
+                heights[targets[sinks[targets % self.n]]] = 0
+            reached.append(targets)
+            # Sites which toppled are stable now unless they received grains
+            active = targets
+
+        if len(reached) == 0:
+            return total, np.zeros(0, dtype=np.int64)
+        return total, np.unique(np.concatenate(reached))
+
+    def simulate(self, steps, n=1, site=None, same_site=False):
+        """
+        Evolve all the branches by `steps` drops, as for drop_sand.
+        """
+        for _ in range(steps):
+            self.drop_sand(n, site, same_site)
+
+    def history(self, field):
+        """
+        The `field` ('mass', 'topples', 'area' or 'length') history recorded
+        since the fork, as a (steps, k) array.
+        """
+        if len(self._history[field]) == 0:
+            return np.zeros((0, self.k), dtype=np.int64)
+        return np.array(self._history[field])
+
+    def parent_history(self, field):
+        """
+        The parent's `field` history up to the fork. The fork only holds a
+        reference to the parent's lists; this returns a copy of the part
+        recorded before the fork.
+        """
+        history = getattr(self.parent, field + '_history')
+        return history[:self.offset + (field == 'mass')]
+
+    def differences(self, reference=0):
+        """Number of sites where each branch differs from `reference`."""
+        reference = self._rows[reference]
+        return np.array([np.count_nonzero(row != reference) for row in self._rows])
+
+    def to_pile(self, branch):
+        """
+        A standalone pile of the parent's class holding one branch: its grid
+        and the parent's history followed by the branch's.
+        """
+        parent = self.parent
+        pile = type(parent)(self.width, self.height, threshold=parent.threshold)
+        pile.grid = self.grid(branch).astype(parent.grid.dtype)
+        pile.pre_critical = parent.pre_critical
+        pile.burn_in = parent.burn_in
+        for field in FIELDS:
+            setattr(pile, field + '_history', list(self.parent_history(field)) +
+                    self.history(field)[:, branch].tolist())
+        return pile
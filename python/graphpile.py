@@ -0,0 +1,398 @@
+#################################################
+#   Author: Caleb Smith
+#   Student ID: 1027644
+#   November 9,2020
+#################################################
+"""
+Sandpiles on arbitrary graphs.
+
+A Lattice describes the graph through its toppling Laplacian with the sink
+removed, stored as plain CSR arrays: vertex i topples once it holds at least
+thresholds[i] grains, loses losses[i] grains (its degree, counting the edges
+to the sink) and sends weights[k] grains to vertex indices[k] for every k in
+indptr[i]:indptr[i+1]. Whatever is not sent to another vertex falls into the
+sink. The losses default to the thresholds; from_pile passes 2*dimension
+instead, since a SandPile loses one grain in every direction whatever its
+threshold. Builders are provided for d-dimensional hypercubic, triangular
+and hexagonal lattices, for the grids of the SandPile classes, and for any
+user-supplied Laplacian.
+
+GraphSandPile relaxes a lattice in vectorized sweeps: every unstable vertex
+topples as many times as it can at once and the grains are scattered with one
+sparse update per sweep, so the cost per topple does not depend on the
+dimension of the lattice.
+
+Example usage:
+    pile = GraphSandPile(hypercubic((30, 30, 30)))
+    pile.simulate(10000)
+"""
+import numpy as np
+
+
+class Lattice:
+    """
+    Graph of a sandpile given by its reduced toppling Laplacian in CSR form.
+    """
+
+    def __init__(self, indptr, indices, weights, thresholds, coords=None,
+                 shape=None, sinks=None, distance=None, losses=None):
+        """
+        Parameters
+        ==========
+        indptr, indices, weights: CSR arrays of the grains each vertex sends
+            to each of its neighbors when it topples
+        thresholds: array, grains needed for each vertex to topple
+        coords: optional (vertices x dimension) array of vertex positions,
+            used to measure avalanche lengths
+        shape: optional grid shape, when the vertices are the sites of a grid
+            in row-major order
+        sinks: optional boolean array of vertices which belong to the sink:
+            they keep their index and may be sent grains, but those grains
+            are removed straight away and the vertex never topples
+        distance: optional function of a start position and an array of
+            positions returning the distances used for avalanche lengths;
+            defaults to the manhattan distance
+        losses: optional array (or number) of the grains each vertex loses
+            when it topples, its degree; defaults to the thresholds
+        """
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.weights = np.asarray(weights, dtype=np.int64)
+        self.thresholds = np.asarray(thresholds, dtype=np.int64)
+        self.coords = None if coords is None else np.asarray(coords)
+        self.shape = None if shape is None else tuple(shape)
+        self.sinks = np.zeros(self.n, dtype=bool) if sinks is None else np.asarray(sinks, dtype=bool)
+        self.distance = distance if distance is not None else _manhattan
+        self.losses = self.thresholds if losses is None else \
+            np.broadcast_to(np.asarray(losses, dtype=np.int64), (self.n,))
+
+    @property
+    def n(self):
+        """Number of vertices, not counting the sink."""
+        return len(self.thresholds)
+
+    def degrees(self):
+        """Grains each vertex sends to other vertices when it topples."""
+        rows = np.repeat(np.arange(self.n), np.diff(self.indptr))
+        return np.bincount(rows, weights=self.weights, minlength=self.n).astype(np.int64)
+
+    def sink_edges(self):
+        """Grains each vertex sends to the sink (including sink vertices)
+        when it topples."""
+        rows = np.repeat(np.arange(self.n), np.diff(self.indptr))
+        kept = ~self.sinks[self.indices]
+        return self.losses - np.bincount(
+            rows[kept], weights=self.weights[kept], minlength=self.n).astype(np.int64)
+
+    def spread(self, vertices, topples):
+        """
+        Return the vertices receiving grains when each of `vertices` topples
+        the matching number of `topples` times, and how many grains each gets.
+        Targets are unique.
+        """
+        starts = self.indptr[vertices]
+        lengths = self.indptr[vertices + 1] - starts
+        # Position in `indices` of every edge leaving `vertices`
+        edges = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + \
+            np.arange(lengths.sum())
+        targets, inverse = np.unique(self.indices[edges], return_inverse=True)
+        amounts = np.bincount(inverse, weights=self.weights[edges] * np.repeat(topples, lengths),
+                              minlength=len(targets)).astype(np.int64)
+        return targets, amounts
+
+    def index(self, site):
+        """Vertex index of `site`, given either as an index or as grid coordinates."""
+        if np.ndim(site) == 0:
+            return int(site)
+        return int(np.ravel_multi_index(tuple(site), self.shape))
+
+    def laplacian(self):
+        """
+        The reduced toppling Laplacian as a scipy.sparse CSR matrix; its
+        diagonal holds the losses, so it does not record other thresholds.
+        """
+        from scipy import sparse
+        adjacency = sparse.csr_matrix((self.weights, self.indices, self.indptr),
+                                      shape=(self.n, self.n))
+        return (sparse.diags(self.losses, dtype=np.int64) - adjacency).tocsr()
+
+    @classmethod
+    def from_laplacian(cls, laplacian, coords=None, shape=None):
+        """
+        Build a lattice from a reduced toppling Laplacian: the diagonal holds
+        the thresholds (and losses) and off-diagonal entries are minus the grains sent
+        from the row vertex to the column vertex. Accepts scipy.sparse
+        matrices and dense arrays.
+        """
+        if hasattr(laplacian, 'tocoo'):
+            coo = laplacian.tocoo()
+            rows, cols, values = coo.row, coo.col, coo.data
+            thresholds = laplacian.diagonal()
+        else:
+            laplacian = np.asarray(laplacian)
+            rows, cols = np.nonzero(laplacian)
+            values = laplacian[rows, cols]
+            thresholds = np.diagonal(laplacian)
+        off = rows != cols
+        return _from_edges(len(thresholds), rows[off], cols[off], -values[off],
+                           thresholds, coords=coords, shape=shape)
+
+
+def _manhattan(start, coords):
+    return np.abs(coords - start).sum(axis=1)
+
+
+def _from_edges(n, sources, targets, weights, thresholds, **kwargs):
+    """Build a Lattice from a list of (possibly repeated) weighted edges."""
+    sources = np.asarray(sources, dtype=np.int64)
+    targets = np.asarray(targets, dtype=np.int64)
+    weights = np.asarray(weights, dtype=np.int64)
+    # Sort by source and merge repeated edges into a single weighted one
+    keys, inverse = np.unique(sources * n + targets, return_inverse=True)
+    merged = np.bincount(inverse, weights=weights).astype(np.int64)
+    rows, cols = np.divmod(keys, n)
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=n))])
+    return Lattice(indptr, cols, merged, np.broadcast_to(thresholds, (n,)), **kwargs)
+
+
+def _grid_lattice(shape, offsets, periodic, threshold, keep=None):
+    """
+    Build a lattice on the sites of a grid of `shape` where each site sends
+    one grain along every offset which stays inside the grid (or wraps, along
+    periodic axes). `keep(coords, offset)` may reject further edges.
+    """
+    shape = tuple(shape)
+    dimension = len(shape)
+    if isinstance(periodic, bool):
+        periodic = (periodic,) * dimension
+    coords = np.indices(shape).reshape(dimension, -1)
+    sizes = np.array(shape)[:, None]
+    sources, targets = [], []
+    for offset in offsets:
+        moved = coords + np.array(offset)[:, None]
+        inside = np.ones(coords.shape[1], dtype=bool)
+        for axis in range(dimension):
+            if periodic[axis]:
+                moved[axis] %= shape[axis]
+            else:
+                inside &= (moved[axis] >= 0) & (moved[axis] < shape[axis])
+        if keep is not None:
+            inside &= keep(coords, offset)
+        moved = np.minimum(np.maximum(moved, 0), sizes - 1)
+        sources.append(np.flatnonzero(inside))
+        targets.append(np.ravel_multi_index(tuple(moved[:, inside]), shape))
+    n = coords.shape[1]
+    sources = np.concatenate(sources)
+    return _from_edges(n, sources, np.concatenate(targets), np.ones(len(sources)),
+                       threshold, coords=coords.T, shape=shape)
+
+
+def hypercubic(shape, periodic=False):
+    """
+    d-dimensional hypercubic lattice with 2d neighbors per site; grains
+    leaving the grid through a non-periodic boundary fall into the sink.
+
+    Parameters
+    ==========
+    shape: tuple of ints, the size along each axis
+    periodic: bool or tuple of bools, whether each axis wraps around
+    """
+    dimension = len(shape)
+    offsets = []
+    for axis in range(dimension):
+        for step in (-1, 1):
+            offset = [0] * dimension
+            offset[axis] = step
+            offsets.append(offset)
+    return _grid_lattice(shape, offsets, periodic, 2 * dimension)
+
+
+def triangular(width, height, periodic=False):
+    """Triangular lattice with 6 neighbors per site, stored on a sheared grid."""
+    offsets = [(1, 0), (-1, 0), (0, 1), (0, -1), (1, -1), (-1, 1)]
+    return _grid_lattice((width, height), offsets, periodic, 6)
+
+
+def hexagonal(width, height, periodic=False):
+    """
+    Hexagonal (honeycomb) lattice with 3 neighbors per site, stored as a
+    brick wall: every site is joined to its left and right neighbors, and to
+    the site above if x + y is even, or below if it is odd.
+    """
+    def vertical(coords, offset):
+        even = (coords[0] + coords[1]) % 2 == 0
+        if offset[1] == 1:
+            return even
+        if offset[1] == -1:
+            return ~even
+        return np.ones(coords.shape[1], dtype=bool)
+
+    offsets = [(1, 0), (-1, 0), (0, 1), (0, -1)]
+    return _grid_lattice((width, height), offsets, periodic, 3, keep=vertical)
+
+
+def from_pile(pile):
+    """
+    Lattice with the same boundary conditions as a SandPile (or subclass)
+    instance, built from its get_neighbors method. Sites for which
+    `pile.is_sink` is true (the hourglass hole) become part of the sink.
+    """
+    width, height = pile.width, pile.height
+    sinks = np.array([pile.is_sink((x, y)) for x in range(width)
+                      for y in range(height)], dtype=bool)
+    sources, targets = [], []
+    for x in range(width):
+        for y in range(height):
+            if sinks[x * height + y]:
+                continue
+            for neighbor in pile.get_neighbors((x, y)):
+                sources.append(x * height + y)
+                targets.append(neighbor[0] * height + neighbor[1])
+    coords = np.indices((width, height)).reshape(2, -1).T
+    shape, periodic = np.array([width, height]), np.array(pile.periodic)
+
+    # The piles' own distance for avalanche lengths: Manhattan, except that on
+    # a periodic axis it is the smaller of |a - b| and |size - (a + b)|. Only
+    # the shape is kept, so cached lattices do not hold on to `pile`
+    def distance(start, positions):
+        apart = np.abs(positions - np.asarray(start))
+        wrapped = np.abs(shape - (positions + np.asarray(start)))
+        return np.where(periodic, np.minimum(apart, wrapped), apart).sum(axis=-1)
+
+    # A site loses one grain per direction, whatever the threshold
+    return _from_edges(width * height, sources, targets, np.ones(len(sources)),
+                       pile.threshold, coords=coords, shape=(width, height),
+                       sinks=sinks, distance=distance, losses=2 * pile.dimension)
+
+
+class GraphSandPile:
+    """
+    Sandpile on an arbitrary Lattice, relaxed with vectorized sweeps.
+    Keeps the same history lists as SandPile.
+    """
+
+    def __init__(self, lattice, random=False):
+        self.lattice = lattice
+        self.threshold = lattice.thresholds
+        if random:
+            self.heights = np.random.randint(1, np.maximum(lattice.thresholds, 2))
+            self.heights[lattice.sinks] = 0
+            self.pre_critical = False
+        else:
+            self.heights = np.zeros(lattice.n, dtype=np.int64)
+            self.pre_critical = True
+
+        self.mass_history = [0]
+        self.topples_history = []
+        self.area_history = []
+        self.length_history = []
+
+    @classmethod
+    def from_pile(cls, pile):
+        """GraphSandPile with the boundary conditions and grid of `pile`."""
+        graph_pile = cls(from_pile(pile))
+        graph_pile.heights = np.array(pile.grid, dtype=np.int64).ravel()
+        graph_pile.pre_critical = pile.pre_critical
+        return graph_pile
+
+    @property
+    def grid(self):
+        """The heights arranged on the lattice's grid shape."""
+        return self.heights.reshape(self.lattice.shape)
+
+    def mass(self):
+        """Return the total mass of the pile."""
+        return int(np.sum(self.heights))
+
+    def relax(self, vertices=None):
+        """
+        Topple until every vertex is stable. Returns the odometer as a pair of
+        arrays (vertices which toppled, number of times they did) and the
+        vertices which received grains.
+
+        Parameters
+        ==========
+        vertices: array of the vertices which may be unstable; if None, the
+            whole lattice is checked
+        """
+        heights = self.heights
+        thresholds, losses = self.lattice.thresholds, self.lattice.losses
+        sinks = self.lattice.sinks if self.lattice.sinks.any() else None
+        if vertices is None:
+            active = np.flatnonzero(heights >= thresholds)
+        else:
+            active = np.unique(vertices)
+
+        toppled, counts, reached = [], [], []
+        while len(active) > 0:
+            unstable = active[heights[active] >= thresholds[active]]
+            if len(unstable) == 0:
+                break
+            # Topple every unstable vertex as often as it can at once
+            topples = (heights[unstable] - thresholds[unstable]) // losses[unstable] + 1
+            heights[unstable] -= topples * losses[unstable]
+            targets, amounts = self.lattice.spread(unstable, topples)
+            heights[targets] += amounts
+            if sinks is not None:
+                # Grains sent to sink vertices leave the pile
+                heights[targets[sinks[targets]]] = 0
+
+            toppled.append(unstable)
+            counts.append(topples)
+            reached.append(targets)
+            active = np.union1d(unstable, targets)
+
+        if len(toppled) == 0:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, empty
+        sites, inverse = np.unique(np.concatenate(toppled), return_inverse=True)
+        odometer = np.bincount(inverse, weights=np.concatenate(counts)).astype(np.int64)
+        return sites, odometer, np.unique(np.concatenate(reached))
+
+    def stabilize(self):
+        """Topple until every vertex is stable; returns the number of topples."""
+        _, odometer, _ = self.relax()
+        return int(odometer.sum())
+
+    def drop_sand(self, n=1, site=None):
+        """
+        Add `n` grains to `site` (a vertex index or grid coordinates), or to a
+        random vertex, relax, and record the avalanche statistics.
+        """
+        if site is None:
+            vertex = np.random.randint(0, self.lattice.n)
+        else:
+            vertex = self.lattice.index(site)
+        self.heights[vertex] += n
+        if self.lattice.sinks[vertex]:
+            self.heights[vertex] = 0
+
+        sites, odometer, reached = self.relax([vertex])
+        if len(sites) == 0:
+            topples, area, length = 0, 0, 0
+        else:
+            topples = int(odometer.sum())
+            area = len(np.union1d(reached, [vertex]))
+            length = 0
+            if self.lattice.coords is not None:
+                coords = self.lattice.coords
+                length = int(np.max(self.lattice.distance(coords[vertex], coords[reached]),
+                                    initial=0))
+        self.mass_history.append(self.mass())
+        self.topples_history.append(topples)
+        self.area_history.append(area)
+        self.length_history.append(length)
+
+    def simulate(self, steps, n=1, site=None):
+        """
+        Evolve the system by dropping sand on the lattice
+
+        Parameters
+        ==========
+        steps: int, number of steps to evolve
+        n: int, number of grains to drop per step
+        site: vertex index or grid coordinates to drop grains on;
+            if none specified, drops are made on a random vertex
+        """
+        for _ in range(steps):
+            self.drop_sand(n, site)
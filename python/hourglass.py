@@ -4,9 +4,6 @@
 #   November 9,2020
 #################################################
 import numpy as np
-import scipy as sp
-import scipy.stats
-from matplotlib import pyplot
 from sandpile import SandPile
 
 
@@ -16,6 +13,8 @@ class HourGlassSandPile(SandPile):
     the x and y directions wrap around and there is a central
     zone in the middle through which sand may fall.
     """
+    topology = 'hourglass'
+    periodic = (True, True)
 
     def __init__(self, width, height, threshold=4, random=False):
         SandPile.__init__(self, width, height,
@@ -42,6 +41,16 @@ class HourGlassSandPile(SandPile):
         else:
             return False
 
+    def is_sink(self, site):
+        """The central hole is the sink of the hourglass."""
+        return self.is_central(site)
+
+    def sink_mask(self):
+        """Vectorized is_central over the whole grid."""
+        x = np.arange(self.width)[:, None]
+        y = np.arange(self.height)[None, :]
+        return (np.abs(x - self.width // 2) < 2) & (np.abs(y - self.height // 2) < 2)
+
     def get_neighbors(self, site):
         """
         Override get_neighbors to handle the different boundary conditions
@@ -88,7 +97,9 @@ class HourGlassSandPile(SandPile):
         for neighbor in neighbors:
             self.grid[tuple(neighbor)] += 1
 
-        self.grid[tuple(site)] -= 4
+        # The grid wraps around both axes, so every grain stays on it; the
+        # grains sent into the central hole are the ones which are lost
+        self.grid[tuple(site)] -= 2 * self.dimension
         return neighbors
 
     def dist(self, x, y):
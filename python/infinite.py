@@ -0,0 +1,325 @@
+#################################################
+#   Author: Caleb Smith
+#   Student ID: 1027644
+#   November 9,2020
+#################################################
+"""
+A sandpile on the infinite square lattice.
+
+Instead of a fixed width and height, the lattice is stored as square tiles
+which are allocated the first time grains reach them, so the pile never
+feels a boundary and memory and time follow the region the sand has actually
+covered. All the allocated tiles live in one (tiles, size, size) array, and
+every tile knows which tiles are its 4 neighbors. Relaxation works in sweeps
+over the tiles holding unstable sites, like the bulk engine (see bulk.py):
+every unstable site topples as often as it can at once, grains move within
+a tile by shifted additions and across tiles along their edges. Drops of
+many grains at once are instead relaxed by the bulk engine on a box around
+the pile, grown until nothing topples on its border, so that no grain could
+have left it.
+
+Coordinates are unbounded integers, with the sand usually dropped at the
+origin (0, 0). grid() returns the heights cropped to the occupied region.
+
+Example usage:
+    pile = InfiniteSandPile()
+    pile.drop_sand(10**5)
+    pile.grid()
+"""
+import io
+
+import numpy as np
+
+# Grains a site loses when it topples, one to each of the 4 directions
+LOST = 4
+# Offsets of the neighboring tiles in the order of the edges crossed:
+# down (+x), up (-x), right (+y), left (-y)
+DIRECTIONS = ((1, 0), (-1, 0), (0, 1), (0, -1))
+OPPOSITE = (1, 0, 3, 2)
+# Drops of at least this many grains are relaxed with the bulk engine
+BULK_GRAINS = 1024
+
+
+def _edge(direction, side):
+    """
+    Index of the edge of a tile stack on `side` ('out' for the cells whose
+    grains leave in `direction`, 'in' for those receiving them).
+    """
+    last = (side == 'out') == (direction % 2 == 0)
+    cells = -1 if last else 0
+    if direction < 2:
+        return (slice(None), cells, slice(None))
+    return (slice(None), slice(None), cells)
+
+
+class InfiniteSandPile:
+    """
+    Sandpile on an unbounded lattice, stored as tiles allocated on demand.
+    """
+    topology = 'infinite'
+
+    def __init__(self, threshold=4, tile=32):
+        """
+        Parameters
+        ==========
+        threshold: int, grains needed for a site to topple
+        tile: int, width and height of the tiles
+        """
+        self.threshold = threshold
+        self.tile = tile
+        self._heights = np.zeros((4, tile, tile), dtype=np.int64)
+        self._reached = np.zeros((4, tile, tile), dtype=bool)
+        self._coords = np.zeros((4, 2), dtype=np.int64)
+        self._neighbors = np.full((4, 4), -1, dtype=np.int64)
+        self._index = {}
+        self.mass_history = [0]
+        self.topples_history = []
+        self.area_history = []
+        self.length_history = []
+
+    @property
+    def tiles(self):
+        """Number of tiles allocated so far."""
+        return len(self._index)
+
+    @property
+    def nbytes(self):
+        """Memory used by the tiles."""
+        return sum(array.nbytes for array in (
+            self._heights, self._reached, self._coords, self._neighbors))
+
+    def _allocate(self, coords):
+        """Allocate the tile at tile coordinates `coords`, returning its index."""
+        index = len(self._index)
+        if index == len(self._heights):
+            # Double the capacity of every per-tile array
+            grown = 2 * index
+            self._heights = np.concatenate([self._heights, np.zeros_like(self._heights)])
+            self._reached = np.concatenate([self._reached, np.zeros_like(self._reached)])
+            self._coords = np.concatenate([self._coords, np.zeros_like(self._coords)])
+            self._neighbors = np.concatenate(
+                [self._neighbors, np.full((grown - index, 4), -1, dtype=np.int64)])
+        self._index[coords] = index
+        self._coords[index] = coords
+        for direction, (dx, dy) in enumerate(DIRECTIONS):
+            neighbor = self._index.get((coords[0] + dx, coords[1] + dy))
+            if neighbor is not None:
+                self._neighbors[index, direction] = neighbor
+                self._neighbors[neighbor, OPPOSITE[direction]] = index
+        return index
+
+    def _locate(self, site, allocate=True):
+        """Index of the tile holding `site` and the site's place in it."""
+        tile_coords = (site[0] // self.tile, site[1] // self.tile)
+        index = self._index.get(tile_coords)
+        if index is None and allocate:
+            index = self._allocate(tile_coords)
+        return index, (site[0] % self.tile, site[1] % self.tile)
+
+    def __getitem__(self, site):
+        """Height of one site; sites which sand never reached hold 0."""
+        index, local = self._locate(site, allocate=False)
+        return 0 if index is None else int(self._heights[index][local])
+
+    def add_sand(self, site=(0, 0), n=1):
+        """Add `n` grains to `site` without relaxing."""
+        index, local = self._locate(tuple(site))
+        self._heights[index][local] += n
+        return index
+
+    def drop_sand(self, n=1, site=(0, 0)):
+        """
+        Add `n` grains to `site` and relax, recording the avalanche in the
+        history lists.
+        """
+        site = tuple(site)
+        index = self.add_sand(site, n)
+        if n >= BULK_GRAINS:
+            topples, reached, xmin, ymin = self._relax_bulk(site)
+            x, y = np.nonzero(reached)
+            x, y = x + xmin, y + ymin
+        else:
+            topples, touched = self._relax(np.array([index]))
+            tiles, x, y = np.nonzero(self._reached[touched])
+            x = x + self._coords[touched[tiles], 0] * self.tile
+            y = y + self._coords[touched[tiles], 1] * self.tile
+            self._reached[touched] = False
+        area = len(x) if topples > 0 else 0
+        # Manhattan distance, as SandPile.dist
+        length = int(np.max(np.abs(x - site[0]) + np.abs(y - site[1]))) if area > 0 else 0
+        self.mass_history.append(self.mass_history[-1] + n)
+        self.topples_history.append(topples)
+        self.area_history.append(area)
+        self.length_history.append(length)
+
+    def simulate(self, steps, n=1, site=(0, 0)):
+        """Drop `n` grains on `site` `steps` times, relaxing after each drop."""
+        for _ in range(steps):
+            self.drop_sand(n, site)
+
+    def _relax(self, active):
+        """
+        Topple until every tile is stable, starting from the tiles `active`.
+        Returns the number of topples and the indices of the tiles which
+        grains reached.
+        """
+        threshold = self.threshold
+        total = 0
+        touched = []
+        while len(active) > 0:
+            heights = self._heights[active]
+            topples = np.where(heights >= threshold, (heights - threshold) // LOST + 1, 0)
+            busy = topples.reshape(len(active), -1).any(axis=1)
+            if not busy.any():
+                break
+            active, heights, topples = active[busy], heights[busy], topples[busy]
+            total += int(topples.sum())
+            touched.append(active)
+            # Sites which toppled or received grains count towards the area
+            toppled = topples > 0
+            reached = toppled.copy()
+            reached[:, 1:, :] |= toppled[:, :-1, :]
+            reached[:, :-1, :] |= toppled[:, 1:, :]
+            reached[:, :, 1:] |= toppled[:, :, :-1]
+            reached[:, :, :-1] |= toppled[:, :, 1:]
+            self._reached[active] |= reached
+
+            # Grains moving within each tile
+            heights -= LOST * topples
+            heights[:, 1:, :] += topples[:, :-1, :]
+            heights[:, :-1, :] += topples[:, 1:, :]
+            heights[:, :, 1:] += topples[:, :, :-1]
+            heights[:, :, :-1] += topples[:, :, 1:]
+            self._heights[active] = heights
+
+            # Grains crossing into the neighboring tiles, allocated if needed
+            receivers = [active]
+            for direction, (dx, dy) in enumerate(DIRECTIONS):
+                leaving = topples[_edge(direction, 'out')]
+                sending = leaving.any(axis=1)
+                if not sending.any():
+                    continue
+                for index in active[sending][self._neighbors[active[sending], direction] < 0]:
+                    x, y = self._coords[index]
+                    self._allocate((int(x) + dx, int(y) + dy))
+                targets = self._neighbors[active[sending], direction]
+                edge = (targets,) + _edge(direction, 'in')[1:]
+                self._heights[edge] += leaving[sending]
+                self._reached[edge] |= leaving[sending] > 0
+                receivers.append(targets)
+                touched.append(targets)
+            active = np.unique(np.concatenate(receivers))
+
+        if len(touched) == 0:
+            return 0, np.zeros(0, dtype=np.int64)
+        return total, np.unique(np.concatenate(touched))
+
+    def _relax_bulk(self, site):
+        """
+        Relax the whole pile with the bulk engine, on a box around the pile
+        and `site` large enough for the pile's mass. Returns the number of
+        topples, which sites of the box grains reached and the box's corner.
+        """
+        from bulk import stabilize
+        xmin, xmax, ymin, ymax = self.bounds()
+        # A stable pile holds well over 2 grains per site on average
+        radius = int(np.ceil(np.sqrt(self.mass() / (2 * np.pi)))) + 2
+        while True:
+            box = (min(xmin, site[0] - radius), max(xmax, site[0] + radius),
+                   min(ymin, site[1] - radius), max(ymax, site[1] + radius))
+            grid, odometer = stabilize(self._read(*box), threshold=self.threshold,
+                                       odometer=True)
+            # Grains only leave the box when a site on its border topples
+            if not (odometer[[0, -1], :].any() or odometer[:, [0, -1]].any()):
+                break
+            radius *= 2
+        self._write(grid, box[0], box[2])
+        toppled = odometer > 0
+        reached = toppled.copy()
+        reached[1:, :] |= toppled[:-1, :]
+        reached[:-1, :] |= toppled[1:, :]
+        reached[:, 1:] |= toppled[:, :-1]
+        reached[:, :-1] |= toppled[:, 1:]
+        return int(odometer.sum()), reached, box[0], box[2]
+
+    def stabilize(self):
+        """Relax every allocated tile, e.g. after add_sand."""
+        topples, _ = self._relax(np.arange(self.tiles))
+        self._reached[:] = False
+        return topples
+
+    def mass(self):
+        """Return the total mass of the pile."""
+        return int(self._heights[:self.tiles].sum())
+
+    def bounds(self):
+        """
+        The occupied region as (xmin, xmax, ymin, ymax), inclusive, or None
+        if the pile is empty.
+        """
+        heights = self._heights[:self.tiles]
+        tiles, x, y = np.nonzero(heights)
+        if len(tiles) == 0:
+            return None
+        x = x + self._coords[tiles, 0] * self.tile
+        y = y + self._coords[tiles, 1] * self.tile
+        return int(x.min()), int(x.max()), int(y.min()), int(y.max())
+
+    def _overlaps(self, xmin, xmax, ymin, ymax):
+        """
+        Yield the tile coordinates of every tile overlapping the region
+        (inclusive bounds), with the overlap as slices of the region and of
+        the tile.
+        """
+        size = self.tile
+        for tx in range(xmin // size, xmax // size + 1):
+            for ty in range(ymin // size, ymax // size + 1):
+                x0, y0 = max(tx * size, xmin), max(ty * size, ymin)
+                x1, y1 = min((tx + 1) * size, xmax + 1), min((ty + 1) * size, ymax + 1)
+                yield (tx, ty), \
+                    (slice(x0 - xmin, x1 - xmin), slice(y0 - ymin, y1 - ymin)), \
+                    (slice(x0 - tx * size, x1 - tx * size), slice(y0 - ty * size, y1 - ty * size))
+
+    def _read(self, xmin, xmax, ymin, ymax):
+        """The heights of a region (inclusive bounds) as a dense array."""
+        grid = np.zeros((xmax - xmin + 1, ymax - ymin + 1), dtype=np.int64)
+        for coords, region, cells in self._overlaps(xmin, xmax, ymin, ymax):
+            index = self._index.get(coords)
+            if index is not None:
+                grid[region] = self._heights[index][cells]
+        return grid
+
+    def _write(self, grid, xmin, ymin):
+        """Store a dense array of heights whose [0, 0] entry is (xmin, ymin),
+        allocating the tiles where it holds sand."""
+        bounds = (xmin, xmin + grid.shape[0] - 1, ymin, ymin + grid.shape[1] - 1)
+        for coords, region, cells in self._overlaps(*bounds):
+            index = self._index.get(coords)
+            if index is None and grid[region].any():
+                index = self._allocate(coords)
+            if index is not None:
+                self._heights[index][cells] = grid[region]
+
+    def grid(self):
+        """
+        The heights of the occupied region as a dense array; its [0, 0]
+        entry is the site (xmin, ymin) of bounds().
+        """
+        bounds = self.bounds()
+        if bounds is None:
+            return np.zeros((0, 0), dtype=np.int64)
+        return self._read(*bounds)
+
+    def graph_grid(self):
+        """Render the occupied region as a PNG image, as SandPile.graph_grid."""
+        from matplotlib import pyplot
+        fig, ax = pyplot.subplots(constrained_layout=True)
+        psm = ax.pcolormesh(self.grid(), cmap='inferno', vmin=0, vmax=self.threshold - 1)
+        fig.colorbar(psm, ax=ax)
+
+        bytes_image = io.BytesIO()
+        fig.savefig(bytes_image, format='png')
+        bytes_image.seek(0)
+        pyplot.close(fig)
+
+        return bytes_image
@@ -17,33 +17,38 @@ import io
 from sandpile import SandPile
 from cylindrical import CylindricalSandPile
 from hourglass import HourGlassSandPile
+from infinite import InfiniteSandPile
+from statepool import StatePool
+
+# Critical states to start from; fill it ahead of time with statepool.py
+POOL = StatePool()
 
 
 def wrapper(i):
     if i == 0:
-        pile = SandPile(20, 20, random=True)
+        pile = POOL.checkout(SandPile, 20, 20)
         return simulate_pile(pile, 100000, "results/s20x20/", no_mass=False)
     if i == 1:
-        pile = CylindricalSandPile(20, 20, random=True)
+        pile = POOL.checkout(CylindricalSandPile, 20, 20)
         return simulate_pile(pile, 100000, "results/c20x20/", no_mass=False)
     if i == 2:
-        pile = HourGlassSandPile(20, 20, random=True)
+        pile = POOL.checkout(HourGlassSandPile, 20, 20)
         return simulate_pile(pile, 100000, "results/hg20x20/", no_mass=False)
     if i == 3:
-        pile = SandPile(50, 50, random=True)
+        pile = POOL.checkout(SandPile, 50, 50)
         return simulate_pile(pile, 100000, "results/s50x50/", no_mass=False)
     if i == 4:
-        pile = CylindricalSandPile(50, 50, random=True)
+        pile = POOL.checkout(CylindricalSandPile, 50, 50)
         return simulate_pile(pile, 100000, "results/c50x50/", no_mass=False)
     """
     Uncomment these lines if you want: they take much longer to run
     than the others
 
     if i == 5:
-        pile = HourGlassSandPile(50, 50, random=True)
+        pile = POOL.checkout(HourGlassSandPile, 50, 50)
         return simulate_pile(pile, 100000, "results/hg50x50/", no_mass=False)
     if i == 6:
-        pile = SandPile(100, 100, random=True)
+        pile = POOL.checkout(SandPile, 100, 100)
         return simulate_pile(pile, 100000, "results/s100x100/", no_mass=False)
     """
 
@@ -66,18 +71,43 @@ def main():
 
 
 def main_bytes_image(iterations=1000, width=100, height=100):
-    pile = SandPile(width, height, random=False)
-    site_x = round(width / 2)
-    site_y = round(height / 2)
-    pile.simulate(iterations, site=(site_x, site_y))
-    return pile.graph_grid()
+    return central_pile(iterations, width, height).graph_grid()
 
 def main_grid(iterations=1000, width=100, height=100):
+    return grid_list(central_pile(iterations, width, height))
+
+
+def central_pile(iterations=1000, width=100, height=100):
+    """
+    The pile after dropping `iterations` grains one at a time on the centre
+    of an empty width x height grid, or on the infinite lattice if either
+    is None.
+    """
+    if width is None or height is None:
+        return infinite_pile(iterations)
     pile = SandPile(width, height, random=False)
     site_x = round(width / 2)
     site_y = round(height / 2)
     pile.simulate(iterations, site=(site_x, site_y))
-    return np.ndarray.tolist(pile.grid)
+    return pile
+
+
+def grid_list(pile):
+    """The grid of a pile (cropped to the sand if infinite) as nested lists."""
+    grid = pile.grid() if callable(pile.grid) else pile.grid
+    return np.ndarray.tolist(grid)
+
+
+def infinite_pile(iterations):
+    """
+    The pile grown by dropping `iterations` grains on one site of an
+    unbounded lattice; its grid is cropped to the sand (see infinite.py).
+    """
+    pile = InfiniteSandPile()
+    # By the abelian property, dropping the grains all at once leaves the
+    # same grid as dropping them one at a time
+    pile.drop_sand(iterations)
+    return pile
 
 
 if __name__ == "__main__":
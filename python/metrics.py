@@ -0,0 +1,215 @@
+#################################################
+#   Author: Caleb Smith
+#   Student ID: 1027644
+#   November 9,2020
+#################################################
+"""
+Operational metrics in the Prometheus text format.
+
+Counters, gauges and histograms, optionally split by labels, kept in a
+Registry which renders all of them as the text a Prometheus server scrapes
+(see https://prometheus.io/docs/instrumenting/exposition_formats/). Each
+metric is safe to update from several threads. Gauges can also be computed
+when the registry is rendered, from a function returning the value of every
+label combination, for quantities such as the states waiting in a pool.
+
+Each process keeps its own metrics: with several server processes, every
+one of them is scraped on its own and Prometheus adds them up.
+
+Example usage:
+    registry = Registry()
+    latency = registry.histogram('simulation_seconds', 'Time per simulation',
+                                 labels=('topology',))
+    latency.observe(0.25, topology='open')
+    registry.render()
+"""
+import math
+import threading
+
+# Default buckets: seconds, from a few milliseconds to a minute
+SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Powers of 4 from 256 bytes to 64 MiB
+BYTES = tuple(4 ** power for power in range(4, 14))
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    """A label value quoted as the text format requires."""
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if value == int(value) and abs(value) < 2 ** 53:
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    """A metric with a name, help text and label names."""
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError('{} takes the labels {}, got {}'.format(
+                self.name, ', '.join(self.labels) or 'none', ', '.join(sorted(labels)) or 'none'))
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def _samples(self):
+        """(suffix, label values, extra labels, value) of every sample."""
+        with self._lock:
+            return [('', key, (), value) for key, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help.replace('\n', ' ')),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        for suffix, key, extra, value in self._samples():
+            lines.append('{}{}{} {}'.format(self.name, suffix,
+                                            _format_labels(self.labels, key, extra),
+                                            _format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    """A total which only goes up, such as requests served."""
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if amount < 0:
+            raise ValueError('Counters cannot decrease')
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    """A value which goes up and down, such as requests in progress."""
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), function=None):
+        """
+        Parameters
+        ==========
+        name, help: name and description of the metric
+        labels: names of the labels the values are split by
+        function: optional function called at every render, returning a
+            dict mapping tuples of label values to the current values
+        """
+        super().__init__(name, help, labels)
+        self.function = function
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def total(self):
+        """The sum of the values of every label combination."""
+        with self._lock:
+            return sum(self._values.values())
+
+    def _samples(self):
+        if self.function is None:
+            return super()._samples()
+        values = self.function()
+        return [('', tuple(str(label) for label in key), (), value)
+                for key, value in sorted(values.items())]
+
+
+class Histogram(_Metric):
+    """
+    Observations counted in cumulative buckets, with their count and sum,
+    such as request latencies.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=SECONDS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def count(self, **labels):
+        with self._lock:
+            counts, _ = self._values.get(self._key(labels), ([0], 0))
+            return sum(counts)
+
+    def _samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    samples.append(('_bucket', key, (('le', _format_value(bound)),), cumulative))
+                samples.append(('_count', key, (), cumulative))
+                samples.append(('_sum', key, (), total))
+        return samples
+
+
+class Registry:
+    """The metrics of a process, rendered together."""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError('A metric called {} already exists'.format(metric.name))
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=(), function=None):
+        return self.register(Gauge(name, help, labels, function))
+
+    def histogram(self, name, help, labels=(), buckets=SECONDS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def __getitem__(self, name):
+        return self._metrics[name]
+
+    def render(self):
+        """Every metric in the Prometheus text format."""
+        return ''.join(metric.render() + '\n' for metric in self._metrics.values())
@@ -0,0 +1,178 @@
+#################################################
+#   Author: Caleb Smith
+#   Student ID: 1027644
+#   November 9,2020
+#################################################
+"""
+Optional instrumentation for SandPile runs.
+
+A Profiler is attached to a single pile and replaces the hot methods of that
+instance with counting and timing wrappers. The class itself is never touched,
+so piles without a profiler run exactly the same code as before.
+
+Example usage:
+    pile = SandPile(50, 50, random=True)
+    profiler = Profiler(progress_interval=10).attach(pile)
+    pile.simulate(100000)
+    print(profiler.report())
+"""
+import json
+import sys
+import time
+from collections import deque
+
+# Methods timed by the profiler and the phase each is reported under.
+# Timings are inclusive: 'topple' contains the 'neighbors' time it triggers and
+# 'drop' contains everything that happens while an avalanche runs
+PHASES = {
+    'drop_sand': 'drop',
+    '_drop_site': 'drop_site',
+    'topple': 'topple',
+    'get_neighbors': 'neighbors',
+    'mass': 'mass',
+    '_record': 'history',
+    'graph': 'analysis',
+    'get_statistics': 'analysis',
+    'calculate_correlations': 'analysis',
+    'calculate_average_mass': 'analysis',
+}
+
+COUNTERS = ('drops', 'topples', 'neighbor_lookups', 'queue_pushes',
+            'queue_pops', 'mass_calls')
+
+
+def _counting_queue(counters):
+    """Return a deque subclass which counts pushes and pops into `counters`."""
+    class CountingQueue(deque):
+        def __init__(self, items=()):
+            deque.__init__(self, items)
+            counters['queue_pushes'] += len(self)
+
+        def append(self, item):
+            counters['queue_pushes'] += 1
+            deque.append(self, item)
+
+        def extend(self, items):
+            items = list(items)
+            counters['queue_pushes'] += len(items)
+            deque.extend(self, items)
+
+        def popleft(self):
+            counters['queue_pops'] += 1
+            return deque.popleft(self)
+
+    return CountingQueue
+
+
+class Profiler:
+    """
+    Counts topples, neighbor lookups, queue operations and per-phase wall
+    time of a SandPile, and optionally reports progress of long simulations.
+    """
+
+    def __init__(self, progress_interval=None, stream=None):
+        """
+        Parameters
+        ==========
+        progress_interval: float or None, seconds between progress reports
+            written while `simulate` runs; None disables reporting
+        stream: file object progress reports are written to (default stderr)
+        """
+        self.progress_interval = progress_interval
+        self.stream = stream if stream is not None else sys.stderr
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.phases = {}
+        self.simulate_seconds = 0.0
+        self._pile = None
+        self._progress = None
+
+    def attach(self, pile):
+        """Instrument `pile` and return the profiler."""
+        if self._pile is not None:
+            raise RuntimeError('Profiler is already attached to a pile')
+        self._pile = pile
+        pile.profiler = self
+        pile._queue_factory = _counting_queue(self.counters)
+        for name, phase in PHASES.items():
+            setattr(pile, name, self._timed(getattr(pile, name), name, phase))
+        pile.simulate = self._simulate(pile.simulate)
+        return self
+
+    def detach(self):
+        """Restore the pile's original methods."""
+        pile = self._pile
+        for name in list(PHASES) + ['simulate', '_queue_factory']:
+            pile.__dict__.pop(name, None)
+        pile.profiler = None
+        self._pile = None
+
+    def _timed(self, method, name, phase):
+        counters = self.counters
+        stats = self.phases.setdefault(phase, {'calls': 0, 'seconds': 0.0})
+        clock = time.perf_counter
+
+        def wrapper(*args, **kwargs):
+            start = clock()
+            result = method(*args, **kwargs)
+            stats['seconds'] += clock() - start
+            stats['calls'] += 1
+            if name == 'topple':
+                counters['topples'] += len(result) > 0
+            elif name == 'get_neighbors':
+                counters['neighbor_lookups'] += 1
+            elif name == 'mass':
+                counters['mass_calls'] += 1
+            elif name == '_drop_site':
+                counters['drops'] += 1
+                if self._progress is not None:
+                    self._report_progress()
+            return result
+        return wrapper
+
+    def _simulate(self, method):
+        def wrapper(steps, *args, **kwargs):
+            start = time.perf_counter()
+            if self.progress_interval is not None:
+                self._progress = {'start': start, 'steps': steps,
+                                  'drops': self.counters['drops'],
+                                  'topples': self.counters['topples'],
+                                  'next': start + self.progress_interval}
+            try:
+                return method(steps, *args, **kwargs)
+            finally:
+                self._progress = None
+                self.simulate_seconds += time.perf_counter() - start
+        return wrapper
+
+    def _report_progress(self):
+        now = time.perf_counter()
+        progress = self._progress
+        if now < progress['next']:
+            return
+        progress['next'] = now + self.progress_interval
+        elapsed = max(now - progress['start'], 1e-9)
+        drops = self.counters['drops'] - progress['drops']
+        topples = self.counters['topples'] - progress['topples']
+        self.stream.write(
+            'simulate: {}/{} drops ({:.1%}), {:.1f} drops/s, {:.1f} topples/s\n'.format(
+                drops, progress['steps'], drops / max(progress['steps'], 1),
+                drops / elapsed, topples / elapsed))
+        self.stream.flush()
+
+    def report(self):
+        """Return the collected counts and timings as a JSON-serializable dict."""
+        seconds = self.simulate_seconds
+        return {
+            'counters': dict(self.counters),
+            'phases': {phase: dict(stats) for phase, stats in self.phases.items()},
+            'simulate_seconds': seconds,
+            'throughput': {
+                'drops_per_sec': self.counters['drops'] / seconds if seconds else None,
+                'topples_per_sec': self.counters['topples'] / seconds if seconds else None,
+            },
+        }
+
+    def write(self, file_name):
+        """Save the report as JSON to `file_name`."""
+        with open(file_name, 'w') as f:
+            json.dump(self.report(), f, indent=2)
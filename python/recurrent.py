@@ -0,0 +1,184 @@
+#################################################
+#   Author: Caleb Smith
+#   Student ID: 1027644
+#   November 9,2020
+#################################################
+"""
+Recurrent (critical) configurations of sandpiles on a graphpile.Lattice.
+
+The recurrent configurations are exactly the states the pile visits once it
+has reached the critical state, and they are all equally likely there. They
+are in bijection with the spanning trees of the graph rooted at the sink
+(Majumdar and Dhar), so a uniform recurrent configuration can be sampled by
+drawing a uniform spanning tree with Wilson's algorithm and mapping it
+through the burning bijection. This skips the long pre-critical warm-up.
+
+The lattice is assumed to be undirected (a symmetric Laplacian), which holds
+for every builder in graphpile. Sink vertices of the lattice belong to the
+sink and always get height 0.
+
+Example usage:
+    heights = sample_recurrent(hypercubic((100, 100)), seed=1)
+    is_recurrent(hypercubic((100, 100)), heights)
+"""
+import numpy as np
+
+SINK = -1
+
+
+def _edges(lattice):
+    """
+    Expand the lattice into a multigraph edge list: every vertex v owns the
+    edges ptr[v]:ptr[v+1], one per grain it sends when toppling, in CSR order
+    followed by its edges to the sink. Targets are SINK for the sink.
+    """
+    n = lattice.n
+    rows = np.repeat(np.arange(n), np.diff(lattice.indptr))
+    targets = np.where(lattice.sinks[lattice.indices], SINK, lattice.indices)
+    # One entry per grain, then the grains which fall straight into the sink
+    sources = np.concatenate([np.repeat(rows, lattice.weights),
+                              np.repeat(np.arange(n), lattice.losses - lattice.degrees())])
+    targets = np.concatenate([np.repeat(targets, lattice.weights),
+                              np.full(len(sources) - lattice.weights.sum(), SINK)])
+    order = np.argsort(sources, kind='stable')
+    sources, targets = sources[order], targets[order]
+    ptr = np.concatenate([[0], np.cumsum(np.bincount(sources, minlength=n))])
+    return ptr, sources, targets
+
+
+def burning_times(lattice, heights):
+    """
+    Run Dhar's burning algorithm on `heights` and return the step at which
+    each vertex burns (1 for the first step), 0 for sink vertices and -1 for
+    vertices which never burn.
+
+    A vertex burns once it holds at least as many grains as it has edges to
+    unburnt vertices; the sink is burnt from the start.
+    """
+    ptr, sources, targets = _edges(lattice)
+    heights = np.asarray(heights).ravel()
+    real = targets != SINK
+    # Edges from each vertex to vertices which are not burnt yet
+    unburnt_edges = np.bincount(sources[real], minlength=lattice.n)
+    times = np.full(lattice.n, -1, dtype=np.int64)
+    times[lattice.sinks] = 0
+
+    candidates = np.flatnonzero(~lattice.sinks)
+    step = 0
+    while len(candidates) > 0:
+        step += 1
+        burning = candidates[(times[candidates] < 0) &
+                             (heights[candidates] >= unburnt_edges[candidates])]
+        if len(burning) == 0:
+            break
+        times[burning] = step
+        # Edges are symmetric, so the neighbors of the burning vertices each
+        # lose one unburnt edge per edge they share with them
+        starts, lengths = ptr[burning], ptr[burning + 1] - ptr[burning]
+        edges = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + \
+            np.arange(lengths.sum())
+        neighbors = targets[edges]
+        neighbors = neighbors[neighbors != SINK]
+        unburnt_edges -= np.bincount(neighbors, minlength=lattice.n)
+        candidates = np.unique(neighbors)
+    return times
+
+
+def is_recurrent(lattice, heights):
+    """Whether `heights` is a recurrent configuration of `lattice`."""
+    times = burning_times(lattice, heights)
+    return bool((times[~lattice.sinks] > 0).all())
+
+
+def uniform_spanning_tree(lattice, rng):
+    """
+    Draw a uniform spanning tree of the lattice's multigraph, rooted at the
+    sink, with Wilson's algorithm. Returns the position (within each vertex's
+    edge list, see _edges) of the edge from every vertex to its parent; sink
+    vertices get -1.
+    """
+    ptr, _, targets = _edges(lattice)
+    n = lattice.n
+    # Work with plain lists: the loop erased random walks are inherently serial
+    ptr_list = ptr.tolist()
+    degree = np.diff(ptr).tolist()
+    target_list = np.where(targets == SINK, n, targets).tolist()
+    in_tree = lattice.sinks.tolist() + [True]
+    next_edge = [-1] * n
+
+    randoms = rng.random(4096).tolist()
+    used = 0
+    for start in range(n):
+        u = start
+        while not in_tree[u]:
+            if used == len(randoms):
+                randoms = rng.random(4096).tolist()
+                used = 0
+            edge = ptr_list[u] + int(randoms[used] * degree[u])
+            used += 1
+            next_edge[u] = edge
+            u = target_list[edge]
+        # Retrace the walk; loops have been erased by overwriting next_edge
+        u = start
+        while not in_tree[u]:
+            in_tree[u] = True
+            u = target_list[next_edge[u]]
+
+    parent_edge = np.array(next_edge, dtype=np.int64)
+    positions = parent_edge - ptr[:-1]
+    positions[lattice.sinks] = -1
+    return positions
+
+
+def tree_to_recurrent(lattice, parent_positions):
+    """
+    Map a spanning tree rooted at the sink (as returned by
+    uniform_spanning_tree) to its recurrent configuration, inverting the
+    burning bijection: a vertex at depth t in the tree burns at step t, and
+    which of its neighbors burnt at step t-1 is its parent fixes its height.
+    """
+    ptr, sources, targets = _edges(lattice)
+    n = lattice.n
+    real = ~lattice.sinks
+    parent = np.full(n, SINK, dtype=np.int64)
+    parent[real] = targets[ptr[:-1][real] + parent_positions[real]]
+
+    # Depth of every vertex by pointer jumping; the sink has depth 0
+    depth = np.where(real, 1, 0)
+    ancestor = parent.copy()
+    while True:
+        climbing = ancestor != SINK
+        if not climbing.any():
+            break
+        depth[climbing] += depth[ancestor[climbing]]
+        ancestor[climbing] = ancestor[ancestor[climbing]]
+
+    target_depth = np.where(targets == SINK, 0, depth[np.maximum(targets, 0)])
+    own_depth = depth[sources]
+    position = np.arange(len(sources)) - ptr[sources]
+    # Edges to vertices which were still unburnt when the vertex burnt
+    later = (targets != SINK) & (target_depth >= own_depth)
+    # Edges to vertices burnt one step earlier and listed before the parent
+    earlier = (target_depth == own_depth - 1) & (position < parent_positions[sources])
+    heights = np.bincount(sources, weights=later + earlier, minlength=n).astype(np.int64)
+    heights[lattice.sinks] = 0
+    return heights
+
+
+def sample_recurrent(lattice, seed=None):
+    """
+    Return a uniformly distributed recurrent configuration of `lattice`.
+
+    Parameters
+    ==========
+    lattice: graphpile.Lattice with a symmetric Laplacian
+    seed: int, numpy Generator or None; if None, the seed is drawn from
+        numpy's global random state so np.random.seed keeps runs reproducible
+    """
+    if isinstance(seed, np.random.Generator):
+        rng = seed
+    else:
+        if seed is None:
+            seed = np.random.randint(0, 2**31 - 1)
+        rng = np.random.default_rng(seed)
+    return tree_to_recurrent(lattice, uniform_spanning_tree(lattice, rng))
@@ -4,17 +4,40 @@
 #   November 9,2020
 #################################################
 import numpy as np
-from scipy.stats import spearmanr    # For calculating correlations
-from matplotlib import pyplot       # For plotting
-import sys                          # For printing to files
 from pathlib import Path            # Create output directory
 import io
+from collections import deque       # FIFO of sites waiting to topple
+
+
+def avalanche_dtype(duration=False, waves=False):
+    """
+    Return the NumPy dtype of the avalanche records yielded by
+    `SandPile.iter_avalanches`: the drop site (x, y), the topples, area and
+    length of the avalanche, the grains lost off the grid, the mass left
+    after it, if `duration` is set the number of parallel sweeps and, if
+    `waves` is set, the number of waves and the size of the last one.
+    """
+    fields = [('x', np.int64), ('y', np.int64), ('topples', np.int64),
+              ('area', np.int64), ('length', np.int64), ('loss', np.int64),
+              ('mass', np.int64)]
+    if duration:
+        fields.append(('duration', np.int64))
+    if waves:
+        fields.extend([('waves', np.int64), ('last_wave', np.int64)])
+    return np.dtype(fields)
 
 
 class SandPile:
     """
     SandPile class
     """
+    # Name used to key results, caches and command line options by boundary condition
+    topology = 'open'
+    # Whether the width and height axes wrap around, used by the bulk engine
+    periodic = (False, False)
+    # Container used for the queue of sites waiting to topple; the profiler
+    # swaps in a counting version on the instances it is attached to
+    _queue_factory = deque
 
     def __init__(self, width, height, threshold=4, random=False):
         """Initialize a sandpile with the specified width and height."""
@@ -40,6 +63,18 @@ class SandPile:
         self.topples_history = []   # Number of topples to reach stability in avalanche
         self.area_history = []      # Number of unique sites reached in avalanche
         self.length_history = []    # Maximum radius of avalanche
+        # Kept only once `track` is called, from the avalanche `tracked_from` on
+        self.duration_history = None    # Parallel sweeps of each avalanche
+        self.waves_history = None       # Number of waves of each avalanche
+        self.wave_size_history = None   # Topples of every wave, one avalanche after another
+        self.tracked_from = None
+        self.profiler = None        # Set by profiling.Profiler.attach
+        self.burn_in = None         # End of the transient, see detect_stationarity
+        self.origin = None          # Generation metadata, see statepool.StatePool
+        self.rng = None             # RandomState of the drop sites; None for np.random
+        # Objects with a record(pile, start, odometer) method which are given
+        # the odometer (topples per site) of every avalanche, see record_footprints
+        self.recorders = []
 
     def drop_sand(self, n=1, site=None):
         """Add `n` grains of sand to the grid.  Each grains of sand is added to
@@ -55,18 +90,22 @@ class SandPile:
           The site on which the grain(s) of sand should be dropped.  If `None`,
           a random site is used.
         """
-        place = site
-        if site == None:
-            place = (np.random.randint(0, self.width),
-                     np.random.randint(0, self.height))
-        else:
-            place = tuple(site)
-
+        place = self._drop_site(site)
         self.grid[place] += n
 
         # Call avalanche to stabilize the configuration and updated as needed
         self.avalanche(place)
 
+    def _drop_site(self, site=None):
+        """
+        Return `site` as a tuple, or a random site drawn from `rng` (or
+        numpy's global random state) if `site` is None.
+        """
+        if site is None:
+            random = np.random if self.rng is None else self.rng
+            return (random.randint(0, self.width), random.randint(0, self.height))
+        return tuple(site)
+
     def mass(self):
         """Return the total mass of the grid."""
         return np.sum(self.grid)
@@ -96,6 +135,20 @@ class SandPile:
 
         return ret
 
+    def is_sink(self, site):
+        """
+        Returns true if `site` is part of the sink, i.e. grains reaching it
+        leave the system. The open boundary has no such sites inside the grid.
+        """
+        return False
+
+    def sink_mask(self):
+        """
+        Returns a boolean grid which is true on the sites for which `is_sink`
+        is true.
+        """
+        return np.zeros((self.width, self.height), dtype=bool)
+
     def topple(self, site):
         """
         Topples a site, if the number of grains is greater than the threshold
@@ -117,7 +170,9 @@ class SandPile:
         for neighbor in neighbors:
             self.grid[tuple(neighbor)] += 1
 
-        self.grid[tuple(site)] -= 4
+        # One grain went to each of the 2*dimension directions, whether or not
+        # the neighbor exists; grains sent off the grid are lost
+        self.grid[tuple(site)] -= 2 * self.dimension
         return neighbors
 
     def avalanche(self, start):
@@ -129,44 +184,257 @@ class SandPile:
         ==========
         start: tuple or list of coordinates of the site where the avalanche began
         """
-        buffer = self.topple(start)
+        duration = self.duration_history is not None
+        waves = self.waves_history is not None
+        relax = self._relaxer(duration, waves)
+        if len(self.recorders) == 0:
+            stats = relax(start)
+        else:
+            odometer = {}
+            stats = relax(start, odometer)
+            for recorder in self.recorders:
+                recorder.record(self, start, odometer)
 
-        # If no topples, update history and return
-        if len(buffer) == 0:
-            self.mass_history.append(self.mass())
-            self.area_history.append(0)
-            self.topples_history.append(0)
-            self.length_history.append(0)
-            return
+        # Update statistics
+        self._record(self.mass(), *stats[:3], duration=stats[3] if duration else None,
+                     waves=stats[3] if waves else None)
+
+    def _relaxer(self, duration=False, waves=False):
+        """
+        The relaxation method giving the avalanche statistics asked for:
+        `_relax`, `_relax_parallel` for the duration or `_relax_waves` for
+        the waves. The duration and the waves need different toppling
+        orders, so they cannot both be measured in one relaxation.
+        """
+        if duration and waves:
+            raise ValueError('The duration and the waves of an avalanche need different '
+                             'toppling orders; measure them in separate runs')
+        if duration:
+            return self._relax_parallel
+        if waves:
+            return self._relax_waves
+        return self._relax
+
+    def _topple(self, site):
+        """
+        Topple `site` as `topple` does, and return whether it toppled along
+        with the neighbors it sent grains to. A site without neighbors (the
+        only one of a 1 x 1 grid) sends every grain off the grid, so the
+        list `topple` returns is empty whether or not it toppled.
+        """
+        unstable = self.grid[tuple(site)] >= self.threshold
+        neighbors = self.topple(site)
+        return len(neighbors) > 0 or (unstable and not self.is_sink(site)), neighbors
+
+    def _relax(self, start, odometer=None):
+        """
+        Topple sites in FIFO order, starting from `start`, until the grid is
+        stable again. Returns the number of topples, the number of unique sites
+        reached and the maximum distance from `start` reached.
+
+        Parameters
+        ==========
+        start: tuple or list of coordinates of the site where the avalanche began
+        odometer: dict or None; if given, the number of times each site
+            toppled is added to it, keyed by `get_1D_coord`
+        """
+        toppled, neighbors = self._topple(start)
+
+        # If no topples, there is nothing to record
+        if not toppled:
+            return 0, 0, 0
+        buffer = self._queue_factory(neighbors)
+
+        if odometer is not None:
+            coord = self.get_1D_coord(start)
+            odometer[coord] = odometer.get(coord, 0) + 1
+        # Several grains dropped at once may leave the start unstable
+        if self.grid[tuple(start)] >= self.threshold:
+            buffer.append(start)
 
         # If we had a topple, loop through neighbors until it dies
         sites_affected = set([self.get_1D_coord(start)])
         distance = 0
         topples = 1
         while len(buffer) > 0:
-            current = buffer[0]
-            current_neighbors = self.topple(current)
+            current = buffer.popleft()
+            toppled, current_neighbors = self._topple(current)
             sites_affected.add(self.get_1D_coord(current))
             distance = max(distance, self.dist(start, current))
 
             # If there was a topple, increment topples
             # and append the affected sites to buffer
-            if len(current_neighbors) > 0:
+            if toppled:
                 buffer.extend(current_neighbors)
                 topples += 1
+                if odometer is not None:
+                    coord = self.get_1D_coord(current)
+                    odometer[coord] = odometer.get(coord, 0) + 1
 
             # Need to make sure that the current site is actually stable
             if self.grid[tuple(current)] >= self.threshold:
                 buffer.append(current)
 
-            # Remove the first element
-            buffer = buffer[1:]
+        return topples, len(sites_affected), distance
 
-        # Update statistics
-        self.mass_history.append(self.mass())
+    def _relax_parallel(self, start, odometer=None):
+        """
+        Relax the grid from `start` using synchronous sweeps: in every sweep,
+        each site which was unstable at the start of the sweep topples once.
+        By the abelian property the final grid, topples, area and length are the
+        same as for `_relax`; in addition this returns the duration of the
+        avalanche, i.e. the number of sweeps in which something toppled.
+
+        Parameters
+        ==========
+        start: tuple or list of coordinates of the site where the avalanche began
+        odometer: dict or None, as for `_relax`
+        """
+        start = tuple(start)
+        frontier = set([start])
+        reached = set([start])
+        topples = 0
+        duration = 0
+        while True:
+            # Decide who topples before moving any sand so that grains
+            # arriving during this sweep only count in the next one
+            unstable = [site for site in frontier
+                        if self.grid[site] >= self.threshold]
+            if len(unstable) == 0:
+                break
+
+            frontier = set()
+            toppled = False
+            for site in unstable:
+                toppled_site, neighbors = self._topple(site)
+                if toppled_site:
+                    toppled = True
+                    topples += 1
+                    if odometer is not None:
+                        coord = self.get_1D_coord(site)
+                        odometer[coord] = odometer.get(coord, 0) + 1
+                    for neighbor in neighbors:
+                        frontier.add(tuple(neighbor))
+                    frontier.add(site)  # May need to topple again
+            reached.update(frontier)
+            duration += toppled
+
+        # Visiting a stable site is a no-op, except for boundary conditions
+        # (like the hourglass hole) which clear the sites they visit
+        for site in reached:
+            self.topple(site)
+
+        if topples == 0:
+            return 0, 0, 0, 0
+        length = max(self.dist(start, site) for site in reached)
+        return topples, len(reached), length, duration
+
+    def _relax_waves(self, start, odometer=None):
+        """
+        Relax the grid from `start` wave by wave: the start topples once, and
+        every other site then topples in FIFO order while the start is held
+        back, even if it becomes unstable again. That is one wave; the next
+        begins if the start is still unstable. The final grid, topples, area
+        and length are the same as for `_relax`; in addition this returns the
+        list of the wave sizes (topples per wave), whose length is the number
+        of times the start toppled.
+
+        Parameters
+        ==========
+        start: tuple or list of coordinates of the site where the avalanche began
+        odometer: dict or None, as for `_relax`
+        """
+        start = tuple(start)
+        coord = self.get_1D_coord(start)
+        sizes = []
+        sites_affected = set([coord])
+        distance = 0
+        while True:
+            toppled, neighbors = self._topple(start)
+            if not toppled:
+                break
+            buffer = self._queue_factory(neighbors)
+            if odometer is not None:
+                odometer[coord] = odometer.get(coord, 0) + 1
+            size = 1
+            while len(buffer) > 0:
+                current = buffer.popleft()
+                if tuple(current) == start:
+                    continue
+                toppled, current_neighbors = self._topple(current)
+                sites_affected.add(self.get_1D_coord(current))
+                distance = max(distance, self.dist(start, current))
+                if toppled:
+                    buffer.extend(current_neighbors)
+                    size += 1
+                    if odometer is not None:
+                        site = self.get_1D_coord(current)
+                        odometer[site] = odometer.get(site, 0) + 1
+
+                # Only thresholds above 4 can leave a site unstable after a topple
+                if self.grid[tuple(current)] >= self.threshold:
+                    buffer.append(current)
+            sizes.append(size)
+
+        if len(sizes) == 0:
+            return 0, 0, 0, sizes
+        return sum(sizes), len(sites_affected), distance, sizes
+
+    def _record(self, mass, topples, area, length, duration=None, waves=None):
+        """
+        Append the statistics of one avalanche to the history lists, and its
+        duration and wave sizes to those kept by `track`.
+        """
+        self.mass_history.append(mass)
         self.topples_history.append(topples)
-        self.area_history.append(len(sites_affected))
-        self.length_history.append(distance)
+        self.area_history.append(area)
+        self.length_history.append(length)
+        if duration is not None:
+            self.duration_history.append(duration)
+        if waves is not None:
+            self.waves_history.append(len(waves))
+            self.wave_size_history.extend(waves)
+
+    def track(self, duration=False, waves=False):
+        """
+        Start keeping, for every following avalanche, its duration (the
+        number of synchronous sweeps in which something toppled, see
+        `_relax_parallel`) in `duration_history` or its waves (see
+        `_relax_waves`): their number in `waves_history` and their sizes, in
+        order, in `wave_size_history`. Entry i of these lists is the
+        avalanche `tracked_from + i` of the other history lists.
+
+        Parameters
+        ==========
+        duration: bool, whether to keep the duration
+        waves: bool, whether to keep the waves; not together with duration
+        """
+        self._relaxer(duration, waves)
+        if self.tracked_from is not None:
+            raise RuntimeError('The pile is already tracking avalanches')
+        self.tracked_from = len(self.topples_history)
+        if duration:
+            self.duration_history = []
+        if waves:
+            self.waves_history = []
+            self.wave_size_history = []
+
+    def tracked_history(self, name, start=None):
+        """
+        The values of a history kept by `track` ('duration', 'waves' or
+        'wave_size') for the avalanches from `start` (by default the start
+        index) on, as an array. Avalanches before `tracked_from` are left out.
+        """
+        history = getattr(self, name + '_history')
+        if history is None:
+            raise ValueError('The {} of the avalanches is not tracked; call track '
+                             'first'.format(name.replace('_', ' ')))
+        start = self.get_start_index() if start is None else start
+        skip = max(start - self.tracked_from, 0)
+        if name == 'wave_size':
+            # The sizes of the waves of the skipped avalanches come first
+            skip = int(np.sum(self.waves_history[:skip], dtype=np.int64))
+        return np.asarray(history[skip:], dtype=np.int64)
 
     def dist(self, x, y):
         """
@@ -180,31 +448,188 @@ class SandPile:
         # Make distance the manhattan distance
         return abs(x[0] - y[0]) + abs(x[1]-y[1])
 
-    def simulate(self, steps, n=1, site=None):
+    def simulate(self, steps, n=1, site=None, until_stationary=False,
+                 samples=None, detector=None, writer=None):
         """
         Evolve the system by dropping sand on the lattice
 
         Parameters
         ==========
-        steps: int, number of steps to evolve
+        steps: int, number of steps to evolve; with `until_stationary`, the
+            largest number of steps allowed for the warm-up
         n: int, number of grains to drop per step
         site: tuple or list of coordinates of site to drop grains on;
             if none specified, drops are made on a random site
+        until_stationary: bool, stop as soon as the density and topples
+            series are stationary and mark `burn_in` there
+        samples: int or None, with `until_stationary`, keep going until
+            exactly this many avalanches were recorded after the burn-in
+        detector: stationarity.StationarityDetector to use; defaults to
+            `self.stationarity_detector()`
+        writer: dataset.DatasetWriter to stream the avalanches to instead
+            of appending them to the history lists, so memory stays the
+            same however long the run
         """
+        if writer is not None:
+            if until_stationary:
+                raise ValueError('writer cannot be combined with until_stationary')
+            writer.open(self)
+            # Hand the avalanches over in blocks ending where the writer's
+            # chunks end, so grid snapshots are taken at the chunk boundaries
+            while steps > 0:
+                count = min(steps, writer.space())
+                for records in self.iter_avalanches(count, n, site, chunk_size=count,
+                                                    duration=writer.duration, waves=writer.waves):
+                    writer.write(self, records)
+                steps -= count
+            return
+
+        if not until_stationary:
+            for _ in range(steps):
+                self.drop_sand(n, site)
+            return
+
+        if detector is None:
+            detector = self.stationarity_detector()
+        offset = len(self.topples_history)
+        sites = self.width * self.height
         for _ in range(steps):
             self.drop_sand(n, site)
+            if detector.update(self.mass_history[-1] / sites, self.topples_history[-1]):
+                break
+        else:
+            raise RuntimeError('The pile did not become stationary within '
+                               '{} steps'.format(steps))
+        self.burn_in = offset + detector.burn_in
+
+        if samples is not None:
+            collected = len(self.topples_history) - self.burn_in
+            for _ in range(samples - collected):
+                self.drop_sand(n, site)
+            # If the stationary windows already hold more than enough, start
+            # later; anything after the burn-in is stationary as well
+            self.burn_in = len(self.topples_history) - samples
+
+    def stationarity_detector(self, tolerance=1.0, patience=3):
+        """
+        Return a stationarity.StationarityDetector with windows of half the
+        number of sites, about the time the pile takes to exchange its mass.
+        """
+        from stationarity import StationarityDetector
+        return StationarityDetector(window=max(self.width * self.height // 2, 50),
+                                    tolerance=tolerance, patience=patience)
+
+    def detect_stationarity(self, detector=None):
+        """
+        Look for the end of the pre-critical transient in the recorded
+        history and set `burn_in` (used by get_start_index, and hence by all
+        the analysis methods) accordingly. Returns the burn-in index, or None
+        if the history never became stationary.
+        """
+        if detector is None:
+            detector = self.stationarity_detector()
+        densities = np.array(self.mass_history[1:]) / (self.width * self.height)
+        detector.update_many(densities, self.topples_history)
+        self.burn_in = detector.burn_in
+        return self.burn_in
+
+    def iter_avalanches(self, steps=None, n=1, site=None, chunk_size=1024,
+                        duration=False, waves=False, record=False):
+        """
+        Evolve the system like `simulate`, yielding the avalanches as they
+        happen instead of only storing them in the history lists.
+        Avalanches are yielded in chunks: NumPy structured arrays with the
+        fields given by `avalanche_dtype`, one row per dropped grain(s).
+
+        Parameters
+        ==========
+        steps: int, number of steps to evolve; if None, runs until the
+            consumer stops iterating
+        n: int, number of grains to drop per step
+        site: tuple or list of coordinates of site to drop grains on;
+            if none specified, drops are made on a random site
+        chunk_size: int, maximum number of avalanches per yielded chunk
+        duration: bool, whether to relax in synchronous sweeps and also
+            record the number of sweeps each avalanche lasted
+        waves: bool, whether to relax wave by wave and also record the number
+            of waves and the size of the last one
+        record: bool, whether to also append to the history lists, including
+            those kept by `track`
+        """
+        dtype = avalanche_dtype(duration, waves)
+        # Measure what the tracked histories need as well
+        track_duration = duration or (record and self.duration_history is not None)
+        track_waves = waves or (record and self.waves_history is not None)
+        relax = self._relaxer(track_duration, track_waves)
+        size = chunk_size if steps is None else max(min(chunk_size, steps), 1)
+        chunk = np.empty(size, dtype=dtype)
+        filled = 0
+        mass = self.mass()
+        step = 0
+        while steps is None or step < steps:
+            step += 1
+            place = self._drop_site(site)
+            self.grid[place] += n
+            if len(self.recorders) == 0:
+                stats = relax(place)
+            else:
+                odometer = {}
+                stats = relax(place, odometer)
+                for recorder in self.recorders:
+                    recorder.record(self, place, odometer)
+            new_mass = self.mass()
+            if record:
+                self._record(new_mass, *stats[:3],
+                             duration=stats[3] if self.duration_history is not None else None,
+                             waves=stats[3] if self.waves_history is not None else None)
+
+            extra = ()
+            if duration:
+                extra = (stats[3],)
+            elif waves:
+                extra = (len(stats[3]), stats[3][-1] if stats[3] else 0)
+            chunk[filled] = place + (stats[0], stats[1], stats[2],
+                                     mass + n - new_mass, new_mass) + extra
+            mass = new_mass
+            filled += 1
+            if filled == size:
+                yield chunk
+                chunk = np.empty(size, dtype=dtype)
+                filled = 0
+
+        if filled > 0:
+            yield chunk[:filled]
 
     # In a refactor, this function uses logic very similar to that
     # of the avalanche function; this could likely be split out into
     # a separate function and re-used in both locations
-    def stabilize(self):
+    def stabilize(self, engine='queue'):
         """
         Evolve from the current grid (possibly unstable) until all sites are less than the threshold.
         For use in ensemble simulations where the grid is initialized to have a value higher than
         the threshold and allow to relax to a stable configuration.
+
+        Parameters
+        ==========
+        engine: 'queue' to topple one site at a time, 'bulk' to topple the
+            whole grid in vectorized sweeps (see bulk.py), which is much
+            faster when many sites are unstable, or 'bitslice' to run the
+            last sweeps of the bulk engine on packed bit-planes (see
+            bitslice.py), faster still on large grids
         """
+        if engine in ('bulk', 'bitslice'):
+            if engine == 'bulk':
+                from bulk import stabilize
+            else:
+                from bitslice import stabilize
+            self.grid[...] = stabilize(self.grid, self.periodic, self.sink_mask(),
+                                       self.threshold)
+            return
+        if engine != 'queue':
+            raise ValueError('Unknown engine {!r}'.format(engine))
+
         # Find all the unstable sites and start toppling them
-        unstable = []
+        unstable = self._queue_factory()
         for i in range(0, self.width):
             for j in range(0, self.height):
                 if self.grid[i, j] >= self.threshold:
@@ -212,26 +637,191 @@ class SandPile:
 
         # Topple until there is nothing left to topple
         while len(unstable) > 0:
-            affected_neighbors = self.topple(unstable[0])
+            current = unstable.popleft()  # Remove current element
+            affected_neighbors = self.topple(current)
 
             if len(affected_neighbors) > 0:
                 unstable.extend(affected_neighbors)
 
             # Need to make sure that the current site is actually stable
-            if self.grid[tuple(unstable[0])] >= self.threshold:
-                unstable.append(unstable[0])
+            if self.grid[tuple(current)] >= self.threshold:
+                unstable.append(current)
+
+    @classmethod
+    def recurrent(cls, width, height, seed=None):
+        """
+        Create a pile in a uniformly random recurrent configuration, i.e. a
+        state drawn from the critical (stationary) distribution, so statistics
+        can be collected from the first drop without any warm-up.
+
+        Parameters
+        ==========
+        width: int, width of the lattice
+        height: int, height of the lattice
+        seed: int or None, seed for the sampler; if None it is drawn from
+            numpy's global random state
+        """
+        from graphpile import from_pile
+        from recurrent import sample_recurrent
+        heights = sample_recurrent(from_pile(cls(width, height)), seed)
+        return cls.from_grid(heights.reshape(width, height))
+
+    @classmethod
+    def from_grid(cls, grid, threshold=4):
+        """
+        Create a pile holding a copy of `grid`, treated as already being in
+        the critical state.
+
+        Parameters
+        ==========
+        grid: 2D array of heights
+        threshold: int, threshold of the pile
+        """
+        grid = np.asarray(grid)
+        pile = cls(grid.shape[0], grid.shape[1], threshold=threshold)
+        pile.grid = grid.astype(pile.grid.dtype)
+        pile.pre_critical = False
+        # Start the mass history from the actual mass so the first loss is right
+        pile.mass_history = [pile.mass()]
+        return pile
+
+    def is_recurrent(self):
+        """
+        Returns true if the current grid is recurrent, i.e. it can occur in
+        the critical state, using the burning algorithm.
+        """
+        from graphpile import from_pile
+        from recurrent import is_recurrent
+        return is_recurrent(from_pile(self), self.grid.ravel())
+
+    # The recurrent configurations form a group (the sandpile group) under
+    # addition followed by stabilization; the following methods implement it
+    # on top of the bit-sliced bulk engine
+    _group_cache = {}   # (zero, identity) grids keyed by (topology, width, height)
+
+    def _check_group(self, other=None):
+        if self.threshold != 2 * self.dimension:
+            raise ValueError('The sandpile group needs threshold == {}'.format(
+                2 * self.dimension))
+        if isinstance(other, SandPile) and (
+                other.topology != self.topology or other.grid.shape != self.grid.shape):
+            raise ValueError('Can only combine piles with the same topology and size')
+
+    def _stabilized(self, grid):
+        """A new pile of the same kind holding the stabilization of `grid`."""
+        from bitslice import stabilize
+        return self.from_grid(stabilize(grid, self.periodic, self.sink_mask(),
+                                        self.threshold), self.threshold)
+
+    def max_stable(self):
+        """The grid holding threshold - 1 grains on every site outside the sink."""
+        grid = np.full((self.width, self.height), self.threshold - 1, dtype=np.int64)
+        grid[self.sink_mask()] = 0
+        return grid
+
+    @classmethod
+    def identity(cls, width, height):
+        """
+        Create a pile holding the identity of the sandpile group, the
+        stabilization of 2m - stab(2m) where m is the maximal stable grid.
+        Identities are computed once per topology and size and then cached.
+
+        Parameters
+        ==========
+        width: int, width of the lattice
+        height: int, height of the lattice
+        """
+        return cls.from_grid(cls(width, height)._group_elements()[1])
+
+    def _group_elements(self):
+        """
+        Returns the grids z = 2m - stab(2m), which is equivalent to the empty
+        grid and holds at least m grains on every site, and the identity
+        stab(z), computing them only once per topology and size.
+        """
+        self._check_group()
+        key = (self.topology, self.width, self.height)
+        if key not in SandPile._group_cache:
+            double = 2 * self.max_stable()
+            zero = double - self._stabilized(double).grid
+            SandPile._group_cache[key] = (zero, self._stabilized(zero).grid)
+        return SandPile._group_cache[key]
+
+    def __add__(self, other):
+        """
+        Returns a new pile holding the stabilization of the sum of the two
+        grids. `other` may be a pile of the same kind or an array of heights.
+        """
+        self._check_group(other)
+        if isinstance(other, SandPile):
+            other = other.grid
+        return self._stabilized(self.grid + np.asarray(other))
 
-            unstable = unstable[1:]  # Remove current element
+    __radd__ = __add__
+
+    def inverse(self):
+        """
+        Returns the pile which gives the identity when added to this one:
+        the stabilization of e + z - x, where z = 2m - stab(2m) is a zero of
+        the group with at least m grains on every site, so the sum has no
+        negative heights and its stabilization is recurrent.
+        """
+        zero, identity = self._group_elements()
+        return self._stabilized(identity + zero - self.grid)
+
+    def __neg__(self):
+        return self.inverse()
+
+    def __sub__(self, other):
+        self._check_group(other)
+        if not isinstance(other, SandPile):
+            other = self.from_grid(other, self.threshold)
+        return self + other.inverse()
+
+    def __mul__(self, times):
+        """The pile added to itself `times` times, by repeated doubling."""
+        self._check_group()
+        if times < 0:
+            return self.inverse() * -times
+        result = self.identity(self.width, self.height)
+        power = self
+        while times > 0:
+            if times % 2 == 1:
+                result = result + power
+            times //= 2
+            if times > 0:
+                power = power + power
+        return result
+
+    __rmul__ = __mul__
+
+    def order(self, limit=None):
+        """
+        Returns the order of this pile's class in the sandpile group: the
+        smallest k > 0 such that adding it to itself k times gives the
+        identity, or None if that did not happen within `limit` additions.
+        """
+        identity = self._group_elements()[1]
+        # Work with the recurrent representative, which is what repeats
+        element = self + identity
+        current = element
+        k = 1
+        while not np.array_equal(current.grid, identity):
+            if limit is not None and k >= limit:
+                return None
+            current = current + element
+            k += 1
+        return k
 
     @staticmethod
     def ensemble_simulate(width, height, number_runs, n=1, site=None, output='ensemble/'):
         """
         Create an ensemble of sandpiles and collect statistics about them.
         To not have statistics which are warped by
-        the random initialization, create a pile which is
-        unstable, stabilize it, and then collect five statistics
-        from it. Note there are many other possible ways to perform an ensemble
-        simulation.
+        the random initialization, each pile starts from a uniformly random
+        recurrent (critical) configuration, and the statistics of a single
+        drop on it are collected. Note there are many other possible ways to
+        perform an ensemble simulation.
 
         Parameters
         ==========
@@ -246,10 +836,8 @@ class SandPile:
         topples = []
         mass_history = []
         for _ in range(0, number_runs):
-            pile = SandPile(width, height, threshold=5, random=True)
-            pile.threshold = 4
-            pile.stabilize()
-            pile.simulate(50, n, site)
+            pile = SandPile.recurrent(width, height)
+            pile.simulate(1, n, site)
             # Need to use .extend not .append because list
             length_hist.extend(pile.length_history[-1:])
             area.extend(pile.area_history[-1:])
@@ -268,11 +856,43 @@ class SandPile:
         pile.graph(output, no_grid=True)
         return pile
 
+    def fork(self, k):
+        """
+        Returns a forks.ForkedPiles with `k` branches starting from the
+        current grid, which share it until they are written to, reference
+        this pile's history without copying it, and are evolved together.
+
+        Parameters
+        ==========
+        k: int, number of branches
+        """
+        from forks import ForkedPiles
+        return ForkedPiles(self, k)
+
     def get_1D_coord(self, site):
         '''A higher dimensional array can be uniquely mapped to a 1D array
-        using site[0]*width + site[1].'''
-
-        return self.width*site[0] + site[1]
+        using site[0]*height + site[1]; this matches the row-major order
+        of `self.grid.ravel()`.'''
+
+        return self.height*site[0] + site[1]
+
+    def record_footprints(self):
+        '''Start recording the footprint (the sites which toppled and how
+        often) of every following avalanche. Returns the
+        footprint.FootprintStore the footprints are collected in.'''
+        from footprint import FootprintStore
+        store = FootprintStore(self.width, self.height, self.periodic, self.sink_mask())
+        self.recorders.append(store)
+        return store
+
+    def record_snapshots(self, interval=None):
+        '''Start recording the grid after every following avalanche, as
+        keyframes and sparse deltas. Returns the snapshots.SnapshotRecorder,
+        whose grid(step) rebuilds the grid after any recorded step.'''
+        from snapshots import SnapshotRecorder
+        recorder = SnapshotRecorder(self, interval)
+        self.recorders.append(recorder)
+        return recorder
 
     # In a larger project, we would likely want to split out the following methods
     # into a separate class or interface as they are really helper functions
@@ -284,10 +904,10 @@ class SandPile:
         """
         Graph the mass loss as a power law.
         """
+        from matplotlib import pyplot
         if no_mass == False:
             # Shift mass loss and multiply by -1 so we can take log
-            loss_history = np.array([self.mass_history[i+1] - self.mass_history[i]
-                                     for i in range(0, len(self.mass_history)-1)])
+            loss_history = np.diff(self.mass_history)
             max_loss = np.max(loss_history)
             scaled_history = -1 * (loss_history - max_loss)
 
@@ -323,6 +943,7 @@ class SandPile:
         """
         Graph the topples number as a power law.
         """
+        from matplotlib import pyplot
         ax.set_xlabel("Topples")
         ax.set_ylabel("Frequency")
         topples_data, topples_frequency, topples_exponent, intercept = self.get_statistics(
@@ -344,6 +965,7 @@ class SandPile:
         """
         Graph the length as a power law.
         """
+        from matplotlib import pyplot
         ax.set_xlabel("Length")
         ax.set_ylabel("Frequency")
         length_data, length_frequency, length_exponent, intercept = self.get_statistics(
@@ -366,6 +988,7 @@ class SandPile:
         """
         Graph the area as a power law.
         """
+        from matplotlib import pyplot
         ax.set_xlabel("Area")
         ax.set_ylabel("Frequency")
         area_data, area_frequency, area_exponent, intercept = self.get_statistics(
@@ -385,11 +1008,74 @@ class SandPile:
 
         return area_exponent
 
+    def graph_duration(self, output, fig, ax):
+        """
+        Graph the duration (parallel sweeps) as a power law.
+        """
+        from matplotlib import pyplot
+        ax.set_xlabel("Duration")
+        ax.set_ylabel("Frequency")
+        duration_data, duration_frequency, duration_exponent, intercept = self.get_statistics(
+            self.tracked_history('duration'), upper=(self.width+self.height) / 2, start=0)
+        self.make_powerlaw_plot(
+            duration_data, duration_frequency, ax, exponent=duration_exponent, intercept=intercept)
+        fig.savefig(output + 'durationAnalysis.png')
+        pyplot.cla()  # clear axis
+        return duration_exponent
+
+    def graph_waves(self, output, fig, ax):
+        """
+        Graph the wave sizes as a power law; in two dimensions the exponent
+        is expected to be close to -1.
+        """
+        from matplotlib import pyplot
+        ax.set_xlabel("Wave size")
+        ax.set_ylabel("Frequency")
+        wave_data, wave_frequency, wave_exponent, intercept = self.get_statistics(
+            self.tracked_history('wave_size'), upper=min((self.width*self.height)/2, 300),
+            start=0)
+        self.make_powerlaw_plot(
+            wave_data, wave_frequency, ax, exponent=wave_exponent, intercept=intercept)
+        fig.savefig(output + 'wavesAnalysis.png')
+        pyplot.cla()  # clear axis
+        return wave_exponent
+
+    def graph_spectrum(self, output, fig, ax):
+        """
+        Graph the power spectra of the mass and the topples (see
+        spectrum.py) with the power laws fitted at low frequencies. Returns
+        the fitted slopes by signal, or None if the history is too short.
+        """
+        from matplotlib import pyplot
+        from spectrum import analyse_spectra, fit_slope, segment_size
+        segment = segment_size(len(self.topples_history) - self.get_start_index())
+        if segment is None:
+            return None
+        slopes = {}
+        ax.set_xscale('log')
+        ax.set_yscale('log')
+        for name, estimator in analyse_spectra(self, segment=segment).items():
+            frequencies, density = estimator.psd()
+            slope, intercept = fit_slope(frequencies, density)
+            slopes[name] = slope
+            # Leave out the zero frequency, which the detrending removes
+            ax.plot(frequencies[1:], density[1:], label='{} (slope {})'.format(
+                name, np.round(slope, 3)))
+            fitted = frequencies[1:11]
+            ax.plot(fitted, np.exp(intercept) * fitted ** slope, color='red')
+        ax.set_xlabel("Frequency (1 / avalanches)")
+        ax.set_ylabel("Power spectral density")
+        ax.legend()
+        fig.savefig(output + 'spectrum.png')
+        pyplot.cla()
+        return slopes
+
     def graph_density(self, output, no_grid, fig, ax):
         """
         Graph the mass density as a power law, and the grid
         as a colormesh.
         """
+        from matplotlib import pyplot
         ax.set_xlabel("Density")
         ax.set_ylabel("Frequency")
         start = self.get_start_index() + 1  # Add one since we have a leading 0
@@ -418,6 +1104,7 @@ class SandPile:
         This function assumes the 'output' directory exists; if it does not
         an error will occur.
         '''
+        from matplotlib import pyplot
         fig, ax = pyplot.subplots()
         output_dir = Path.cwd() / output
         if not output_dir.is_dir():
@@ -429,22 +1116,32 @@ class SandPile:
         length_exponent = self.graph_length(output, fig, ax)
         area_exponent = self.graph_area(output, fig, ax)
         mean_density = self.graph_density(output, no_grid, fig, ax)
+        self.graph_spectrum(output, fig, ax)
+        # The tracked histories are plotted too, but not returned
+        if self.duration_history is not None:
+            self.graph_duration(output, fig, ax)
+        if self.waves_history is not None:
+            self.graph_waves(output, fig, ax)
         self.print_correlation(output + 'correlation.txt')
+        if self.profiler is not None:
+            self.profiler.write(output + 'profile.json')
 
         # Close the figure
         pyplot.close(fig)
         return [topples_exponent, length_exponent, area_exponent, mean_density]
 
-    def get_statistics(self, field, upper=102, lower=3):
+    def get_statistics(self, field, upper=102, lower=3, start=None):
         '''Return power law statistics of the passed field
            Field should be one of area_history, length_history, etc.
            The upper/lower range was selected by a process of trial and error;
            it works tolerably well for length, area, topples, losses
            at least for small grid sizes; likely will be better fit
            for larger grid sizes
+           Start is the index of the first value of field to use, by default
+           the start index
         '''
         # Start our analysis mid-way through evolution, to avoid pre-critical noise
-        start = self.get_start_index()
+        start = self.get_start_index() if start is None else start
         data = field[start:]
         if len(data) == 0:
             raise Exception("Not enough data")
@@ -481,62 +1178,65 @@ class SandPile:
             transformed_x = np.exp(plot_x)
             transformed_y = np.exp(plot_y)
             axis.plot(transformed_x, transformed_y, color='red')
-            axis.set_label('a =' + np.str(np.round(exponent, 3)))
-            axis.legend(['a =' + np.str(np.round(exponent, 3))])
+            axis.set_label('a =' + str(np.round(exponent, 3)))
+            axis.legend(['a =' + str(np.round(exponent, 3))])
 
     def correlation(self, data1, data2):
+        from scipy.stats import spearmanr
         return spearmanr(data1, data2)
 
-    def calculate_correlations(self):
+    def analyse(self, start=None):
+        """
+        Return the HistoryAnalysis of the history from `start` (by default
+        past the burn-in): moments, rank correlations and conditional
+        averages of the topples, area, length, mass change and mass, all
+        computed in one pass (see analysis.py).
+        """
+        from analysis import analyse
+        return analyse(self, start=start)
+
+    def calculate_correlations(self, analysis=None):
         """
         Calculates the correlation between area and 1) length 2) mass loss 3) topple number.
         Returns a list containing the correlation coefficients calculated between
         area and each of the quantities in the above order:
         area-length correlation, area-mass loss correlation, area-topples number.
+        Each entry is a (correlation, pvalue) pair.
         """
-        start = self.get_start_index()
-        len_data = np.array(self.length_history[start:])
-        area_data = np.array(self.area_history[start:])
-        loss_data = np.array([self.mass_history[i+1] - self.mass_history[i]
-                              for i in range(start, len(self.mass_history) - 1)])
+        analysis = self.analyse() if analysis is None else analysis
+        return [analysis.correlation('area', name)
+                for name in ('length', 'mass_change', 'topples')]
 
-        topples_data = np.array(self.topples_history[start:])
-
-        # Calculate correlations between area and the other quantities
-        area_len_correlation = self.correlation(len_data, area_data)
-        area_loss_correlation = self.correlation(area_data, loss_data)
-        area_topples_correlation = self.correlation(area_data, topples_data)
-
-        return [area_len_correlation, area_loss_correlation, area_topples_correlation]
-
-    def calculate_average_mass(self):
-        start = self.get_start_index()
-        data = np.array(self.mass_history[start:]) / (self.width*self.height)
-        return np.mean(data)
+    def calculate_average_mass(self, analysis=None):
+        analysis = self.analyse() if analysis is None else analysis
+        return analysis.moments('mass')['mean'] / (self.width*self.height)
 
     def get_start_index(self):
+        # A detected burn-in takes precedence over the fixed heuristic
+        if self.burn_in is not None:
+            return self.burn_in
         if self.pre_critical == True:
             return int(self.threshold*self.width*self.height / 2)
         else:
             return 0
 
     def print_correlation(self, file_name):
-        correlations = self.calculate_correlations()
-        mass_average = self.calculate_average_mass()
-        original_stdout = sys.stdout  # Save a reference to the original standard output
+        # One pass over the history gives both the correlations and the mass
+        analysis = self.analyse()
+        correlations = self.calculate_correlations(analysis)
+        mass_average = self.calculate_average_mass(analysis)
 
         with open(file_name, 'w') as f:
-            sys.stdout = f  # Change the standard output to the file
-            print(
-                'Area-Length Correlation: {}: pvalue: {}'.format(correlations[0][0], correlations[0][1]))
-            print(
-                'Area-Loss Correlation: {}: pvalue: {}'.format(correlations[1][0], correlations[1][1]))
-            print(
-                'Area-Topples Correlation: {}: pvalue: {}'.format(correlations[2][0], correlations[2][1]))
-            print('Average Mass: {}'.format(mass_average))
-            sys.stdout = original_stdout  # Reset the standard output to its original value
+            f.write(
+                'Area-Length Correlation: {}: pvalue: {}\n'.format(correlations[0][0], correlations[0][1]))
+            f.write(
+                'Area-Loss Correlation: {}: pvalue: {}\n'.format(correlations[1][0], correlations[1][1]))
+            f.write(
+                'Area-Topples Correlation: {}: pvalue: {}\n'.format(correlations[2][0], correlations[2][1]))
+            f.write('Average Mass: {}\n'.format(mass_average))
 
     def graph_grid(self):
+        from matplotlib import pyplot
         fig2, ax2 = pyplot.subplots(constrained_layout=True)
         psm = ax2.pcolormesh(self.grid, cmap='inferno', vmin=0, vmax=3)
         fig2.colorbar(psm, ax=ax2)
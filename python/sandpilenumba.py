@@ -3,53 +3,90 @@
 #   Student ID: 1027644
 #   November 9,2020
 #################################################
+"""
+Numba version of the sandpile, with its kernels compiled ahead of use.
+
+The kernels below are compiled by numba the first time they are called,
+which takes seconds. They are cached on disk (in __pycache__, or in
+NUMBA_CACHE_DIR when set), so warmup() compiles every kernel for the
+types SandPile passes them, loading it from the cache when possible, and
+reports where each one came from. Running this module does the same and
+prints the report; the Dockerfile runs it at build time so that containers
+start with a warm cache. Setting NUMBA_CPU_NAME=generic both when the
+cache is built and when it is used keeps it valid on other CPUs.
+
+The histories are typed lists created by a kernel too: calling the methods
+of a typed list from Python compiles them again in every process.
+
+Example usage:
+    python sandpilenumba.py
+"""
 import numpy as np
-from scipy.stats import pearsonr    # For calculating correlations
-from matplotlib import pyplot       # For plotting
 import sys                          # For printing to files
+import time
 from pathlib import Path            # Create output directory
-from numba import jit
+from numba import jit, types
 from numba.typed import List
 
+# Kernels in the order warmup compiles them: the callees first, so that
+# compiling fast_avalanche can reuse them
+KERNELS = ('new_history', 'get_neighbors', 'topple', 'dist', 'fast_avalanche')
+
 
 @jit(nopython=True, cache=True)
-def fast_avalanche(grid, threshold, width, height, start, mass_history,
-                   topples_history, length_history, area_history, steps, n):
+def fast_avalanche(grid, threshold, width, height, sites, mass_history,
+                   topples_history, length_history, area_history, n):
     """Run the avalanche causing all sites to topple and store the stats of
-    the avalanche in the appropriate variables.
-    start: site sand is dropped, beginning cascade
+    the avalanche in the appropriate variables, for every drop.
+    sites: (steps, 2) array of the sites sand is dropped on, each beginning
+    a cascade
     """
-    for i in range(steps):
+    for i in range(len(sites)):
+        start = sites[i, 0]*height + sites[i, 1]
         # Add sand
-        grid[start[0]*width + start[1]] += n
-
-        # start toppling
-        buffer = topple(grid, width, height, threshold,
-                        width*start[0]+start[1])
-        # If no topples, update history and return
-        if len(buffer) == 0:
-            return grid
-
-        # If we had a topple, loop through neighbors until it dies
-        sites_affected = set([width*start[0] + start[1]])
+        grid[start] += n
+
+        # If no topples, update history and move on to the next drop.
+        # Whether a site topples is checked before toppling it: the only
+        # site of a 1 x 1 grid has no neighbors to return
+        if grid[start] < threshold:
+            topples_history.append(0)
+            length_history.append(0)
+            area_history.append(0)
+            mass_history.append(np.sum(grid))
+            continue
+        buffer = topple(grid, width, height, threshold, start)
+
+        # Several grains dropped at once may leave the start unstable
+        if grid[start] >= threshold:
+            buffer.append(start)
+
+        # If we had a topple, loop through neighbors until it dies.
+        # The buffer is a FIFO queue read from `head`, as SandPile._relax
+        sites_affected = set([start])
         distance = 0
         topples = 1
-        while len(buffer) > 0:
-            current = buffer[0]
+        head = 0
+        while head < len(buffer):
+            current = buffer[head]
+            head += 1
+            toppled = grid[current] >= threshold
             affected_sites = topple(grid, width, height, threshold,
                                     current)
             sites_affected.add(current)
-            distance = max(distance, dist(start, current, width))
+            distance = max(distance, dist(sites[i, 0], sites[i, 1], current, height))
 
-            if len(affected_sites) > 0:
+            if toppled:
                 buffer.extend(affected_sites)
+                topples += 1
 
             if grid[current] >= threshold:
                 buffer.append(current)
 
-            # Remove the first element
-            buffer = buffer[1:]
-            topples += 1
+            # Drop the sites already visited once they are most of the buffer
+            if head > 1024 and 2*head > len(buffer):
+                buffer = buffer[head:]
+                head = 0
 
         topples_history.append(topples)
         length_history.append(distance)
@@ -61,33 +98,31 @@ def fast_avalanche(grid, threshold, width, height, start, mass_history,
 @jit(nopython=True, cache=True)
 def get_neighbors(site, width, height):
     """
-        site: a list of coordinates
-        Returns a list containing the coordinates of its
+        site: index of a site in the flattened grid, x*height + y
+        Returns a list containing the indices of its
         nearest neighboring sites. If this list is shorter than 4, then
         it is on a boundary and thus sand toppled from this site will be deleted
         Neighbors returned in order Left, Right, Up, Down if these exist
     """
-    y = site % width
-    x = int((site-y)/width)
+    y = site % height
+    x = site // height
     ret = [i for i in range(0)]
     if x > 0 and x < width:
-        ret.append(width*(x - 1) + y)
+        ret.append(height*(x - 1) + y)
     if x < (width-1):
-        ret.append((x+1)*width + y)
+        ret.append((x+1)*height + y)
     if y > 0 and y < height:
-        ret.append(width*x + y-1)
+        ret.append(height*x + y-1)
     if y < (height - 1):
-        ret.append(width*x + y + 1)
+        ret.append(height*x + y + 1)
 
     return ret
 
 @jit(nopython=True, cache=True)
 def topple(grid, width, height, threshold, site):
     ''' Topples a site, if the number of grains is greater than the threshold
-    Returns a boolean indicating whether toppling occured '''
-    # Use tuple below because a list will not index properly (learned this the hard way)
-    # Also, using a tuple instead of explicit destructuring means it will be easier
-    # to extend to higher dimensional grid if desired
+    Returns the list of neighbors which received grains (empty if the site
+    did not topple) '''
     if grid[site] < threshold:
         return [i for i in range(0)]
 
@@ -96,15 +131,66 @@ def topple(grid, width, height, threshold, site):
     for i in range(len(neighbors)):
         grid[neighbors[i]] += 1
 
-    grid[site] -= threshold
+    # One grain went to each of the 4 directions, whether or not the
+    # neighbor exists; grains sent off the grid are lost
+    grid[site] -= 4
     return neighbors
 
 @jit(nopython=True, cache=True)
-def dist(x, index, width):
-    y = [int(index-(index % width) / width), index % width]
-    '''Distance between two sites x,y'''
+def dist(x, y, index, height):
+    '''Distance between the site (x, y) and the site at `index`'''
     # Make distance the manhattan distance
-    return abs(x[0] - y[0]) + abs(x[1]-y[1])
+    return abs(x - index // height) + abs(y - index % height)
+
+@jit(nopython=True, cache=True)
+def new_history():
+    """An empty typed list of int64, to hold one of a pile's histories."""
+    return List.empty_list(types.int64)
+
+
+def signatures():
+    """The argument types SandPile calls each kernel with."""
+    index = types.int64
+    grid = types.int64[::1]
+    sites = types.int64[:, ::1]
+    history = types.ListType(index)
+    return {
+        'new_history': (),
+        'get_neighbors': (index, index, index),
+        'topple': (grid, index, index, index, index),
+        'dist': (index, index, index, index),
+        'fast_avalanche': (grid, index, index, index, sites, history, history,
+                           history, history, index),
+    }
+
+
+def warmup():
+    """
+    Compile every kernel for the types SandPile uses, loading it from the
+    on-disk cache if it is there. Returns a dict mapping each kernel to
+    where it came from ('cache', 'compiled', or 'memory' if this process
+    already had it) and the seconds taken.
+    """
+    report = {}
+    types_used = signatures()
+    for name in KERNELS:
+        kernel, signature = globals()[name], types_used[name]
+        start = time.perf_counter()
+        if signature in kernel.overloads:
+            source = 'memory'
+        else:
+            hits = sum(kernel.stats.cache_hits.values())
+            kernel.compile(signature)
+            source = 'cache' if sum(kernel.stats.cache_hits.values()) > hits else 'compiled'
+        report[name] = (source, time.perf_counter() - start)
+    return report
+
+
+def format_report(report):
+    """One line per kernel of a warmup() report."""
+    return '\n'.join('{:<16}{:<10}{:.3f}s'.format(name, source, seconds)
+                     for name, (source, seconds) in report.items())
+
 
 class SandPile:
     """SandPile class
@@ -130,18 +216,10 @@ class SandPile:
         # step (so that `len(self.mass_history)` is equal to the number of time
         # steps the sand pile has been running).
         # Need to start with 0 because we are going to take the difference
-        self.mass_history = List()
-        self.topples_history = List()  # Number of topples to reach stability in avalanche
-        self.area_history = List()     # Number of unique sites reached in avalanche
-        self.length_history = List()   # Maximum radius of avalanche
-        self.mass_history.append(0)
-        self.mass_history.pop()
-        self.topples_history.append(0)
-        self.topples_history.pop()
-        self.area_history.append(0)
-        self.area_history.pop()
-        self.length_history.append(0)
-        self.length_history.pop()
+        self.mass_history = new_history()
+        self.topples_history = new_history()  # Number of topples to reach stability in avalanche
+        self.area_history = new_history()     # Number of unique sites reached in avalanche
+        self.length_history = new_history()   # Maximum radius of avalanche
 
 
     def simulate(self, steps, n=1, site=None):
@@ -150,17 +228,19 @@ class SandPile:
         steps: number of steps to evolve
         n: number of grains to drop per step
         site: coordinates (list/tuple) of site to drop on;
-            if none specified, drops are made on a random site
+            if none specified, each drop is made on a random site, drawn
+            as SandPile does so the same seed gives the same drops
         '''
-        if site == None:
-            place = (np.random.randint(0, self.width),
-                    np.random.randint(0, self.height))
+        if site is None:
+            places = [(np.random.randint(0, self.width),
+                       np.random.randint(0, self.height)) for _ in range(steps)]
         else:
-            place = tuple(site)
+            places = [tuple(site)] * steps
+        places = np.array(places, dtype=np.int64).reshape(steps, 2)
 
-        grid = fast_avalanche(np.ndarray.flatten(self.grid), self.threshold,
-                                self.width, self.height, place, self.mass_history,
-                                self.topples_history, self.length_history, self.area_history, n, steps)
+        grid = fast_avalanche(self.grid.astype(np.int64).ravel(), self.threshold,
+                                self.width, self.height, places, self.mass_history,
+                                self.topples_history, self.length_history, self.area_history, n)
 
         self.grid = np.reshape(grid, (self.width, self.height))
 
@@ -172,6 +252,7 @@ class SandPile:
         an error will occur.
         Consider refactoring into separate functions.
         '''
+        from matplotlib import pyplot
         fig, ax = pyplot.subplots()
         output_dir = Path.cwd() / output
         if not output_dir.is_dir():
@@ -298,10 +379,11 @@ class SandPile:
             transformed_x = np.exp(plot_x)
             transformed_y = np.exp(plot_y)
             axis.plot(transformed_x, transformed_y, color='red')
-            axis.set_label('a =' + np.str(np.round(exponent, 3)))
-            axis.legend(['a =' + np.str(np.round(exponent, 3))])
+            axis.set_label('a =' + str(np.round(exponent, 3)))
+            axis.legend(['a =' + str(np.round(exponent, 3))])
 
     def correlation(self, data1, data2):
+        from scipy.stats import pearsonr
         return pearsonr(data1, data2)
 
     def calculate_correlations(self):
@@ -352,3 +434,7 @@ class SandPile:
                 'Area-Topples Correlation: {}: pvalue: {}'.format(correlations[2][0], correlations[2][1]))
             print('Average Mass: {}'.format(mass_average))
             sys.stdout = original_stdout  # Reset the standard output to its original value
+
+
+if __name__ == '__main__':
+    print(format_report(warmup()))
@@ -0,0 +1,439 @@
+#!/usr/bin/env python3
+#################################################
+#   Author: Caleb Smith
+#   Student ID: 1027644
+#   November 9,2020
+#################################################
+"""Finite-size scaling
+Runs a ladder of lattice sizes and fits the avalanche exponents by data
+collapse. The distribution of an observable s (area, topples, length or, on
+request, the duration or the number of waves) on an L x L lattice follows
+the finite-size scaling form
+
+    P(s, L) = s^-tau F(s / L^D)
+
+so s^tau P(s, L) plotted against s / L^D falls onto one curve for every L.
+The fit looks for the tau and D making the curves overlap best; the moment
+exponents sigma(q) of <s^q> ~ L^sigma(q) give the starting point.
+
+The work is split into chunks: one chunk samples an independent critical
+state of one size (see recurrent.py), drops a fixed number of grains on it
+and returns the histogram of the observables. Chunks run in parallel worker
+processes. The size with the most estimated work left (its cost per chunk
+times the chunks it still needs) gets the next free worker, and a size stops
+as soon as the relative standard error of <s^q> over its chunks reaches the
+target. Since chunks are independent, the uncertainties of the exponents
+are estimated by resampling whole chunks (bootstrap).
+
+Example usage:
+    sweep = ScalingSweep('open', [16, 32, 64], tolerance=0.02, n_jobs=4)
+    sweep.run()
+    sweep.fit('area')
+
+    python scaling.py open 16 32 64 --tolerance 0.02 --jobs 4
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+from topologies import TOPOLOGIES, get_topology
+
+OBSERVABLES = ('area', 'topples', 'length')
+# Observables measured only when asked for, as the avalanches are then relaxed
+# in synchronous sweeps (duration) or wave by wave (see SandPile.iter_avalanches)
+EXTRA_OBSERVABLES = ('duration', 'waves', 'last_wave')
+# Orders of the moments used for the moment exponents
+MOMENTS = np.arange(1, 4.01, 0.25)
+
+
+def run_chunk(topology, size, drops, seed, observables=OBSERVABLES):
+    """
+    Sample a critical state of an L x L lattice, drop `drops` grains on it
+    and return the histogram of each observable, as sorted distinct values
+    and their counts, along with the seconds taken.
+    """
+    start = time.perf_counter()
+    seeds = np.random.SeedSequence(seed).generate_state(2)
+    pile = get_topology(topology).recurrent(size, size, seed=int(seeds[0]))
+    # Chunks may run in threads next to each other (see the /sweep route)
+    pile.rng = np.random.RandomState(seeds[1])
+    values = {name: [] for name in observables}
+    # The duration and the waves are only measured when asked for
+    duration = 'duration' in observables
+    waves = 'waves' in observables or 'last_wave' in observables
+    for chunk in pile.iter_avalanches(drops, chunk_size=4096, duration=duration, waves=waves):
+        for name in observables:
+            values[name].append(chunk[name])
+    histograms = {name: np.unique(np.concatenate(values[name]), return_counts=True)
+                  for name in observables}
+    return histograms, time.perf_counter() - start
+
+
+def merge(histograms):
+    """Merge sparse histograms (values, counts) into one."""
+    values = np.concatenate([values for values, _ in histograms])
+    counts = np.concatenate([counts for _, counts in histograms])
+    merged, inverse = np.unique(values, return_inverse=True)
+    return merged, np.bincount(inverse.ravel(), weights=counts).astype(np.int64)
+
+
+def moment(histogram, q, drops):
+    """<s^q> over `drops` avalanches, given their histogram."""
+    values, counts = histogram
+    return np.dot(counts, values.astype(np.float64) ** q) / drops
+
+
+def log_binned(histogram, drops, per_octave=4, lower=1, min_count=10):
+    """
+    The probability density of a histogram in logarithmic bins of
+    `per_octave` bins per factor of 2, from `lower` up. Bins with fewer
+    than `min_count` avalanches are left out. Returns the geometric centers
+    of the bins and the densities.
+    """
+    values, counts = histogram
+    keep = values >= max(lower, 1)
+    values, counts = values[keep], counts[keep]
+    if len(values) == 0:
+        return np.zeros(0), np.zeros(0)
+    exponents = np.arange(int(np.ceil(np.log2(values[-1] + 1) * per_octave)) + 2)
+    edges = np.unique(np.floor(2.0 ** (exponents / per_octave)).astype(np.int64))
+    index = np.searchsorted(edges, values, side='right') - 1
+    binned = np.bincount(index, weights=counts, minlength=len(edges) - 1)[:len(edges) - 1]
+    widths = np.diff(edges)
+    centers = np.sqrt(edges[:-1] * (edges[1:] - 1.0))
+    full = binned >= min_count
+    return centers[full], binned[full] / (drops * widths[full])
+
+
+def collapse_cost(exponents, curves):
+    """
+    How badly the curves fail to collapse for exponents (tau, D): the mean
+    squared vertical distance between every curve and the others, over the
+    ranges where they overlap, in log coordinates.
+    """
+    tau, dimension = exponents
+    scaled = [(np.log(s) - dimension * np.log(size), np.log(density) + tau * np.log(s))
+              for size, s, density in curves]
+    total, points = 0.0, 0
+    for i, (x, y) in enumerate(scaled):
+        for j, (other_x, other_y) in enumerate(scaled):
+            if i == j or len(other_x) < 2:
+                continue
+            inside = (x >= other_x[0]) & (x <= other_x[-1])
+            if inside.any():
+                total += np.sum((y[inside] - np.interp(x[inside], other_x, other_y)) ** 2)
+                points += inside.sum()
+    return total / points if points > 0 else np.inf
+
+
+def moment_exponents(sizes, histograms, drops, orders=MOMENTS):
+    """
+    The moment exponents sigma(q), from the slope of log <s^q> against
+    log L, and the (tau, D) they imply: sigma(q) = D (q + 1 - tau) for the
+    orders q above tau - 1.
+    """
+    log_sizes = np.log(sizes)
+    sigma = np.array([
+        np.polyfit(log_sizes, [np.log(moment(histogram, q, n))
+                               for histogram, n in zip(histograms, drops)], 1)[0]
+        for q in orders])
+    dimension, intercept = np.polyfit(orders, sigma, 1)
+    return sigma, (1 - intercept / dimension, dimension)
+
+
+class ScalingSweep:
+    """
+    Histograms of a ladder of lattice sizes, sampled chunk by chunk until
+    each size is precise enough, and the exponents fitted from them.
+    """
+
+    def __init__(self, topology, sizes, observables=OBSERVABLES, chunk_drops=None,
+                 tolerance=0.05, order=2, min_chunks=4, max_chunks=64, n_jobs=None,
+                 seed=0):
+        """
+        Parameters
+        ==========
+        topology: name of the boundary condition (see topologies.py)
+        sizes: list of int, lattice sizes L (the lattices are L x L)
+        observables: avalanche observables to histogram, from OBSERVABLES
+            and EXTRA_OBSERVABLES; the duration cannot be combined with the
+            waves
+        chunk_drops: int or function of L, grains dropped per chunk;
+            defaults to 4 L^2, enough for the grid to be turned over
+        tolerance: float, target relative standard error of <s^order> of
+            the first observable; a size stops once it is reached
+        order: float, order of the moment used for the precision target
+        min_chunks, max_chunks: int, chunks run per size at least and at most
+        n_jobs: int, worker processes (None for one per CPU, 1 to run
+            everything in this process)
+        seed: int, seed from which the seed of every chunk is derived
+        """
+        get_topology(topology)
+        if 'duration' in observables and {'waves', 'last_wave'} & set(observables):
+            raise ValueError('The duration cannot be measured together with the waves')
+        self.topology = topology
+        self.sizes = sorted(sizes)
+        self.observables = tuple(observables)
+        if chunk_drops is None:
+            chunk_drops = lambda size: 4 * size * size
+        elif not callable(chunk_drops):
+            chunk_drops = (lambda drops: lambda size: drops)(chunk_drops)
+        self.chunk_drops = chunk_drops
+        self.tolerance = tolerance
+        self.order = order
+        self.min_chunks = min_chunks
+        self.max_chunks = max_chunks
+        self.n_jobs = n_jobs
+        self.seed = seed
+        self.chunks = {size: [] for size in self.sizes}
+        self.seconds = {size: [] for size in self.sizes}
+        self.drops = {size: [] for size in self.sizes}
+        self._submitted = {size: 0 for size in self.sizes}
+
+    def add_chunk(self, size, histograms, drops, seconds=0.0):
+        """Record the histograms of one finished chunk of a size."""
+        self.chunks[size].append(histograms)
+        self.drops[size].append(drops)
+        self.seconds[size].append(seconds)
+
+    def error(self, size):
+        """
+        Relative standard error of <s^order> of the first observable over
+        the chunks of a size (inf with fewer than two chunks).
+        """
+        chunks = self.chunks[size]
+        if len(chunks) < 2:
+            return np.inf
+        name = self.observables[0]
+        estimates = np.array([moment(chunk[name], self.order, drops)
+                              for chunk, drops in zip(chunks, self.drops[size])])
+        mean = estimates.mean()
+        if mean == 0:
+            return np.inf
+        return estimates.std(ddof=1) / np.sqrt(len(estimates)) / mean
+
+    def done(self, size):
+        """Whether a size needs no more chunks."""
+        finished = len(self.chunks[size])
+        if self._submitted[size] >= self.max_chunks:
+            return True
+        return finished >= self.min_chunks and self.error(size) <= self.tolerance
+
+    def _cost(self, size):
+        """Estimated seconds per chunk: measured, or scaled from other sizes
+        assuming the work grows as L^2 topples per drop."""
+        if self.seconds[size]:
+            return np.mean(self.seconds[size])
+        work = lambda other: self.chunk_drops(other) * other ** 2
+        rates = [np.mean(self.seconds[other]) / work(other)
+                 for other in self.sizes if self.seconds[other]]
+        return work(size) * (np.mean(rates) if rates else 1.0)
+
+    def _remaining(self, size):
+        """Estimated chunks a size still needs, beyond those running."""
+        finished = len(self.chunks[size])
+        running = self._submitted[size] - finished
+        needed = self.min_chunks
+        error = self.error(size)
+        if np.isfinite(error):
+            # The standard error falls as one over the square root of the chunks
+            needed = max(needed, int(np.ceil(finished * (error / self.tolerance) ** 2)))
+        return min(needed, self.max_chunks) - finished - running
+
+    def next_size(self):
+        """The size to run a chunk of next: the one with the most estimated
+        work left, or None if no size needs another chunk now."""
+        candidates = [size for size in self.sizes
+                      if not self.done(size) and self._remaining(size) > 0]
+        if not candidates:
+            return None
+        return max(candidates, key=lambda size: self._cost(size) * self._remaining(size))
+
+    def _arguments(self, size):
+        index = self._submitted[size]
+        self._submitted[size] += 1
+        seed = [self.seed, self.sizes.index(size), size, index]
+        return (self.topology, size, self.chunk_drops(size), seed, self.observables)
+
+    def run(self, log=None):
+        """
+        Run chunks until every size is done. Returns self.
+
+        Parameters
+        ==========
+        log: file-like object to report finished chunks to, or None
+        """
+        for _ in self.iter_run(log):
+            pass
+        return self
+
+    def iter_run(self, log=None):
+        """
+        Run chunks until every size is done, yielding the size of every
+        chunk as soon as it is recorded, so the progress can be reported
+        and the run stopped early by closing the generator.
+
+        Parameters
+        ==========
+        log: file-like object to report finished chunks to, or None
+        """
+        if self.n_jobs == 1:
+            while True:
+                size = self.next_size()
+                if size is None:
+                    break
+                args = self._arguments(size)
+                histograms, seconds = run_chunk(*args)
+                self._finished(size, histograms, args[2], seconds, log)
+                yield size
+            return
+
+        workers = self.n_jobs if self.n_jobs is not None else os.cpu_count() or 1
+        with ProcessPoolExecutor(workers) as executor:
+            running = {}
+            try:
+                while True:
+                    while len(running) < workers:
+                        size = self.next_size()
+                        if size is None:
+                            break
+                        args = self._arguments(size)
+                        running[executor.submit(run_chunk, *args)] = (size, args[2])
+                    if not running:
+                        break
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        size, drops = running.pop(future)
+                        histograms, seconds = future.result()
+                        self._finished(size, histograms, drops, seconds, log)
+                        yield size
+            finally:
+                # Stopped early: drop the chunks which have not started yet
+                for future in running:
+                    future.cancel()
+
+    def _finished(self, size, histograms, drops, seconds, log):
+        self.add_chunk(size, histograms, drops, seconds)
+        if log is not None:
+            log.write('L={} chunk {} {:.1f}s relative error {:.3g}\n'.format(
+                size, len(self.chunks[size]), seconds, self.error(size)))
+            log.flush()
+
+    def histogram(self, size, observable, chunks=None):
+        """The merged histogram of a size, optionally of a subset of its chunks."""
+        chunks = range(len(self.chunks[size])) if chunks is None else chunks
+        return merge([self.chunks[size][i][observable] for i in chunks])
+
+    def _fit(self, observable, selection, lower, per_octave):
+        sizes = [size for size in self.sizes if len(self.chunks[size]) > 0]
+        histograms = [self.histogram(size, observable, selection.get(size))
+                      for size in sizes]
+        drops = [sum(self.drops[size][i] for i in selection.get(
+            size, range(len(self.chunks[size])))) for size in sizes]
+        sigma, guess = moment_exponents(sizes, histograms, drops)
+        curves = [(size,) + log_binned(histogram, n, per_octave, lower)
+                  for size, histogram, n in zip(sizes, histograms, drops)]
+        return sigma, guess, curves
+
+    def fit(self, observable=None, bootstrap=100, lower=4, per_octave=4):
+        """
+        Fit tau and D by data collapse of every size's distribution of
+        `observable`, with standard errors from resampling the chunks.
+        Returns a dict with the exponents, their errors, the moment
+        exponents sigma(q) and the number of drops per size.
+
+        Parameters
+        ==========
+        observable: name of the observable; defaults to the first one
+        bootstrap: int, number of resamples for the errors (0 for none)
+        lower: int, smallest value of the observable used in the collapse,
+            to leave out the lattice-scale corrections to scaling
+        per_octave: int, logarithmic bins per factor of 2
+        """
+        from scipy.optimize import minimize
+        observable = self.observables[0] if observable is None else observable
+        sizes = [size for size in self.sizes if len(self.chunks[size]) > 0]
+        if len(sizes) < 2:
+            raise ValueError('Data collapse needs at least two sizes with data')
+
+        sigma, guess, curves = self._fit(observable, {}, lower, per_octave)
+        best = minimize(collapse_cost, guess, args=(curves,), method='Nelder-Mead').x
+
+        rng = np.random.RandomState(self.seed)
+        samples = []
+        for _ in range(bootstrap):
+            selection = {size: rng.randint(0, len(self.chunks[size]), len(self.chunks[size]))
+                         for size in sizes}
+            _, _, resampled = self._fit(observable, selection, lower, per_octave)
+            samples.append(minimize(collapse_cost, best, args=(resampled,),
+                                    method='Nelder-Mead').x)
+        errors = np.std(samples, axis=0, ddof=1) if bootstrap > 1 else [np.nan, np.nan]
+
+        return {'observable': observable, 'tau': best[0], 'D': best[1],
+                'tau_error': errors[0], 'D_error': errors[1],
+                'moment_tau': guess[0], 'moment_D': guess[1],
+                'sigma': dict(zip(MOMENTS.tolist(), sigma.tolist())),
+                'cost': collapse_cost(best, curves),
+                'drops': {size: sum(self.drops[size]) for size in sizes},
+                'chunks': {size: len(self.chunks[size]) for size in sizes}}
+
+    def graph_collapse(self, output, observable=None, exponents=None, lower=4):
+        """
+        Save a plot of the collapsed distributions to `output`, for the
+        given (tau, D) or else those found by fit.
+        """
+        from matplotlib import pyplot
+        observable = self.observables[0] if observable is None else observable
+        if exponents is None:
+            result = self.fit(observable, bootstrap=0, lower=lower)
+            exponents = (result['tau'], result['D'])
+        tau, dimension = exponents
+        _, _, curves = self._fit(observable, {}, lower, 4)
+        fig, ax = pyplot.subplots(constrained_layout=True)
+        for size, s, density in curves:
+            ax.loglog(s / size ** dimension, density * s ** tau, '.-', label='L = {}'.format(size))
+        ax.set_xlabel('{} / L^{:.3f}'.format(observable, dimension))
+        ax.set_ylabel('{}^{:.3f} P({})'.format(observable, tau, observable))
+        ax.legend()
+        fig.savefig(output)
+        pyplot.close(fig)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('topology', choices=sorted(TOPOLOGIES))
+    parser.add_argument('sizes', nargs='+', type=int)
+    parser.add_argument('--observables', nargs='+', choices=OBSERVABLES + EXTRA_OBSERVABLES,
+                        default=OBSERVABLES)
+    parser.add_argument('--drops', type=int, default=None,
+                        help='grains per chunk (default 4 L^2)')
+    parser.add_argument('--tolerance', type=float, default=0.05)
+    parser.add_argument('--min-chunks', type=int, default=4)
+    parser.add_argument('--max-chunks', type=int, default=64)
+    parser.add_argument('--jobs', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--bootstrap', type=int, default=100)
+    parser.add_argument('--output', default=None, help='JSON file for the fits')
+    args = parser.parse_args(argv)
+
+    sweep = ScalingSweep(args.topology, args.sizes, args.observables, args.drops,
+                         args.tolerance, min_chunks=args.min_chunks,
+                         max_chunks=args.max_chunks, n_jobs=args.jobs, seed=args.seed)
+    sweep.run(log=sys.stderr)
+    fits = [sweep.fit(observable, args.bootstrap) for observable in args.observables]
+    for result in fits:
+        print('{observable}: tau = {tau:.3f} +- {tau_error:.3f}, '
+              'D = {D:.3f} +- {D_error:.3f}'.format(**result))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(fits, f, indent=2, default=float)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
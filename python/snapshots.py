@@ -0,0 +1,167 @@
+#################################################
+#   Author: Caleb Smith
+#   Student ID: 1027644
+#   November 9,2020
+#################################################
+"""
+Compact recording of the grid after every avalanche.
+
+A SnapshotRecorder is one of a pile's recorders (see
+SandPile.record_snapshots). For every avalanche it stores a sparse delta: the
+cells the avalanche changed and their new heights. The only cells which can
+change are the drop site, the sites which toppled and their neighbors, so a
+delta is at most a constant times the number of topples. Every so often it
+also stores a keyframe, the whole grid packed at 2 bits per cell (more for
+thresholds above 4). The grid after any step is the previous keyframe with
+the deltas since then applied.
+
+By default a keyframe is written once the deltas since the last one take as
+much memory as a keyframe. The keyframes then never take more memory than
+the deltas (apart from the first one), and rebuilding any step touches at
+most about two keyframes' worth of data.
+
+Example usage:
+    pile = SandPile(100, 100, random=True)
+    snapshots = pile.record_snapshots()
+    pile.simulate(10000)
+    snapshots.grid(5000)
+"""
+import numpy as np
+
+from footprint import GrowableArray
+
+
+def _bits(threshold):
+    """Bits per cell needed for the heights of a stable grid."""
+    for bits in (2, 4, 8):
+        if threshold <= 2 ** bits:
+            return bits
+    raise ValueError('Thresholds above 256 cannot be packed')
+
+
+def pack(heights, bits):
+    """Pack a 1D array of heights below 2**bits into bytes."""
+    per_byte = 8 // bits
+    padded = np.zeros(-(-len(heights) // per_byte) * per_byte, dtype=np.uint8)
+    padded[:len(heights)] = heights
+    padded = padded.reshape(-1, per_byte)
+    shifts = np.arange(per_byte, dtype=np.uint8) * bits
+    return np.bitwise_or.reduce(padded << shifts, axis=1).astype(np.uint8)
+
+
+def unpack(packed, bits, size):
+    """Inverse of pack: the first `size` heights stored in `packed`."""
+    per_byte = 8 // bits
+    shifts = np.arange(per_byte, dtype=np.uint8) * bits
+    heights = (packed[:, None] >> shifts) & np.uint8(2 ** bits - 1)
+    return heights.ravel()[:size]
+
+
+class SnapshotRecorder:
+    """
+    Keyframes and per-avalanche deltas of a pile's grid, with random access
+    to the grid after any recorded step.
+    """
+
+    def __init__(self, pile, interval=None):
+        """
+        Parameters
+        ==========
+        pile: SandPile (or subclass) to record; its current grid is step 0
+        interval: int or None, number of steps between keyframes; None
+            writes a keyframe whenever the deltas since the last one are as
+            large as a keyframe
+        """
+        from graphpile import from_pile
+        self.width = pile.width
+        self.height = pile.height
+        self.bits = _bits(pile.threshold)
+        self.interval = interval
+        self.lattice = from_pile(pile)
+        self._current = pile.grid.ravel().astype(np.uint8)
+        self._keyframes = []
+        self._keyframe_steps = GrowableArray(np.int64, 16)
+        self._indptr = GrowableArray(np.int64)
+        self._indptr.append(0)
+        self._indices = GrowableArray(np.int32)
+        self._values = GrowableArray(np.uint8)
+        self._add_keyframe(0)
+
+    @property
+    def steps(self):
+        """Number of avalanches recorded."""
+        return len(self._indptr) - 1
+
+    def _add_keyframe(self, step):
+        self._keyframes.append(pack(self._current, self.bits))
+        self._keyframe_steps.append(step)
+        self._since_keyframe = 0
+
+    def record(self, pile, start, odometer):
+        """Store the cells changed by one avalanche, given its odometer."""
+        grid = pile.grid.ravel()
+        start = pile.get_1D_coord(start)
+        if len(odometer) > 0:
+            toppled = np.fromiter(odometer.keys(), dtype=np.int64, count=len(odometer))
+            neighbors, _ = self.lattice.spread(toppled, np.ones(len(toppled), dtype=np.int64))
+            candidates = np.unique(np.concatenate([[start], toppled, neighbors]))
+        else:
+            candidates = np.array([start])
+        heights = grid[candidates].astype(np.uint8)
+        changed = heights != self._current[candidates]
+        indices, heights = candidates[changed], heights[changed]
+        self._current[indices] = heights
+        self._indices.extend(indices)
+        self._values.extend(heights)
+        self._indptr.append(len(self._indices))
+
+        # Each delta entry costs an int32 index and a uint8 height
+        self._since_keyframe += 5 * len(indices)
+        step = self.steps
+        if self.interval is not None:
+            due = step % self.interval == 0
+        else:
+            due = self._since_keyframe >= self._keyframes[0].nbytes
+        if due:
+            self._add_keyframe(step)
+
+    @property
+    def nbytes(self):
+        """Memory used by the keyframes and deltas."""
+        return sum(frame.nbytes for frame in self._keyframes) + sum(
+            column.nbytes for column in (self._keyframe_steps, self._indptr,
+                                         self._indices, self._values))
+
+    def grid(self, step):
+        """The grid right after `step` avalanches (0 for the initial grid)."""
+        if step < 0:
+            step += self.steps + 1
+        if not 0 <= step <= self.steps:
+            raise IndexError('step {} out of range 0..{}'.format(step, self.steps))
+        steps = self._keyframe_steps.array
+        frame = np.searchsorted(steps, step, side='right') - 1
+        heights = unpack(self._keyframes[frame], self.bits, self.width * self.height)
+        begin, end = self._indptr.array[steps[frame]], self._indptr.array[step]
+        indices = self._indices.array[begin:end]
+        values = self._values.array[begin:end]
+        # A cell may change several times; keep its last value
+        last = len(indices) - 1 - np.unique(indices[::-1], return_index=True)[1]
+        heights[indices[last]] = values[last]
+        return heights.reshape(self.width, self.height)
+
+    def iter_grids(self, start=0, stop=None):
+        """
+        Yield the grids after steps start, start + 1, ..., stop - 1, applying
+        the deltas one at a time (faster than calling grid for every step).
+        The same array is updated and yielded each time; copy it to keep it.
+        """
+        stop = self.steps + 1 if stop is None else stop
+        if start >= stop:
+            return
+        heights = self.grid(start).ravel()
+        indptr = self._indptr.array
+        yield heights.reshape(self.width, self.height)
+        for step in range(start + 1, stop):
+            begin, end = indptr[step - 1], indptr[step]
+            heights[self._indices.array[begin:end]] = self._values.array[begin:end]
+            yield heights.reshape(self.width, self.height)
@@ -0,0 +1,181 @@
+#################################################
+#   Author: Caleb Smith
+#   Student ID: 1027644
+#   November 9,2020
+#################################################
+"""
+Streaming power spectra of the mass and activity time series.
+
+A WelchPSD estimates the power spectral density of a signal by Welch's
+method: the signal is cut into overlapping segments, each segment is
+detrended and multiplied by a Hann window, and the squared magnitudes of
+their Fourier transforms are averaged. The values are fed in chunks of any
+length; only the running sum of the segment spectra and the values of the
+segment still being filled are kept, so memory stays the same for runs of
+any length. The result matches scipy.signal.welch with the same parameters.
+
+The signals of a pile are its histories, one value per avalanche: the mass
+after each avalanche and the activity (topples). A self-organized critical
+pile shows a power law S(f) ~ f^-alpha at low frequencies; fit_slope fits
+it on a log-log scale, as get_statistics does for the size distributions.
+
+Example usage:
+    spectra = analyse_spectra(pile)
+    frequencies, density = spectra['topples'].psd()
+    slope, intercept = fit_slope(frequencies, density)
+
+    spectra = analyse_spectra(Dataset('runs/open100').iter_chunks(),
+                              signals=('mass', 'topples'))
+"""
+import numpy as np
+
+# Signals of SandPile histories: the mass after each avalanche and the topples
+SIGNALS = ('mass', 'topples')
+# Values fed to the estimators at a time when reading from history lists
+BLOCK = 65536
+
+
+def hann(size):
+    """The periodic Hann window, as scipy.signal.get_window('hann', size)."""
+    return 0.5 - 0.5 * np.cos(2 * np.pi * np.arange(size) / size)
+
+
+class WelchPSD:
+    """
+    Welch estimate of the power spectral density of a signal fed in chunks.
+    """
+
+    def __init__(self, segment=1024, overlap=None, sampling=1.0, detrend='constant'):
+        """
+        Parameters
+        ==========
+        segment: int, values per segment; the frequency resolution is
+            sampling / segment
+        overlap: int, values shared by consecutive segments (by default
+            half a segment)
+        sampling: float, values per unit of time (1 per avalanche)
+        detrend: 'constant' to remove the mean of each segment, 'linear' to
+            remove its least squares line, or None
+        """
+        overlap = segment // 2 if overlap is None else overlap
+        if not 0 <= overlap < segment:
+            raise ValueError('overlap must be at least 0 and less than the segment')
+        if detrend not in ('constant', 'linear', None):
+            raise ValueError('Unknown detrend {!r}'.format(detrend))
+        self.segment = segment
+        self.step = segment - overlap
+        self.sampling = sampling
+        self.detrend = detrend
+        self.window = hann(segment)
+        self.samples = 0            # Values fed so far
+        self.segments = 0           # Segments averaged so far
+        self._power = np.zeros(segment // 2 + 1)
+        # Values not yet in a finished segment, at most one segment long
+        self._pending = np.zeros(0)
+
+    def update(self, values):
+        """Feed the next values of the signal."""
+        values = np.asarray(values, dtype=np.float64).ravel()
+        self.samples += len(values)
+        data = np.concatenate([self._pending, values])
+        count = (len(data) - self.segment) // self.step + 1 if len(data) >= self.segment else 0
+        if count > 0:
+            # The segments as a read-only view of the data
+            stride = data.strides[0]
+            self._add(np.lib.stride_tricks.as_strided(
+                data, (count, self.segment), (self.step * stride, stride), writeable=False))
+        self._pending = data[count * self.step:].copy()
+        return self
+
+    def _add(self, segments):
+        if self.detrend == 'constant':
+            segments = segments - segments.mean(axis=1, keepdims=True)
+        elif self.detrend == 'linear':
+            x = np.arange(self.segment) - (self.segment - 1) / 2
+            slope = segments @ x / np.dot(x, x)
+            segments = segments - segments.mean(axis=1, keepdims=True) - slope[:, None] * x
+        spectra = np.fft.rfft(segments * self.window, axis=1)
+        self._power += (spectra.real ** 2 + spectra.imag ** 2).sum(axis=0)
+        self.segments += len(segments)
+
+    def psd(self):
+        """
+        The frequencies and the one-sided power spectral density at each,
+        averaged over the segments fed so far.
+        """
+        if self.segments == 0:
+            raise ValueError('Not enough data: {} values for segments of {}'.format(
+                self.samples, self.segment))
+        density = self._power / (self.segments * self.sampling * np.sum(self.window ** 2))
+        # Fold the negative frequencies onto the positive ones; the zero and
+        # (for even segments) the Nyquist frequency have no counterpart
+        density[1:len(density) - (self.segment % 2 == 0)] *= 2
+        return np.fft.rfftfreq(self.segment, 1 / self.sampling), density
+
+
+def fit_slope(frequencies, density, low=None, high=None):
+    """
+    Fit log(density) = slope * log(frequency) + intercept between the
+    frequencies `low` and `high` (by default the lowest decade above zero).
+    Returns the slope, which is -alpha for a 1/f^alpha spectrum, and the
+    intercept.
+    """
+    low = frequencies[1] if low is None else low
+    high = 10 * low if high is None else high
+    keep = (frequencies >= low) & (frequencies <= high) & (density > 0)
+    if keep.sum() < 2:
+        raise ValueError('Fewer than 2 frequencies between {} and {}'.format(low, high))
+    slope, intercept = np.polyfit(np.log(frequencies[keep]), np.log(density[keep]), 1)
+    return slope, intercept
+
+
+def segment_size(samples, largest=1024, smallest=16):
+    """
+    The largest power of 2 up to `largest` giving at least 7 half
+    overlapping segments out of `samples` values, or None if even segments
+    of `smallest` values would give fewer.
+    """
+    size = largest
+    while size >= smallest:
+        if samples >= 4 * size:
+            return size
+        size //= 2
+    return None
+
+
+def analyse_spectra(source, signals=None, start=None, **options):
+    """
+    Return a dict mapping each signal to the WelchPSD of a pile's history,
+    of one chunk, or of an iterable of chunks (dicts of arrays or structured
+    arrays, as yielded by SandPile.iter_avalanches or Dataset.iter_chunks).
+
+    Parameters
+    ==========
+    source: SandPile, chunk or iterable of chunks
+    signals: names of the signals; defaults to SIGNALS for piles and to the
+        topples otherwise. For piles, the signal 'name' is the history
+        'name_history'
+    start: for piles, index of the first avalanche to include (by default
+        the pile's start index)
+    options: passed on to WelchPSD
+    """
+    if hasattr(source, 'mass_history'):
+        signals = SIGNALS if signals is None else signals
+        start = source.get_start_index() if start is None else start
+        estimators = {name: WelchPSD(**options) for name in signals}
+        for name, estimator in estimators.items():
+            history = getattr(source, name + '_history')
+            # The mass history starts with the mass before the first avalanche
+            offset = start + 1 if name == 'mass' else start
+            for first in range(offset, len(history), BLOCK):
+                estimator.update(history[first:first + BLOCK])
+        return estimators
+
+    signals = ('topples',) if signals is None else signals
+    estimators = {name: WelchPSD(**options) for name in signals}
+    if isinstance(source, (dict, np.ndarray)):
+        source = [source]
+    for chunk in source:
+        for name, estimator in estimators.items():
+            estimator.update(chunk[name])
+    return estimators
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+#################################################
+#   Author: Caleb Smith
+#   Student ID: 1027644
+#   November 9,2020
+#################################################
+"""Critical state pool
+A directory of critical (recurrent) states shared by every run and server on
+a machine, so warm-up to criticality is paid once per state instead of once
+per run. States are grouped by topology and size:
+
+    <root>/<topology>_<width>x<height>/<id>.npy    heights as uint8
+    <root>/<topology>_<width>x<height>/<id>.json   generation metadata
+
+The heights are stored as plain .npy files so they can be memory-mapped.
+A state is checked out by renaming its file, which is atomic, so several
+processes can share one pool without handing out the same state twice.
+
+Example usage:
+    pool = StatePool()
+    pool.fill('open', 100, 100, count=10)
+    pile = pool.checkout('open', 100, 100)
+
+    python statepool.py fill open 100 100 --count 10
+    python statepool.py list
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+import numpy as np
+
+from topologies import TOPOLOGIES, get_topology
+
+DEFAULT_ROOT = os.environ.get('SANDPILE_STATE_POOL', 'state_pool')
+METHODS = ('recurrent', 'drive')
+
+
+def _topology_name(topology):
+    """Accept either a topology name or a pile class."""
+    if isinstance(topology, str):
+        get_topology(topology)
+        return topology
+    return topology.topology
+
+
+class StatePool:
+    """
+    Persistent pool of critical states, keyed by (topology, width, height).
+    """
+
+    def __init__(self, root=None):
+        """
+        Parameters
+        ==========
+        root: directory of the pool; defaults to $SANDPILE_STATE_POOL or
+            ./state_pool
+        """
+        self.root = root if root is not None else DEFAULT_ROOT
+        self._refills = {}
+        self._lock = threading.Lock()
+
+    def _directory(self, topology, width, height):
+        return os.path.join(self.root, '{}_{}x{}'.format(
+            _topology_name(topology), width, height))
+
+    def _ids(self, directory):
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return []
+        return sorted(name[:-4] for name in names if name.endswith('.npy'))
+
+    def available(self, topology, width, height):
+        """Number of states waiting to be checked out."""
+        return len(self._ids(self._directory(topology, width, height)))
+
+    def keys(self):
+        """(topology, width, height) of every key with a directory in the pool."""
+        keys = []
+        for name in sorted(os.listdir(self.root)) if os.path.isdir(self.root) else []:
+            topology, _, size = name.rpartition('_')
+            if topology in TOPOLOGIES and 'x' in size:
+                width, height = size.split('x')
+                keys.append((topology, int(width), int(height)))
+        return keys
+
+    def states(self, topology, width, height):
+        """The generation metadata of every available state."""
+        directory = self._directory(topology, width, height)
+        states = []
+        for state_id in self._ids(directory):
+            try:
+                with open(os.path.join(directory, state_id + '.json')) as f:
+                    states.append(json.load(f))
+            except FileNotFoundError:
+                # Checked out since we listed the directory
+                continue
+        return states
+
+    def load(self, topology, width, height, state_id):
+        """Memory-map the heights of one state, without checking it out."""
+        path = os.path.join(self._directory(topology, width, height), state_id + '.npy')
+        return np.load(path, mmap_mode='r')
+
+    def add(self, pile, metadata=None):
+        """
+        Store the grid of `pile` in the pool and return its id.
+
+        Parameters
+        ==========
+        pile: SandPile (or subclass) in a critical state
+        metadata: dict of information about how the state was produced
+        """
+        directory = self._directory(pile.topology, pile.width, pile.height)
+        os.makedirs(directory, exist_ok=True)
+        state_id = uuid.uuid4().hex
+        metadata = dict(metadata or {}, id=state_id, topology=pile.topology,
+                        width=pile.width, height=pile.height,
+                        threshold=pile.threshold, mass=int(pile.mass()))
+        path = os.path.join(directory, state_id)
+        with open(path + '.json', 'w') as f:
+            json.dump(metadata, f, indent=2)
+        # Write under a temporary name so readers never see a partial grid;
+        # the .npy file appearing is what makes the state available
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, pile.grid.astype(np.uint8))
+        os.replace(path + '.tmp', path + '.npy')
+        return state_id
+
+    def generate(self, topology, width, height, method='recurrent', seed=None):
+        """
+        Produce a new critical pile and the metadata describing how.
+
+        Parameters
+        ==========
+        topology: topology name or pile class
+        width, height: int, size of the lattice
+        method: 'recurrent' to sample a uniform recurrent state directly, or
+            'drive' to drop sand on an empty grid until it is stationary
+        seed: int or None; None draws fresh entropy, recorded in the metadata
+        """
+        cls = get_topology(_topology_name(topology))
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        start = time.perf_counter()
+        metadata = {'method': method, 'seed': seed}
+        if method == 'recurrent':
+            pile = cls.recurrent(width, height, seed=seed)
+        elif method == 'drive':
+            pile = cls(width, height)
+            # A RandomState of its own, as refills run next to other threads
+            pile.rng = np.random.RandomState(seed % 2**32)
+            pile.simulate(100 * width * height, until_stationary=True)
+            metadata['drops'] = len(pile.topples_history)
+            metadata['burn_in'] = pile.burn_in
+        else:
+            raise ValueError('Unknown method {!r}; expected one of {}'.format(
+                method, ', '.join(METHODS)))
+        metadata['seconds'] = time.perf_counter() - start
+        metadata['created'] = datetime.now(timezone.utc).isoformat()
+        metadata['numpy'] = np.__version__
+        return pile, metadata
+
+    def fill(self, topology, width, height, count, method='recurrent'):
+        """Generate states until `count` are available; returns how many were added."""
+        added = 0
+        while self.available(topology, width, height) < count:
+            pile, metadata = self.generate(topology, width, height, method)
+            self.add(pile, metadata)
+            added += 1
+        return added
+
+    def refill_async(self, topology, width, height, count, method='recurrent'):
+        """
+        Fill the pool up to `count` states in a background thread, unless a
+        refill of the same key is already running. Returns the thread.
+        """
+        key = (_topology_name(topology), width, height)
+        with self._lock:
+            thread = self._refills.get(key)
+            if thread is None or not thread.is_alive():
+                thread = threading.Thread(target=self.fill, daemon=True,
+                                          args=(topology, width, height, count, method))
+                self._refills[key] = thread
+                thread.start()
+        return thread
+
+    def wait(self, topology=None, width=None, height=None, timeout=None):
+        """
+        Wait for the background refill of one key to finish, or for all of
+        them if no key is given.
+        """
+        with self._lock:
+            if topology is None:
+                threads = list(self._refills.values())
+            else:
+                key = (_topology_name(topology), width, height)
+                threads = [self._refills[key]] if key in self._refills else []
+        for thread in threads:
+            thread.join(timeout)
+
+    def refilling(self):
+        """Number of refills running in the background."""
+        with self._lock:
+            return sum(thread.is_alive() for thread in self._refills.values())
+
+    def claim(self, topology, width, height):
+        """
+        Remove one state from the pool and return its heights and metadata,
+        or None if the pool has no state for this key.
+        """
+        directory = self._directory(topology, width, height)
+        for state_id in self._ids(directory):
+            path = os.path.join(directory, state_id)
+            claimed = '{}.claimed-{}'.format(path, uuid.uuid4().hex)
+            try:
+                os.rename(path + '.npy', claimed)
+            except FileNotFoundError:
+                # Another process got there first; try the next state
+                continue
+            grid = np.load(claimed)
+            os.remove(claimed)
+            try:
+                with open(path + '.json') as f:
+                    metadata = json.load(f)
+                os.remove(path + '.json')
+            except FileNotFoundError:
+                metadata = {'id': state_id}
+            return grid, metadata
+        return None
+
+    def checkout(self, topology, width, height, generate=True):
+        """
+        Return a pile in a critical state taken out of the pool. Its
+        generation metadata is kept in the pile's `origin` attribute.
+
+        Parameters
+        ==========
+        topology: topology name or pile class
+        width, height: int, size of the lattice
+        generate: bool, whether to generate a state on the spot when the
+            pool is empty (otherwise a LookupError is raised)
+        """
+        cls = get_topology(_topology_name(topology))
+        claimed = self.claim(topology, width, height)
+        if claimed is None:
+            if not generate:
+                raise LookupError('No {} {}x{} state in the pool at {}'.format(
+                    _topology_name(topology), width, height, self.root))
+            pile, metadata = self.generate(topology, width, height)
+        else:
+            grid, metadata = claimed
+            pile = cls.from_grid(grid)
+        pile.origin = metadata
+        return pile
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--root', default=None,
+                        help='pool directory (default $SANDPILE_STATE_POOL or ./state_pool)')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    fill = commands.add_parser('fill', help='generate states until the pool holds enough')
+    fill.add_argument('topology', choices=sorted(TOPOLOGIES))
+    fill.add_argument('width', type=int)
+    fill.add_argument('height', type=int)
+    fill.add_argument('--count', type=int, default=10)
+    fill.add_argument('--method', choices=METHODS, default='recurrent')
+
+    commands.add_parser('list', help='show how many states each key holds')
+
+    args = parser.parse_args(argv)
+    pool = StatePool(args.root)
+    if args.command == 'fill':
+        added = pool.fill(args.topology, args.width, args.height, args.count, args.method)
+        print('Added {} states to {}'.format(added, pool._directory(
+            args.topology, args.width, args.height)))
+    else:
+        for key in pool.keys():
+            print('{:>12} {:>5} x {:<5} {:>6} states'.format(
+                key[0], key[1], key[2], pool.available(*key)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,101 @@
+#################################################
+#   Author: Caleb Smith
+#   Student ID: 1027644
+#   November 9,2020
+#################################################
+"""
+Online detection of the end of the pre-critical transient.
+
+The series of interest (e.g. the density and the topples of every drop) are
+cut into consecutive windows. The series are considered stationary once, for
+`patience` window boundaries in a row, the mean of every series moved by less
+than `tolerance` standard deviations (measured within the windows) from one
+window to the next. While the pile is still filling up the density rises by
+one grain per drop, which moves the mean by several standard deviations per
+window, so the test only passes once the pile has stopped growing.
+Only the running sums of the current window and the statistics of the
+previous one are kept, so memory does not depend on the length of the run.
+
+Example usage:
+    detector = StationarityDetector(window=400)
+    for density in densities:
+        if detector.update(density):
+            break
+    detector.burn_in
+"""
+import numpy as np
+
+
+class StationarityDetector:
+    """
+    Detects when one or more series stop drifting, using windowed means and
+    variances.
+    """
+
+    def __init__(self, window=1000, tolerance=1.0, patience=3):
+        """
+        Parameters
+        ==========
+        window: int, number of samples per window
+        tolerance: float, largest allowed change of a window mean, in units of
+            the standard deviation within the two windows
+        patience: int, number of consecutive passing window boundaries needed
+        """
+        if window < 2:
+            raise ValueError('window must hold at least two samples')
+        self.window = window
+        self.tolerance = tolerance
+        self.patience = patience
+        self.count = 0          # Samples seen so far
+        self.burn_in = None     # Index of the first stationary sample
+        self._sums = None
+        self._squares = None
+        self._previous = None   # (means, variances) of the last full window
+        self._passed = 0
+
+    @property
+    def stationary(self):
+        return self.burn_in is not None
+
+    def update(self, *values):
+        """
+        Add one sample of each series; returns whether the series are
+        stationary (which stays true once reached).
+        """
+        if self._sums is None:
+            self._sums = np.zeros(len(values))
+            self._squares = np.zeros(len(values))
+        values = np.asarray(values, dtype=np.float64)
+        self._sums += values
+        self._squares += values * values
+        self.count += 1
+        if self.count % self.window == 0:
+            self._close_window()
+        return self.stationary
+
+    def update_many(self, *series):
+        """Add several samples at once; each argument is one series."""
+        for values in zip(*series):
+            if self.update(*values):
+                break
+        return self.stationary
+
+    def _close_window(self):
+        means = self._sums / self.window
+        variances = np.maximum(self._squares / self.window - means * means, 0)
+        self._sums[:] = 0
+        self._squares[:] = 0
+
+        if self._previous is not None and not self.stationary:
+            previous_means, previous_variances = self._previous
+            spread = np.sqrt((variances + previous_variances) / 2)
+            drift = np.abs(means - previous_means)
+            # A constant series has no spread; it is stationary if it is flat
+            if np.all((drift <= self.tolerance * spread) | ((spread == 0) & (drift == 0))):
+                self._passed += 1
+            else:
+                self._passed = 0
+            if self._passed >= self.patience:
+                # The first window of the passing run starts the stationary part
+                self.burn_in = self.count - (self.patience + 1) * self.window
+        self._previous = (means, variances)
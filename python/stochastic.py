@@ -0,0 +1,310 @@
+#################################################
+#   Author: Caleb Smith
+#   Student ID: 1027644
+#   November 9,2020
+#################################################
+"""
+Sandpiles with stochastic toppling rules, relaxed in vectorized sweeps.
+
+Two rules of other universality classes than the deterministic BTW model:
+
+    Manna             a site holding 2 grains or more topples by sending 2
+                      grains, each to one of its 4 neighbors chosen at random
+    RandomThreshold   BTW toppling (one grain to each neighbor), but every
+                      site topples from its own random threshold, drawn
+                      again after each topple (annealed) or once (quenched)
+
+The randomness comes from counter-based streams: the choices made by the
+k-th topple of site i are a hash of (seed, i, k) and nothing else, so they
+do not depend on the order in which sites topple. Such piles keep the
+abelian property: the final grid and the number of topples of each site
+are the same whatever the order, and the results of a seed are the same
+whichever engine relaxes it. The random drop sites and initial grid come
+from streams of the same seed, not from np.random.
+
+The engine topples every unstable site once per sweep, with NumPy
+operations on the arrays of unstable sites, and only looks at the sites
+which toppled or received grains in the previous sweep, so small
+avalanches on large lattices stay cheap and whole grids relax in bulk.
+
+StochasticSandPile is a SandPile on any topology (see topologies.py) using
+one of the rules, so the histories, simulate, iter_avalanches, track
+(duration only) and the analysis and graphing methods all apply. Its area
+and length count the sites which toppled rather than every site visited.
+
+Example usage:
+    pile = StochasticSandPile(100, 100, Manna(), topology='open', seed=1)
+    pile.simulate(10000)
+    pile.graph('manna_output/')
+"""
+import numpy as np
+
+from sandpile import SandPile
+from topologies import get_topology
+
+# Streams of random numbers drawn from a seed
+TOPPLE, THRESHOLD, DROP, INITIAL = 1, 2, 3, 4
+# Moves to the neighbors Left, Right, Up and Down, as SandPile.get_neighbors
+DX = np.array([-1, 1, 0, 0])
+DY = np.array([0, 0, -1, 1])
+_GOLDEN = np.uint64(0x9e3779b97f4a7c15)
+
+
+def _mix(x):
+    """The splitmix64 finalizer: a bijection of uint64 scrambling every bit."""
+    x = x ^ (x >> np.uint64(30))
+    x = x * np.uint64(0xbf58476d1ce4e5b9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+def counter_hash(seed, stream, index, counter):
+    """
+    64 random bits for every (index, counter) pair of a stream of a seed;
+    the same inputs always give the same bits.
+
+    Parameters
+    ==========
+    seed: non-negative int
+    stream: int, one of the streams (TOPPLE, THRESHOLD, DROP, INITIAL)
+    index: int or array, the site (below 2^32)
+    counter: int or array, how many numbers the site drew before (below 2^32)
+    """
+    with np.errstate(over='ignore'):
+        key = _mix(np.asarray(seed, dtype=np.uint64) * _GOLDEN + np.uint64(stream))
+        words = (np.asarray(index, dtype=np.uint64) << np.uint64(32)) | \
+            np.asarray(counter, dtype=np.uint64)
+        return _mix(key ^ _mix(words))
+
+
+class Manna:
+    """
+    The Manna model: sites topple from 2 grains, sending each of 2 grains
+    to a neighbor chosen uniformly at random.
+    """
+    name = 'manna'
+    threshold = 2
+    lost = 2
+
+    def thresholds(self, seed, sites, counters):
+        return self.threshold
+
+    def directions(self, hashes):
+        """The direction (an index of DX, DY) of every grain of each topple."""
+        return [hashes & np.uint64(3), (hashes >> np.uint64(2)) & np.uint64(3)]
+
+
+class RandomThreshold:
+    """
+    BTW toppling from random thresholds, uniform between `low` and `high`.
+    A toppling site always loses 4 grains, so `low` is at least 4.
+    """
+    name = 'random_threshold'
+    lost = 4
+
+    def __init__(self, low=4, high=7, annealed=True):
+        """
+        Parameters
+        ==========
+        low, high: int, smallest and largest thresholds
+        annealed: bool, whether a site draws a new threshold after each of
+            its topples, rather than keeping one for good
+        """
+        if not self.lost <= low <= high:
+            raise ValueError('Thresholds must satisfy {} <= low <= high'.format(self.lost))
+        self.low = low
+        self.high = high
+        self.annealed = annealed
+
+    @property
+    def threshold(self):
+        return self.high
+
+    def thresholds(self, seed, sites, counters):
+        """The threshold of each site for its next topple."""
+        hashes = counter_hash(seed, THRESHOLD, sites, counters if self.annealed else 0)
+        return self.low + (hashes % np.uint64(self.high - self.low + 1)).astype(np.int64)
+
+    def directions(self, hashes):
+        return [np.full(len(hashes), d) for d in range(len(DX))]
+
+
+RULES = {Manna.name: Manna, RandomThreshold.name: RandomThreshold}
+
+
+def relax(grid, counters, rule, seed, periodic=(False, False), sinks=None, candidates=None):
+    """
+    Topple every unstable site once per sweep until `grid` is stable. The
+    grid and `counters`, the number of times each site toppled so far, are
+    updated in place. Returns the flat index of the site of every topple,
+    in order, and the number of sweeps in which something toppled.
+
+    Parameters
+    ==========
+    grid, counters: C-contiguous int64 arrays of shape (width, height)
+    rule: Manna or RandomThreshold
+    seed: int, seed of the random streams
+    periodic: pair of bools, whether the width and height axes wrap around;
+        grains leaving through a non-periodic boundary are lost
+    sinks: optional boolean (width, height) array of sites which belong to
+        the sink: grains reaching them are removed and they never topple
+    candidates: flat indices of the only sites which may be unstable, or
+        None to check every site
+    """
+    if not (grid.flags.c_contiguous and counters.flags.c_contiguous):
+        raise ValueError('The grid and counters are updated in place, so must be C-contiguous')
+    width, height = grid.shape
+    heights, odometer = grid.reshape(-1), counters.reshape(-1)
+    sinks = None if sinks is None or not sinks.any() else sinks.reshape(-1)
+    if candidates is None:
+        candidates = np.arange(width * height)
+    toppled = []
+    while len(candidates) > 0:
+        unstable = candidates[heights[candidates] >=
+                              rule.thresholds(seed, candidates, odometer[candidates])]
+        if sinks is not None:
+            unstable = unstable[~sinks[unstable]]
+        if len(unstable) == 0:
+            break
+        hashes = counter_hash(seed, TOPPLE, unstable, odometer[unstable])
+        heights[unstable] -= rule.lost
+        odometer[unstable] += 1
+        toppled.append(unstable)
+
+        x, y = unstable // height, unstable % height
+        targets = []
+        for directions in rule.directions(hashes):
+            directions = directions.astype(np.intp)
+            tx, ty = x + DX[directions], y + DY[directions]
+            if periodic[0]:
+                tx %= width
+            if periodic[1]:
+                ty %= height
+            inside = (tx >= 0) & (tx < width) & (ty >= 0) & (ty < height)
+            targets.append(tx[inside] * height + ty[inside])
+        targets = np.concatenate(targets)
+        np.add.at(heights, targets, 1)
+        if sinks is not None:
+            heights[targets[sinks[targets]]] = 0
+        # Only the sites which toppled or received grains can be unstable now
+        candidates = np.unique(np.concatenate([unstable, targets]))
+
+    if len(toppled) == 0:
+        return np.zeros(0, dtype=np.intp), 0
+    return np.concatenate(toppled), len(toppled)
+
+
+class StochasticSandPile(SandPile):
+    """
+    A sandpile on one of the topologies, toppling by a stochastic rule.
+    """
+
+    def __init__(self, width, height, rule=None, topology='open', seed=0, random=False):
+        """
+        Parameters
+        ==========
+        width, height: int, size of the grid
+        rule: Manna (the default) or RandomThreshold
+        topology: name of the boundary condition (see topologies.py)
+        seed: non-negative int, seed of every random choice of the pile
+        random: bool, whether to start from random heights below the
+            smallest threshold instead of an empty grid
+        """
+        self.rule = Manna() if rule is None else rule
+        self.lattice = get_topology(topology)(width, height)
+        self.topology = self.lattice.topology
+        self.periodic = self.lattice.periodic
+        self.seed = seed
+        SandPile.__init__(self, width, height, threshold=self.rule.threshold)
+        self.counters = np.zeros((width, height), dtype=np.int64)
+        self.drops = 0              # Random drop sites drawn so far
+        self._sinks = self.lattice.sink_mask()
+        self.grid = self.grid.astype(np.int64)
+        if random:
+            smallest = getattr(self.rule, 'low', self.rule.threshold)
+            hashes = counter_hash(seed, INITIAL, np.arange(width * height), 0)
+            self.grid[...] = (hashes % np.uint64(smallest)).astype(np.int64).reshape(
+                width, height)
+            self.grid[self._sinks] = 0
+            self.pre_critical = False
+
+    def is_sink(self, site):
+        return self.lattice.is_sink(site)
+
+    def sink_mask(self):
+        return self._sinks.copy()
+
+    def _drop_site(self, site=None):
+        """Return `site` as a tuple, or the next random site of the seed."""
+        if site is not None:
+            return tuple(site)
+        index = int(counter_hash(self.seed, DROP, 0, self.drops) %
+                    np.uint64(self.width * self.height))
+        self.drops += 1
+        return (index // self.height, index % self.height)
+
+    def _distances(self, start, sites):
+        """Manhattan distances from `start` to the flat `sites`, wrapping
+        around periodic axes."""
+        total = 0
+        for coordinate, origin, size, wraps in zip(
+                (sites // self.height, sites % self.height), start,
+                (self.width, self.height), self.periodic):
+            distance = np.abs(coordinate - origin)
+            total = total + (np.minimum(distance, size - distance) if wraps else distance)
+        return total
+
+    def _relax_parallel(self, start, odometer=None):
+        """
+        Relax the grid from `start` in vectorized sweeps (see relax). Returns
+        the number of topples, the number of distinct sites which toppled,
+        the largest distance from `start` to one of them and the number of
+        sweeps.
+        """
+        start = tuple(start)
+        if self._sinks[start]:
+            # Grains dropped into the sink leave the pile at once
+            self.grid[start] = 0
+            return 0, 0, 0, 0
+        candidates = np.array([start[0] * self.height + start[1]])
+        toppled, sweeps = relax(self.grid, self.counters, self.rule, self.seed, self.periodic,
+                                self._sinks, candidates)
+        if len(toppled) == 0:
+            return 0, 0, 0, 0
+        sites, counts = np.unique(toppled, return_counts=True)
+        if odometer is not None:
+            for site, count in zip(sites.tolist(), counts.tolist()):
+                odometer[site] = odometer.get(site, 0) + count
+        return len(toppled), len(sites), int(self._distances(start, sites).max()), sweeps
+
+    def _relax(self, start, odometer=None):
+        """As _relax_parallel, without the number of sweeps."""
+        return self._relax_parallel(start, odometer)[:3]
+
+    def _relaxer(self, duration=False, waves=False):
+        if waves:
+            raise ValueError('Waves are only defined for the deterministic BTW rule')
+        return SandPile._relaxer(self, duration)
+
+    def stabilize(self, engine='bulk'):
+        """
+        Topple until every site is stable, checking the whole grid. There
+        is only the vectorized engine, so `engine` is ignored.
+        """
+        relax(self.grid, self.counters, self.rule, self.seed, self.periodic, self._sinks)
+
+    @classmethod
+    def recurrent(cls, width, height, seed=None):
+        raise TypeError('Recurrent states are sampled for the BTW rule only; '
+                        'drive a stochastic pile to its stationary state instead')
+
+    @classmethod
+    def from_grid(cls, grid, rule=None, topology='open', seed=0):
+        """A pile starting from a copy of `grid` (possibly unstable)."""
+        grid = np.asarray(grid)
+        pile = cls(grid.shape[0], grid.shape[1], rule, topology, seed)
+        pile.grid[...] = grid
+        pile.pre_critical = False
+        pile.mass_history = [pile.mass()]
+        return pile
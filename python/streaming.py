@@ -0,0 +1,188 @@
+#################################################
+#   Author: Caleb Smith
+#   Student ID: 1027644
+#   November 9,2020
+#################################################
+"""
+Ensembles and scaling sweeps reported record by record while they run.
+
+The generators below run an ensemble (as SandPile.ensemble_simulate) or a
+finite-size scaling sweep (see scaling.py) and yield plain dicts which can
+be sent as JSON as soon as they are made:
+
+    member    one ensemble member: its topples, area, length and mass
+    chunk     one finished chunk of a sweep: its size, seconds and the
+              relative error of that size so far
+    summary   every `every` members or chunks: the merged histograms, their
+              moments and the exponents estimated from them so far
+    done      the last record: why the run stopped and how much it did
+
+to_ndjson turns them into newline-delimited JSON, one line per record, for
+a streamed HTTP response (see the /ensemble and /sweep routes of app.py).
+Nothing is run ahead of the consumer, so a client which closes the stream
+stops the run; an ensemble also stops by itself once the error of its
+first exponent is below `tolerance`.
+
+Example usage:
+    for record in ensemble_records('open', 20, 20, runs=1000, every=100):
+        print(record['type'])
+"""
+import json
+import math
+import time
+from collections import Counter
+
+import numpy as np
+
+from workqueue import ENSEMBLE_OBSERVABLES, ensemble_shard
+
+# Observables of ensemble members whose exponents are estimated
+FITTED = ('area', 'topples', 'length')
+
+
+def jsonable(value):
+    """`value` with NumPy types made plain, and NaN and infinities as None."""
+    if isinstance(value, dict):
+        return {str(key): jsonable(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [jsonable(item) for item in value]
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, (float, np.floating)):
+        return float(value) if math.isfinite(value) else None
+    return value
+
+
+def to_ndjson(records):
+    """Yield every record as one line of JSON."""
+    for record in records:
+        yield json.dumps(jsonable(record), separators=(',', ':')) + '\n'
+
+
+def _histogram(counter):
+    values = np.array(sorted(counter), dtype=np.int64)
+    return values, np.array([counter[value] for value in values], dtype=np.int64)
+
+
+def fit_tail(histogram, drops, lower, upper, per_octave=4):
+    """
+    Estimate tau of P(s) ~ s^-tau for one lattice size, from the slope of
+    the logarithmically binned distribution between `lower` and `upper`
+    (below the cutoff of the lattice). Returns tau and its standard error,
+    or None with fewer than 4 bins to fit.
+    """
+    from scaling import log_binned
+    centers, density = log_binned(histogram, drops, per_octave, lower)
+    keep = centers <= upper
+    # The error is estimated from the residuals, so a line needs 4 points
+    if keep.sum() < 4:
+        return None
+    (slope, _), covariance = np.polyfit(np.log(centers[keep]), np.log(density[keep]), 1,
+                                        cov=True)
+    return -slope, np.sqrt(covariance[0, 0])
+
+
+def ensemble_records(topology, width, height, runs, n=1, site=None, seed=0, every=10,
+                     tolerance=None):
+    """
+    Run an ensemble member by member (each drops `n` grains on a uniformly
+    random recurrent state, seeded from (seed, member) so any member can be
+    run again alone) and yield its records.
+
+    Parameters
+    ==========
+    topology: name of the boundary condition (see topologies.py)
+    width, height: int, size of the lattices
+    runs: int, number of members
+    n: int, grains dropped on each member
+    site: tuple of coordinates to drop on, or None for random sites
+    seed: int, seed of the ensemble
+    every: int, members between summaries
+    tolerance: float or None, stop once the standard error of the area
+        exponent is at most this
+    """
+    # Tails are fitted above the lattice scale and below the cutoff
+    ranges = {'area': (4, width * height / 4), 'topples': (4, width * height / 4),
+              'length': (2, (width + height) / 4)}
+    histograms = {name: Counter() for name in ENSEMBLE_OBSERVABLES}
+    started = time.perf_counter()
+    for member in range(runs):
+        begin = time.perf_counter()
+        results = ensemble_shard(topology, width, height, 1, n, site, seed=[seed, member])
+        record = {name: int(results[name][0]) for name in ENSEMBLE_OBSERVABLES}
+        for name, value in record.items():
+            histograms[name][value] += 1
+        yield dict(type='member', index=member, seconds=time.perf_counter() - begin, **record)
+
+        if (member + 1) % every == 0 or member + 1 == runs:
+            summary = _ensemble_summary(histograms, member + 1, ranges)
+            yield summary
+            exponent = summary['exponents']['area']
+            if tolerance is not None and exponent is not None and \
+                    exponent['tau_error'] <= tolerance:
+                yield {'type': 'done', 'reason': 'converged', 'members': member + 1,
+                       'seconds': time.perf_counter() - started}
+                return
+    yield {'type': 'done', 'reason': 'finished', 'members': runs,
+           'seconds': time.perf_counter() - started}
+
+
+def _ensemble_summary(histograms, members, ranges):
+    summary = {'type': 'summary', 'members': members, 'histograms': {}, 'moments': {},
+               'exponents': {}}
+    for name, counter in histograms.items():
+        values, counts = _histogram(counter)
+        mean = np.dot(counts, values) / members
+        summary['histograms'][name] = {'values': values, 'counts': counts}
+        summary['moments'][name] = {
+            'mean': mean, 'variance': np.dot(counts, (values - mean) ** 2) / members}
+    for name in FITTED:
+        fit = fit_tail(_histogram(histograms[name]), members, *ranges[name])
+        summary['exponents'][name] = None if fit is None else \
+            {'tau': fit[0], 'tau_error': fit[1]}
+    return summary
+
+
+def sweep_records(sweep, every=1, bootstrap=0):
+    """
+    Run a scaling.ScalingSweep chunk by chunk and yield its records. The
+    summaries hold the logarithmically binned distribution of every
+    observable at every size and, once two sizes have data, the exponents
+    fitted by data collapse.
+
+    Parameters
+    ==========
+    sweep: scaling.ScalingSweep to run
+    every: int, chunks between summaries
+    bootstrap: int, resamples for the errors of the exponents (0 for none)
+    """
+    from scaling import log_binned
+    started = time.perf_counter()
+    finished = 0
+    for size in sweep.iter_run():
+        finished += 1
+        yield {'type': 'chunk', 'size': size, 'chunk': len(sweep.chunks[size]),
+               'seconds': sweep.seconds[size][-1], 'error': sweep.error(size)}
+        if finished % every != 0 and sweep.next_size() is not None:
+            continue
+        summary = {'type': 'summary', 'chunks': {}, 'histograms': {}, 'exponents': {}}
+        sizes = [size for size in sweep.sizes if sweep.chunks[size]]
+        for size in sizes:
+            drops = sum(sweep.drops[size])
+            summary['chunks'][size] = len(sweep.chunks[size])
+            summary['histograms'][size] = {}
+            for name in sweep.observables:
+                centers, density = log_binned(sweep.histogram(size, name), drops)
+                summary['histograms'][size][name] = {'s': centers, 'density': density}
+        for name in sweep.observables:
+            summary['exponents'][name] = None
+            if len(sizes) >= 2:
+                try:
+                    fit = sweep.fit(name, bootstrap=bootstrap)
+                except (ValueError, np.linalg.LinAlgError):
+                    continue    # Not enough of a distribution to fit yet
+                summary['exponents'][name] = {key: fit[key] for key in (
+                    'tau', 'D', 'tau_error', 'D_error', 'moment_tau', 'moment_D')}
+        yield summary
+    yield {'type': 'done', 'reason': 'finished', 'chunks': finished,
+           'seconds': time.perf_counter() - started}
@@ -4,11 +4,40 @@
 #   November 9, 2020
 #################################################
 import unittest
+import os
+import subprocess
+import sys
+import json
 import numpy as np
-from sandpile import SandPile
+from sandpile import SandPile, avalanche_dtype
 from cylindrical import CylindricalSandPile
 from hourglass import HourGlassSandPile
 from sandpilenumba import SandPile as NSP
+import benchmark
+import bulk
+import bitslice
+import footprint
+import copy
+import tempfile
+from statepool import StatePool
+from dataset import DatasetWriter, Dataset
+import snapshots
+import analysis
+import scaling
+import spectrum
+import streaming
+import stochastic
+import conformance
+from infinite import InfiniteSandPile
+from workqueue import WorkQueue, ensemble_shard
+import multiprocessing
+import graphpile
+import recurrent
+from collections import Counter
+from stationarity import StationarityDetector
+from profiling import Profiler
+import io
+from unittest import mock
 
 class TestSandPile(unittest.TestCase):
     def test_get_neighbors(self):
@@ -161,7 +190,1160 @@ class TestSandPile(unittest.TestCase):
         pile.grid=np.array(start)
         pile.simulate(1, site=(0,0))
         self.assertEqual((pile.grid == expected).all(), True)
-        #self.assertEqual((pile.area_history == [9]), True)
+        self.assertEqual(list(pile.area_history), [9])
+
+    def test_numba_warmup(self):
+        import sandpilenumba
+        report = sandpilenumba.warmup()
+        self.assertEqual(tuple(report), sandpilenumba.KERNELS)
+        for source, seconds in report.values():
+            self.assertIn(source, ('cache', 'compiled', 'memory'))
+        # Everything is loaded now, and SandPile uses the same types
+        pile = NSP(5, 5, random=True)
+        pile.simulate(20)
+        self.assertEqual(len(sandpilenumba.fast_avalanche.overloads), 1)
+        self.assertEqual({source for source, _ in sandpilenumba.warmup().values()}, {'memory'})
+
+class TestAvalancheStream(unittest.TestCase):
+    def test_matches_simulate(self):
+        for cls in (SandPile, CylindricalSandPile, HourGlassSandPile):
+            np.random.seed(4)
+            pile = cls(8, 8, random=True)
+            pile.simulate(500)
+
+            np.random.seed(4)
+            streamed = cls(8, 8, random=True)
+            chunks = list(streamed.iter_avalanches(500, chunk_size=128,
+                                                   duration=True))
+            self.assertEqual([len(chunk) for chunk in chunks], [128, 128, 128, 116])
+            records = np.concatenate(chunks)
+            self.assertEqual(records.dtype, avalanche_dtype(duration=True))
+
+            self.assertEqual((streamed.grid == pile.grid).all(), True)
+            self.assertEqual(list(records['topples']), pile.topples_history)
+            self.assertEqual(list(records['area']), pile.area_history)
+            self.assertEqual(list(records['length']), pile.length_history)
+            # Grains lost are the dropped grain minus the change in mass
+            lost = 1 - np.diff(pile.mass_history[1:])
+            self.assertEqual((records['loss'][1:] == lost).all(), True)
+            self.assertEqual((records['duration'] <= records['topples']).all(), True)
+            # Nothing is kept in the history lists unless asked for
+            self.assertEqual(streamed.topples_history, [])
+
+    def test_duration(self):
+        # A single topple in the corner is one sweep; it pushes
+        # (1, 0) over the threshold, which topples in a second sweep
+        pile = SandPile(4, 4)
+        pile.grid[0, 0] = 3
+        pile.grid[1, 0] = 3
+        records = next(pile.iter_avalanches(1, site=(0, 0), duration=True))
+        self.assertEqual(records['duration'][0], 2)
+        self.assertEqual(records['topples'][0], 2)
+
+    def test_waves(self):
+        # (0, 0) topples, then (1, 0), which sends (0, 0) back over the
+        # threshold: held back until the first wave ends, it starts a second
+        pile = SandPile(2, 1)
+        pile.grid[:] = 3
+        records = next(pile.iter_avalanches(1, n=5, site=(0, 0), waves=True))
+        self.assertEqual(records.dtype, avalanche_dtype(waves=True))
+        self.assertEqual(records['waves'][0], 2)
+        self.assertEqual(records['last_wave'][0], 1)
+        self.assertEqual(records['topples'][0], 3)
+        self.assertEqual(list(pile.grid[:, 0]), [1, 1])
+
+    def test_track(self):
+        for cls in (SandPile, CylindricalSandPile, HourGlassSandPile):
+            np.random.seed(5)
+            pile = cls(8, 8, random=True)
+            pile.simulate(300)
+
+            np.random.seed(5)
+            waves = cls(8, 8, random=True)
+            waves.simulate(100)
+            waves.track(waves=True)
+            waves.simulate(200)
+            self.assertEqual((waves.grid == pile.grid).all(), True)
+            self.assertEqual(waves.topples_history, pile.topples_history)
+            self.assertEqual(waves.area_history, pile.area_history)
+            self.assertEqual(len(waves.waves_history), 200)
+            self.assertEqual(sum(waves.wave_size_history), sum(pile.topples_history[100:]))
+            sizes = waves.tracked_history('wave_size', start=299)
+            self.assertEqual(sizes.sum(), pile.topples_history[299])
+            self.assertEqual(len(sizes), waves.waves_history[-1])
+
+            np.random.seed(5)
+            timed = cls(8, 8, random=True)
+            timed.track(duration=True)
+            for _ in timed.iter_avalanches(300, record=True):
+                pass
+            self.assertEqual(timed.length_history, pile.length_history)
+            self.assertEqual(len(timed.duration_history), 300)
+            columns = analysis.pile_columns(timed, start=10)
+            self.assertEqual(len(columns['duration']), len(columns['topples']))
+            self.assertEqual(analysis.analyse(timed, observables=('topples', 'duration')).count,
+                             300 - timed.get_start_index())
+        with self.assertRaises(ValueError):
+            SandPile(4, 4).track(duration=True, waves=True)
+        with self.assertRaises(ValueError):
+            SandPile(4, 4).tracked_history('duration')
+
+    def test_endless(self):
+        pile = SandPile(6, 6)
+        stream = pile.iter_avalanches(chunk_size=10, record=True)
+        for _ in range(3):
+            next(stream)
+        self.assertEqual(len(pile.topples_history), 30)
+
+class TestFootprints(unittest.TestCase):
+    def test_odometer(self):
+        pile = SandPile(4, 4)
+        pile.grid[0, 0] = 3
+        pile.grid[1, 0] = 3
+        pile.grid[0, 1] = 2
+        store = pile.record_footprints()
+        pile.drop_sand(1, (0, 0))
+        pile.drop_sand(1, (3, 3))
+
+        self.assertEqual(len(store), 2)
+        expected = np.zeros((4, 4), dtype=int)
+        expected[0, 0] = 1
+        expected[1, 0] = 1
+        self.assertEqual((store.odometer(0) == expected).all(), True)
+        self.assertEqual(list(store.sizes()), [2, 0])
+        self.assertEqual(list(store.topples()), pile.topples_history)
+        self.assertEqual(list(footprint.boundary_hits(store)), [True, False])
+
+    def test_boundary_topologies(self):
+        # The x edges of a cylinder wrap around, so only the y edges lose grains
+        pile = CylindricalSandPile(6, 6)
+        store = pile.record_footprints()
+        pile.grid[0, 3] = 3
+        pile.drop_sand(1, (0, 3))
+        pile.grid[2, 0] = 3
+        pile.drop_sand(1, (2, 0))
+        self.assertEqual(list(footprint.boundary_hits(store)), [False, True])
+        self.assertEqual(store.boundary[:, [0, -1]].all(), True)
+        self.assertEqual(store.boundary[1:-1, 1:-1].any(), False)
+
+        # The hourglass has no edges; only the sites around its hole lose grains
+        pile = HourGlassSandPile(10, 10)
+        store = pile.record_footprints()
+        pile.grid[0, 0] = 3
+        pile.drop_sand(1, (0, 0))
+        pile.grid[3, 5] = 3
+        pile.drop_sand(1, (3, 5))
+        self.assertEqual(list(footprint.boundary_hits(store)), [False, True])
+        self.assertEqual(store.boundary.sum(), 12)
+        self.assertEqual((store.boundary & pile.sink_mask()).any(), False)
+
+    def test_analyses(self):
+        np.random.seed(5)
+        pile = CylindricalSandPile(24, 16, random=True)
+        store = pile.record_footprints()
+        pile.simulate(400)
+        self.assertEqual(list(store.topples()), pile.topples_history)
+
+        radius, anisotropy = footprint.gyration(store, weighted=True)
+        toppled = store.sizes() > 0
+        self.assertEqual(np.isnan(radius).sum(), np.sum(~toppled))
+        self.assertEqual(((anisotropy[toppled] >= 0) & (anisotropy[toppled] <= 1)).all(), True)
+
+        sizes, counts = footprint.box_counts(store)
+        # A single site box covers each toppled site exactly once
+        self.assertEqual(sizes[0], 1)
+        self.assertEqual((counts[:, 0] == store.sizes()).all(), True)
+        dimension = footprint.box_counting_dimension(store)
+        fitted = dimension[~np.isnan(dimension)]
+        self.assertEqual(((fitted > 0.5) & (fitted < 2.5)).all(), True)
+
+    def test_rectangular_coordinates(self):
+        # Sites of a tall grid must not share a 1D coordinate
+        pile = SandPile(2, 3)
+        coords = {pile.get_1D_coord((x, y)) for x in range(2) for y in range(3)}
+        self.assertEqual(coords, set(range(6)))
+
+class TestGraphSandPile(unittest.TestCase):
+    def test_matches_grid_piles(self):
+        for cls in (SandPile, CylindricalSandPile, HourGlassSandPile):
+            np.random.seed(6)
+            pile = cls(9, 9, random=True)
+            graph_pile = graphpile.GraphSandPile.from_pile(pile)
+            sites = [(np.random.randint(9), np.random.randint(9)) for _ in range(300)]
+            for site in sites:
+                pile.drop_sand(1, site)
+                graph_pile.drop_sand(1, site)
+            self.assertEqual((graph_pile.grid == pile.grid).all(), True)
+            self.assertEqual(graph_pile.topples_history, pile.topples_history)
+            self.assertEqual(graph_pile.area_history, pile.area_history)
+            self.assertEqual(graph_pile.length_history, pile.length_history)
+            self.assertEqual(graph_pile.mass_history[1:], pile.mass_history[1:])
+
+    def test_hypercubic_matches_sandpile(self):
+        np.random.seed(7)
+        pile = SandPile(12, 10, threshold=9, random=True)
+        pile.threshold = 4
+        graph_pile = graphpile.GraphSandPile(graphpile.hypercubic((12, 10)))
+        graph_pile.heights = pile.grid.ravel().copy()
+        pile.stabilize()
+        graph_pile.stabilize()
+        self.assertEqual((graph_pile.grid == pile.grid).all(), True)
+
+    def test_other_thresholds(self):
+        # Sites lose 4 grains per topple whatever the threshold, in every engine
+        for threshold in (5, 7):
+            for Pile in (SandPile, CylindricalSandPile, HourGlassSandPile):
+                case = conformance.Case(Pile.topology,
+                                        np.random.RandomState(threshold).randint(0, 12, (7, 6)),
+                                        [(1, 2), (3, 3), (6, 5), (0, 0)] * 5, n=2,
+                                        threshold=threshold)
+                reference = conformance.run_reference(case)
+                for engine in (conformance.run_graph, conformance.run_forks):
+                    self.assertEqual(conformance.differences(reference, engine(case)), [])
+        lattice = graphpile.from_pile(SandPile(5, 5, threshold=6))
+        self.assertEqual(set(lattice.losses), {4})
+        self.assertEqual(lattice.sink_edges()[0], 2)
+
+    def test_single_site(self):
+        # The only site has no neighbors: every grain it topples is lost
+        graph_pile = graphpile.GraphSandPile.from_pile(SandPile(1, 1))
+        graph_pile.drop_sand(4, (0, 0))
+        self.assertEqual(graph_pile.grid.tolist(), [[0]])
+        self.assertEqual(graph_pile.topples_history[-1], 1)
+        self.assertEqual(graph_pile.area_history[-1], 1)
+        self.assertEqual(graph_pile.length_history[-1], 0)
+
+    def test_lattices(self):
+        cubic = graphpile.hypercubic((4, 5, 6))
+        self.assertEqual(cubic.n, 120)
+        self.assertEqual(set(cubic.thresholds), {6})
+        # Corners lose three grains, the interior none
+        self.assertEqual(cubic.sink_edges()[0], 3)
+        self.assertEqual(cubic.sink_edges()[cubic.index((1, 1, 1))], 0)
+        torus = graphpile.hypercubic((4, 4), periodic=True)
+        self.assertEqual((torus.sink_edges() == 0).all(), True)
+        self.assertEqual(set(graphpile.triangular(5, 5).degrees()), {2, 3, 4, 6})
+        self.assertEqual(set(graphpile.hexagonal(6, 6).degrees()), {1, 2, 3})
+
+        for lattice in (cubic, graphpile.triangular(6, 7), graphpile.hexagonal(6, 7),
+                        graphpile.hypercubic((3, 3, 3, 3))):
+            np.random.seed(8)
+            pile = graphpile.GraphSandPile(lattice)
+            pile.simulate(500)
+            self.assertEqual((pile.heights < lattice.thresholds).all(), True)
+            # Mass only leaves through the sink, one grain is added per step
+            lost = 1 - np.diff(pile.mass_history)
+            self.assertEqual((lost >= 0).all(), True)
+
+    def test_from_laplacian(self):
+        lattice = graphpile.hexagonal(4, 6)
+        laplacian = lattice.laplacian()
+        for matrix in (laplacian, laplacian.toarray()):
+            rebuilt = graphpile.Lattice.from_laplacian(matrix)
+            self.assertEqual((rebuilt.indptr == lattice.indptr).all(), True)
+            self.assertEqual((rebuilt.indices == lattice.indices).all(), True)
+            self.assertEqual((rebuilt.thresholds == lattice.thresholds).all(), True)
+
+class TestRecurrent(unittest.TestCase):
+    def test_uniform(self):
+        # The 2x2 grid has 192 spanning trees, hence 192 recurrent states
+        lattice = graphpile.hypercubic((2, 2))
+        rng = np.random.default_rng(0)
+        samples = Counter(tuple(recurrent.sample_recurrent(lattice, rng))
+                          for _ in range(9600))
+        self.assertEqual(len(samples), 192)
+        self.assertLess(max(samples.values()), 90)
+        self.assertGreater(min(samples.values()), 20)
+        for heights in samples:
+            self.assertEqual(recurrent.is_recurrent(lattice, np.array(heights)), True)
+
+    def test_piles(self):
+        for cls in (SandPile, CylindricalSandPile, HourGlassSandPile):
+            pile = cls.recurrent(12, 12, seed=9)
+            self.assertEqual(pile.pre_critical, False)
+            self.assertEqual(np.max(pile.grid) < 4, True)
+            self.assertEqual(pile.is_recurrent(), True)
+            # Recurrent states stay recurrent under drops
+            pile.simulate(50)
+            self.assertEqual(pile.is_recurrent(), True)
+
+        self.assertEqual(SandPile(12, 12).is_recurrent(), False)
+        hourglass = HourGlassSandPile.recurrent(12, 12, seed=9)
+        self.assertEqual(hourglass.grid[5:8, 5:8].sum(), 0)
+
+    def test_lattices(self):
+        for lattice in (graphpile.hypercubic((6, 6, 6)), graphpile.triangular(9, 8),
+                        graphpile.hexagonal(9, 8)):
+            heights = recurrent.sample_recurrent(lattice, seed=10)
+            self.assertEqual((heights < lattice.thresholds).all(), True)
+            self.assertEqual(recurrent.is_recurrent(lattice, heights), True)
+            # Removing a grain from the minimal site breaks recurrence
+            heights[0] = 0
+            heights[lattice.indices[lattice.indptr[0]:lattice.indptr[1]]] = 0
+            self.assertEqual(recurrent.is_recurrent(lattice, heights), False)
+
+class TestStationarity(unittest.TestCase):
+    def test_detector(self):
+        # A ramp followed by noise around a constant
+        rng = np.random.default_rng(11)
+        series = np.concatenate([np.linspace(0, 10, 500), 10 + rng.normal(size=2000)])
+        detector = StationarityDetector(window=100, patience=3)
+        detector.update_many(series)
+        self.assertEqual(detector.stationary, True)
+        self.assertGreaterEqual(detector.burn_in, 500)
+        self.assertLess(detector.burn_in, 1000)
+
+        ramp = StationarityDetector(window=100)
+        self.assertEqual(ramp.update_many(np.arange(5000.0)), False)
+        self.assertIsNone(ramp.burn_in)
+
+    def test_simulate_until_stationary(self):
+        np.random.seed(12)
+        pile = SandPile(12, 12)
+        pile.simulate(5000, until_stationary=True, samples=700)
+        self.assertEqual(len(pile.topples_history) - pile.burn_in, 700)
+        self.assertEqual(pile.get_start_index(), pile.burn_in)
+        # The pile is no longer filling up after the burn-in
+        densities = np.array(pile.mass_history[pile.burn_in + 1:]) / 144
+        self.assertGreater(densities.min(), 1.8)
+
+        np.random.seed(12)
+        offline = SandPile(12, 12)
+        offline.simulate(len(pile.topples_history))
+        self.assertEqual(offline.detect_stationarity() is not None, True)
+        self.assertRaises(RuntimeError, SandPile(12, 12).simulate, 50,
+                          until_stationary=True)
+
+class TestGroup(unittest.TestCase):
+    def test_bulk_matches_queue(self):
+        np.random.seed(13)
+        for Pile in (SandPile, CylindricalSandPile, HourGlassSandPile):
+            for width, height in ((7, 5), (2, 3), (1, 4)):
+                pile = Pile(width, height)
+                pile.grid = np.random.randint(0, 40, (width, height))
+                grid = pile.grid.copy()
+                pile.stabilize()
+                pile.grid[pile.sink_mask()] = 0
+                stable, odometer = bulk.stabilize(grid, Pile.periodic, pile.sink_mask(),
+                                                  odometer=True)
+                self.assertEqual(np.array_equal(stable, pile.grid), True)
+                if not pile.sink_mask().any():
+                    self.assertEqual(np.array_equal(
+                        grid - bulk.laplacian(odometer, Pile.periodic), stable), True)
+        # Batch dimensions are stabilized independently
+        grids = np.random.randint(0, 10, (3, 6, 5))
+        stable = bulk.stabilize(grids, (True, False))
+        for i in range(3):
+            self.assertEqual(np.array_equal(stable[i], bulk.stabilize(grids[i], (True, False))), True)
+
+    def test_group_laws(self):
+        for Pile in (SandPile, CylindricalSandPile, HourGlassSandPile):
+            identity = Pile.identity(8, 7)
+            x = Pile.recurrent(8, 7, seed=1)
+            y = Pile.recurrent(8, 7, seed=2)
+            self.assertEqual(identity.is_recurrent(), True)
+            self.assertEqual(np.array_equal((x + identity).grid, x.grid), True)
+            self.assertEqual(np.array_equal((x + y).grid, (y + x).grid), True)
+            self.assertEqual(np.array_equal((x + x.inverse()).grid, identity.grid), True)
+            self.assertEqual(np.array_equal((x - y + y).grid, x.grid), True)
+            self.assertEqual(np.array_equal((3 * x).grid, (x + x + x).grid), True)
+        self.assertRaises(ValueError, SandPile(4, 4).__add__, CylindricalSandPile(4, 4))
+
+    def test_order(self):
+        # The sandpile group of the 2x2 grid is Z_8 x Z_24
+        self.assertEqual(SandPile.identity(2, 2).order(), 1)
+        piles = [SandPile.recurrent(2, 2, seed=seed) for seed in range(20)]
+        orders = [pile.order() for pile in piles]
+        self.assertEqual(set(orders) <= {1, 2, 3, 4, 6, 8, 12, 24}, True)
+        self.assertIn(24, orders)
+        self.assertIsNone(piles[orders.index(24)].order(limit=23))
+
+class TestForks(unittest.TestCase):
+    def test_matches_copies(self):
+        rng = np.random.default_rng(14)
+        for Pile in (SandPile, CylindricalSandPile, HourGlassSandPile):
+            np.random.seed(14)
+            pile = Pile.recurrent(9, 8)
+            pile.simulate(20)
+            forks = pile.fork(3)
+            self.assertEqual(forks.shared, True)
+            copies = [copy.deepcopy(pile) for _ in range(3)]
+            for _ in range(200):
+                sites = np.stack([rng.integers(0, 9, 3), rng.integers(0, 8, 3)], axis=1)
+                forks.drop_sand(sites=sites)
+                for branch, other in enumerate(copies):
+                    other.drop_sand(1, tuple(sites[branch]))
+            self.assertEqual(forks.shared, False)
+            for branch, other in enumerate(copies):
+                self.assertEqual(np.array_equal(forks.grid(branch), other.grid), True)
+                child = forks.to_pile(branch)
+                self.assertEqual(child.mass_history, other.mass_history)
+                self.assertEqual(child.topples_history, other.topples_history)
+                self.assertEqual(child.area_history, other.area_history)
+                self.assertEqual(child.length_history, other.length_history)
+
+    def test_single_site(self):
+        # Only one branch topples its lone site, whose grains are all lost
+        forks = SandPile(1, 1).fork(2)
+        forks.add_sand(0, (0, 0), 3)
+        forks.drop_sand(1, (0, 0))
+        self.assertEqual(forks.grids.tolist(), [[[0]], [[1]]])
+        self.assertEqual(forks.history('topples').tolist(), [[1, 0]])
+        self.assertEqual(forks.history('area').tolist(), [[1, 0]])
+        self.assertEqual(forks.history('length').tolist(), [[0, 0]])
+
+    def test_sharing(self):
+        pile = SandPile.recurrent(20, 20, seed=15)
+        pile.simulate(10)
+        forks = pile.fork(4)
+        self.assertEqual(np.shares_memory(forks.grids[0], forks.grids[3]), True)
+        self.assertEqual(forks.grids.flags.writeable, False)
+        # The parent goes on without affecting the fork
+        pile.simulate(10)
+        self.assertEqual(len(forks.parent_history('topples')), 10)
+        self.assertEqual(len(forks.parent_history('mass')), 11)
+        self.assertEqual(np.array_equal(forks.grid(0), pile.grid), False)
+
+        # One extra grain is never undone by identical drops afterwards
+        forks.add_sand(1, (10, 10))
+        forks.simulate(300, same_site=True)
+        self.assertEqual(forks.history('topples').shape, (300, 4))
+        differences = forks.differences()
+        self.assertEqual(differences[0], 0)
+        self.assertEqual(differences[2], 0)
+        self.assertGreater(differences[1], 0)
+
+    def test_copy_on_write(self):
+        import gc
+        import weakref
+        pile = CylindricalSandPile.recurrent(10, 8, seed=16)
+        forks = pile.fork(3)
+        # Perturbing one branch copies that branch only
+        forks.add_sand(1, (4, 4), n=4)
+        self.assertEqual(forks.shared, False)
+        self.assertIs(forks._rows[0], forks._rows[2])
+        self.assertEqual(np.array_equal(forks.grid(0), pile.grid), True)
+        self.assertEqual(np.array_equal(forks.grid(1), pile.grid), False)
+        self.assertEqual(forks.grids.shape, (3, 10, 8))
+        # The cached lattice does not keep the parent alive
+        parent = weakref.ref(pile)
+        del pile, forks
+        gc.collect()
+        self.assertIsNone(parent())
+
+class TestStatePool(unittest.TestCase):
+    def test_fill_and_checkout(self):
+        with tempfile.TemporaryDirectory() as root:
+            pool = StatePool(root)
+            self.assertEqual(pool.fill('cylindrical', 12, 10, count=3), 3)
+            self.assertEqual(pool.fill('cylindrical', 12, 10, count=3), 0)
+            self.assertEqual(pool.available('cylindrical', 12, 10), 3)
+            self.assertEqual(pool.keys(), [('cylindrical', 12, 10)])
+            states = pool.states('cylindrical', 12, 10)
+            self.assertEqual(len(set(state['seed'] for state in states)), 3)
+            self.assertEqual(pool.load('cylindrical', 12, 10, states[0]['id']).dtype, np.uint8)
+
+            pile = pool.checkout(CylindricalSandPile, 12, 10)
+            self.assertIsInstance(pile, CylindricalSandPile)
+            self.assertEqual(pile.is_recurrent(), True)
+            self.assertEqual(pile.pre_critical, False)
+            self.assertEqual(pile.origin['method'], 'recurrent')
+            self.assertEqual(pool.available('cylindrical', 12, 10), 2)
+            self.assertEqual(pile.origin['id'] in [state['id'] for state in states], True)
+
+            # An empty key generates on the spot, or refuses to
+            self.assertRaises(LookupError, pool.checkout, 'open', 5, 5, generate=False)
+            self.assertEqual(pool.checkout('open', 5, 5).is_recurrent(), True)
+            pool.refill_async('open', 5, 5, 2).join()
+            self.assertEqual(pool.available('open', 5, 5), 2)
+
+    def test_drive(self):
+        with tempfile.TemporaryDirectory() as root:
+            pool = StatePool(root)
+            np.random.seed(4)
+            pile, metadata = pool.generate('open', 8, 8, method='drive', seed=3)
+            self.assertEqual(metadata['drops'] > metadata['burn_in'], True)
+            self.assertEqual(pile.is_recurrent(), True)
+            # The drops come from the seed alone and leave the global state alone
+            expected = np.random.RandomState(4).randint(0, 100)
+            self.assertEqual(np.random.randint(0, 100), expected)
+            again, _ = pool.generate('open', 8, 8, method='drive', seed=3)
+            self.assertEqual(np.array_equal(again.grid, pile.grid), True)
+
+    def test_critical_route(self):
+        import app
+        with tempfile.TemporaryDirectory() as root, \
+                mock.patch.object(app, 'POOL', StatePool(root)):
+            client = app.app.test_client()
+            response = client.get('/critical?topology=hourglass&width=9&height=7')
+            self.assertEqual(response.status_code, 200)
+            grid = np.array(response.get_json()['grid'])
+            self.assertEqual(grid.shape, (9, 7))
+            self.assertEqual(HourGlassSandPile.from_grid(grid).is_recurrent(), True)
+            app.POOL.wait('hourglass', 9, 7)
+            self.assertEqual(app.POOL.available('hourglass', 9, 7), app.POOL_SIZE)
+            self.assertEqual(client.get('/critical?topology=moebius').status_code, 400)
+            self.assertEqual(client.get('/critical?width=100000').status_code, 400)
+
+class TestDataset(unittest.TestCase):
+    def test_round_trip(self):
+        np.random.seed(16)
+        plain = CylindricalSandPile(10, 10)
+        plain.simulate(380)
+        np.random.seed(16)
+        pile = CylindricalSandPile(10, 10)
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, 'run')
+            with DatasetWriter(path, chunk_size=100, snapshots=True) as writer:
+                pile.simulate(250, writer=writer)
+                # Readable up to the last complete chunk while still running
+                self.assertEqual(len(Dataset(path)), 200)
+                pile.simulate(130, writer=writer)
+            # The avalanches went to the dataset only
+            self.assertEqual(pile.topples_history, [])
+            self.assertEqual(pile.mass_history, [0])
+
+            data = Dataset(path)
+            self.assertEqual(len(data), 380)
+            self.assertEqual([chunk['rows'] for chunk in data.index], [100, 100, 100, 80])
+            self.assertEqual(data.metadata['topology'], 'cylindrical')
+            self.assertEqual(data.metadata['rows'], 380)
+            areas = data.column('area')
+            self.assertIsInstance(areas, np.memmap)
+            self.assertEqual(areas.tolist(), plain.area_history)
+            self.assertEqual(data.column('mass', mmap=False).tolist(), plain.mass_history[1:])
+            chunks = list(data.iter_chunks(['x', 'topples']))
+            self.assertEqual(sorted(chunks[0]), ['topples', 'x'])
+            snapshots = dict(data.snapshots())
+            self.assertEqual(sorted(snapshots), [100, 200, 300, 380])
+            self.assertEqual(np.array_equal(snapshots[380], plain.grid), True)
+
+            loaded = data.to_pile()
+            self.assertIsInstance(loaded, CylindricalSandPile)
+            self.assertEqual(loaded.mass_history, plain.mass_history)
+            self.assertEqual(loaded.length_history, plain.length_history)
+            self.assertRaises(FileExistsError, DatasetWriter, path)
+
+    def test_same_run(self):
+        with tempfile.TemporaryDirectory() as root:
+            np.random.seed(17)
+            plain = SandPile(8, 8)
+            plain.simulate(300)
+            np.random.seed(17)
+            written = SandPile(8, 8)
+            with DatasetWriter(os.path.join(root, 'run'), chunk_size=64, duration=True) as writer:
+                written.simulate(300, writer=writer)
+            data = Dataset(os.path.join(root, 'run'))
+            self.assertEqual(data.column('topples').tolist(), plain.topples_history)
+            self.assertEqual(data.column('duration').shape, (300,))
+
+class TestSnapshots(unittest.TestCase):
+    def test_pack(self):
+        heights = np.random.randint(0, 4, 37).astype(np.uint8)
+        packed = snapshots.pack(heights, 2)
+        self.assertEqual(packed.nbytes, 10)
+        self.assertEqual(np.array_equal(snapshots.unpack(packed, 2, 37), heights), True)
+
+    def test_reconstruction(self):
+        for Pile in (SandPile, CylindricalSandPile, HourGlassSandPile):
+            for interval in (None, 7):
+                np.random.seed(18)
+                pile = Pile(12, 9)
+                recorder = pile.record_snapshots(interval)
+                grids = [pile.grid.copy()]
+                for _ in range(400):
+                    pile.drop_sand()
+                    grids.append(pile.grid.copy())
+                self.assertEqual(recorder.steps, 400)
+                for step in np.random.randint(0, 401, 40):
+                    self.assertEqual(np.array_equal(recorder.grid(step), grids[step]), True)
+                self.assertEqual(np.array_equal(recorder.grid(-1), pile.grid), True)
+                for offset, grid in enumerate(recorder.iter_grids(100, 150)):
+                    self.assertEqual(np.array_equal(grid, grids[100 + offset]), True)
+
+    def test_memory_bound(self):
+        np.random.seed(19)
+        pile = SandPile(40, 40, random=True)
+        recorder = pile.record_snapshots()
+        pile.simulate(3000)
+        keyframes = sum(frame.nbytes for frame in recorder._keyframes)
+        deltas = 5 * len(recorder._indices)
+        # One keyframe at most per keyframe's worth of deltas, plus the first
+        self.assertLessEqual(keyframes, deltas + 2 * recorder._keyframes[0].nbytes)
+        # Every delta entry is the drop site, a toppled site or a neighbor
+        self.assertLessEqual(len(recorder._indices), 3000 + 5 * sum(pile.topples_history))
+
+class TestAnalysis(unittest.TestCase):
+    def test_matches_scipy(self):
+        from scipy.stats import spearmanr, skew, kurtosis
+        np.random.seed(20)
+        pile = SandPile(15, 15)
+        pile.simulate(3000)
+        start = pile.get_start_index()
+        area = np.array(pile.area_history[start:])
+        topples = np.array(pile.topples_history[start:])
+        change = np.diff(pile.mass_history)[start:]
+        expected = [spearmanr(pile.length_history[start:], area),
+                    spearmanr(area, change), spearmanr(area, topples)]
+        for (rho, pvalue), reference in zip(pile.calculate_correlations(), expected):
+            self.assertAlmostEqual(rho, reference[0])
+            self.assertAlmostEqual(pvalue, reference[1])
+        moments = pile.analyse().moments('topples')
+        self.assertAlmostEqual(moments['mean'], topples.mean())
+        self.assertAlmostEqual(moments['variance'], topples.var())
+        self.assertAlmostEqual(moments['skewness'], skew(topples))
+        self.assertAlmostEqual(moments['kurtosis'], kurtosis(topples))
+        self.assertAlmostEqual(pile.calculate_average_mass(),
+                               np.mean(pile.mass_history[start:]) / 225)
+
+    def test_streaming(self):
+        np.random.seed(21)
+        pile = SandPile(12, 12, random=True)
+        chunks = list(pile.iter_avalanches(2000, chunk_size=300))
+        whole = analysis.analyse(np.concatenate(chunks), observables=('topples', 'area', 'loss'))
+        streamed = analysis.analyse(iter(chunks), observables=('topples', 'area', 'loss'))
+        self.assertEqual(streamed.count, 2000)
+        self.assertEqual(np.allclose(streamed.correlations()[0], whole.correlations()[0]), True)
+        areas, means, counts = streamed.conditional_mean('topples', 'area')
+        records = np.concatenate(chunks)
+        for area, mean, count in zip(areas, means, counts):
+            selected = records['topples'][records['area'] == area]
+            self.assertEqual(len(selected), count)
+            self.assertAlmostEqual(mean, selected.mean())
+
+class TestScaling(unittest.TestCase):
+    def test_collapse_recovers_exponents(self):
+        # Exact finite-size scaling form P(s, L) = A s^-tau exp(-s / L^D)
+        rng = np.random.RandomState(22)
+        sweep = scaling.ScalingSweep('open', [8, 16, 32], observables=('area',), n_jobs=1)
+        for size in sweep.sizes:
+            s = np.arange(20 * size ** 2)
+            p = 0.2 * np.maximum(s, 1) ** -1.3 * np.exp(-s / size ** 2.0)
+            p[0] = 1 - p[1:].sum()
+            for _ in range(4):
+                drops = rng.choice(s, size=20000, p=p)
+                sweep.add_chunk(size, {'area': np.unique(drops, return_counts=True)}, 20000)
+        result = sweep.fit(bootstrap=10)
+        self.assertLess(abs(result['tau'] - 1.3), 0.05)
+        self.assertLess(abs(result['D'] - 2.0), 0.1)
+        self.assertGreater(result['tau_error'], 0)
+
+    def test_sweep_stops_sizes(self):
+        sweep = scaling.ScalingSweep('open', [4, 6, 8], chunk_drops=200, tolerance=0.2,
+                                     min_chunks=2, max_chunks=5, n_jobs=1, seed=3)
+        # The largest size is the most expensive, so it goes first
+        self.assertEqual(sweep.next_size(), 8)
+        sweep.run()
+        for size in sweep.sizes:
+            self.assertGreaterEqual(len(sweep.chunks[size]), 2)
+            self.assertLessEqual(len(sweep.chunks[size]), 5)
+            self.assertEqual(sweep.done(size), True)
+            self.assertEqual(sum(sweep.histogram(size, 'area')[1]), 200 * len(sweep.chunks[size]))
+        result = sweep.fit('topples', bootstrap=5)
+        self.assertEqual(set(result['drops']), {4, 6, 8})
+
+    def test_extra_observables(self):
+        histograms, _ = scaling.run_chunk('open', 6, 100, 1, ('topples', 'waves'))
+        self.assertEqual(histograms['waves'][1].sum(), 100)
+        # Every avalanche with a topple has at least one wave
+        waves, topples = (dict(zip(*histograms[name])) for name in ('waves', 'topples'))
+        self.assertEqual(waves.get(0, 0), topples.get(0, 0))
+        with self.assertRaises(ValueError):
+            scaling.ScalingSweep('open', [4], observables=('duration', 'waves'))
+
+class TestSpectrum(unittest.TestCase):
+    def test_matches_welch(self):
+        from scipy.signal import welch
+        signal = np.cumsum(np.random.RandomState(8).normal(size=5003))
+        for detrend, overlap in (('constant', None), ('linear', 40)):
+            estimator = spectrum.WelchPSD(128, overlap, sampling=2.0, detrend=detrend)
+            for part in np.array_split(signal, 23):
+                estimator.update(part)
+                # Only the values of the segment being filled are kept
+                self.assertLess(len(estimator._pending), 128)
+            frequencies, density = estimator.psd()
+            expected = welch(signal, fs=2.0, nperseg=128, noverlap=overlap, detrend=detrend)
+            self.assertEqual(np.allclose(frequencies, expected[0]), True)
+            self.assertEqual(np.allclose(density, expected[1]), True)
+        with self.assertRaises(ValueError):
+            spectrum.WelchPSD(128).update(np.zeros(100)).psd()
+
+    def test_slopes(self):
+        noise = np.random.RandomState(3).normal(size=100000)
+        for values, slope in ((noise, 0), (np.cumsum(noise), -2)):
+            frequencies, density = spectrum.WelchPSD(1024).update(values).psd()
+            self.assertLess(abs(spectrum.fit_slope(frequencies, density, high=0.1)[0] - slope),
+                            0.1)
+
+    def test_pile(self):
+        np.random.seed(6)
+        pile = SandPile(10, 10, random=True)
+        pile.simulate(2000)
+        spectra = spectrum.analyse_spectra(pile, segment=256)
+        self.assertEqual(spectra['mass'].samples, 2000)
+        self.assertEqual(spectra['topples'].segments, 14)
+        streamed = SandPile(10, 10, random=True)
+        chunks = streamed.iter_avalanches(2000, chunk_size=300)
+        self.assertEqual(spectrum.analyse_spectra(chunks, segment=256)['topples'].segments, 14)
+        self.assertEqual(spectrum.segment_size(2000), 256)
+        self.assertEqual(spectrum.segment_size(50), None)
+
+class TestInfinite(unittest.TestCase):
+    def test_matches_large_grid(self):
+        # A grid the sand never reaches the edge of behaves as the infinite lattice
+        pile = InfiniteSandPile(tile=8)
+        reference = SandPile(41, 41)
+        for _ in range(300):
+            pile.drop_sand()
+            reference.drop_sand(1, (20, 20))
+        self.assertEqual(pile.topples_history, reference.topples_history)
+        self.assertEqual(pile.area_history, reference.area_history)
+        self.assertEqual(pile.length_history, reference.length_history)
+        xmin, xmax, ymin, ymax = pile.bounds()
+        self.assertEqual(np.array_equal(
+            pile.grid(), reference.grid[20 + xmin:21 + xmax, 20 + ymin:21 + ymax]), True)
+        self.assertEqual(pile.mass(), reference.mass())
+        self.assertLess(pile.tiles, 16)
+
+    def test_bulk_drop(self):
+        pile = InfiniteSandPile(tile=16)
+        pile.drop_sand(5000, site=(-3, 7))
+        reference = InfiniteSandPile(tile=16)
+        reference.add_sand((-3, 7), 5000)
+        reference.stabilize()
+        self.assertEqual(np.array_equal(pile.grid(), reference.grid()), True)
+        self.assertEqual(pile.bounds(), reference.bounds())
+        self.assertEqual(pile.mass(), 5000)
+        self.assertEqual(pile.grid().max() < 4, True)
+        self.assertEqual(pile[-3, 7], reference[-3, 7])
+
+class TestBitslice(unittest.TestCase):
+    def test_pack(self):
+        heights = np.random.randint(-8, 8, (3, 5, 70))
+        self.assertEqual(np.array_equal(bitslice.unpack(bitslice.pack(heights, 4), 70), heights), True)
+
+    def test_matches_bulk(self):
+        np.random.seed(23)
+        for Pile in (SandPile, CylindricalSandPile, HourGlassSandPile):
+            for width, height in ((7, 5), (9, 64), (12, 130)):
+                sinks = Pile(width, height).sink_mask()
+                for high in (8, 40):
+                    grids = np.random.randint(0, high, (2, width, height))
+                    self.assertEqual(np.array_equal(
+                        bitslice.stabilize(grids, Pile.periodic, sinks),
+                        bulk.stabilize(grids, Pile.periodic, sinks)), True)
+            grid = np.random.randint(0, 30, (10, 20))
+            self.assertEqual(np.array_equal(
+                bitslice.stabilize(grid, Pile.periodic, Pile(10, 20).sink_mask(), threshold=6),
+                bulk.stabilize(grid, Pile.periodic, Pile(10, 20).sink_mask(), threshold=6)), True)
+
+    def test_engine(self):
+        np.random.seed(24)
+        for Pile in (SandPile, CylindricalSandPile, HourGlassSandPile):
+            pile = Pile(15, 11)
+            pile.grid = np.random.randint(0, 12, (15, 11))
+            reference = copy.deepcopy(pile)
+            pile.stabilize(engine='bitslice')
+            reference.stabilize()
+            self.assertEqual(np.array_equal(pile.grid, reference.grid), True)
+
+class TestWorkQueue(unittest.TestCase):
+    def test_ensemble_workers(self):
+        with tempfile.TemporaryDirectory() as root:
+            queue = WorkQueue(root, lease=0.5)
+            queue.submit_ensemble('cylindrical', 6, 6, 20, shards=5, seed=7)
+            self.assertEqual(queue.status(), {'pending': 5, 'leased': 0, 'done': 0})
+            # A worker which claims a shard and dies without finishing it
+            self.assertEqual(queue.claim('crashed')['id'], '000000')
+            with self.assertRaises(RuntimeError):
+                queue.reduce()
+            workers = [multiprocessing.Process(target=WorkQueue(root, lease=0.5).work,
+                                               kwargs={'wait': True, 'poll': 0.05})
+                       for _ in range(3)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            self.assertEqual(queue.status(), {'pending': 0, 'leased': 0, 'done': 5})
+            pile = queue.reduce()
+            expected = [ensemble_shard('cylindrical', 6, 6, 4, seed=[7, i]) for i in range(5)]
+            for name in ('topples', 'area', 'length'):
+                self.assertEqual(getattr(pile, name + '_history'),
+                                 np.concatenate([e[name] for e in expected]).tolist())
+            self.assertEqual(pile.mass_history[1:],
+                             np.concatenate([e['mass'] for e in expected]).tolist())
+            self.assertEqual(type(pile), CylindricalSandPile)
+
+    def test_shards_in_threads(self):
+        # Shards draw their drop sites from their own seeds, also side by side
+        import threading
+        expected = [ensemble_shard('open', 6, 6, 30, seed=seed) for seed in range(4)]
+        state = np.random.get_state()
+        results = [None] * 4
+
+        def run(seed):
+            results[seed] = ensemble_shard('open', 6, 6, 30, seed=seed)
+        threads = [threading.Thread(target=run, args=(seed,)) for seed in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for result, shard in zip(results, expected):
+            self.assertEqual(result['area'].tolist(), shard['area'].tolist())
+        self.assertEqual(np.random.get_state()[1].tolist(), state[1].tolist())
+
+    def test_sweep(self):
+        with tempfile.TemporaryDirectory() as root:
+            queue = WorkQueue(root)
+            queue.submit_sweep(scaling.ScalingSweep('open', [4, 6], chunk_drops=100), 2)
+            self.assertEqual(queue.work(max_shards=1), 1)
+            self.assertEqual(queue.work(), 3)
+            sweep = queue.reduce()
+            reference = scaling.ScalingSweep('open', [4, 6], chunk_drops=100, min_chunks=2,
+                                             max_chunks=2, tolerance=1e-9, n_jobs=1).run()
+            for size in (4, 6):
+                self.assertEqual(sweep.drops[size], [100, 100])
+                for name in scaling.OBSERVABLES:
+                    for got, want in zip(sweep.histogram(size, name), reference.histogram(size, name)):
+                        self.assertEqual(np.array_equal(got, want), True)
+
+class TestConformance(unittest.TestCase):
+    def test_random_cases(self):
+        self.assertEqual(conformance.check_random(25, seed=3), [])
+
+    def test_single_site(self):
+        # The only site has no neighbors, yet still topples (found with seed 7)
+        case = conformance.Case('open', [[0]], drops=[(0, 0)], n=4)
+        self.assertEqual(conformance.check(case), {})
+        self.assertEqual(conformance.run_reference(case)['topples'].tolist(), [1])
+        self.assertEqual(conformance.check(case.replace(drops=[(0, 0)] * 3, n=9)), {})
+
+    def test_word_boundaries(self):
+        # The bit-sliced stabilizer packs 64 sites to a word along the height
+        rng = np.random.RandomState(64)
+        for height in (63, 64, 65, 128, 129):
+            case = conformance.Case('open', rng.randint(0, 8, (2, height)),
+                                    [(0, height - 1), (1, 63 % height)] * 3)
+            self.assertEqual(conformance.check(case, ['sweeps']), {})
+
+    def test_multiple_grains(self):
+        # Dropping several grains at once may leave the start unstable
+        for cls in (SandPile, NSP):
+            pile = cls(2, 3)
+            pile.grid = np.array([[2, 0, 1], [0, 3, 1]])
+            pile.simulate(1, 5, site=(1, 1))
+            self.assertEqual(pile.grid.tolist(), [[2, 2, 1], [2, 0, 3]])
+            self.assertEqual(list(pile.topples_history), [2])
+
+    def test_shrink(self):
+        def broken(case):
+            # Forgets the last drop of several grains
+            if case.n > 1 and case.drops:
+                case = case.replace(drops=case.drops[:-1])
+            return conformance.run_reference(case)
+
+        def fails(case):
+            return len(conformance.differences(conformance.run_reference(case), broken(case))) > 0
+
+        grid = np.random.RandomState(45).randint(0, 4, (6, 5))
+        case = conformance.Case('cylindrical', grid,
+                                [(1, 2), (3, 4), (5, 0)], n=3)
+        self.assertEqual(fails(case), True)
+        shrunk = conformance.shrink(case, fails)
+        self.assertEqual((shrunk.grid.shape, shrunk.grid.sum(), len(shrunk.drops), shrunk.n),
+                         ((1, 1), 0, 1, 2))
+
+    def test_timings(self):
+        case = conformance.timing_case('open', 8, 50)
+        timings = conformance.compare_timings(case, repeat=1)
+        # Grains leave the open boundary, so the infinite lattice differs
+        self.assertEqual(set(timings), set(conformance.ENGINES) - {'infinite'})
+        self.assertEqual(min(timings.values()) > 0, True)
+
+class TestStreaming(unittest.TestCase):
+    def test_ensemble_records(self):
+        records = list(streaming.ensemble_records('open', 6, 6, 25, every=10))
+        self.assertEqual([record['type'] for record in records].count('member'), 25)
+        self.assertEqual([record['members'] for record in records
+                          if record['type'] == 'summary'], [10, 20, 25])
+        self.assertEqual(records[-1], dict(records[-1], type='done', reason='finished',
+                                           members=25))
+        # Every member can be run again on its own
+        member = records[13]
+        again = ensemble_shard('open', 6, 6, 1, seed=[0, member['index']])
+        self.assertEqual(member['area'], again['area'][0])
+        summary = records[-2]
+        self.assertEqual(summary['histograms']['area']['counts'].sum(), 25)
+        # Any error is below an infinite tolerance, once there is one
+        records = list(streaming.ensemble_records('open', 16, 16, 2000, every=100,
+                                                  tolerance=np.inf))
+        self.assertEqual(records[-1]['reason'], 'converged')
+        self.assertLess(records[-1]['members'], 2000)
+        self.assertEqual(streaming.jsonable({1: [np.int64(2), np.nan, np.float32(0.5)]}),
+                         {'1': [2, None, 0.5]})
+
+    def test_routes(self):
+        import app
+        client = app.app.test_client()
+        with client.get('/ensemble?width=6&height=6&runs=12&every=5') as response:
+            self.assertEqual(response.mimetype, 'application/x-ndjson')
+            self.assertEqual(response.is_streamed, True)
+            records = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([record['type'] for record in records if record['type'] != 'member'],
+                         ['summary', 'summary', 'summary', 'done'])
+        # Closing the stream stops the run
+        response = client.get('/ensemble?width=20&height=20&runs=100000', buffered=False)
+        self.assertEqual(json.loads(next(iter(response.response)))['index'], 0)
+        response.close()
+        self.assertEqual(app.IN_PROGRESS.value(endpoint='send_ensemble'), 0)
+
+        with client.get('/sweep?sizes=4,6&drops=100&min_chunks=2&max_chunks=2&every=2'
+                        '&observables=area') as response:
+            records = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([record['type'] for record in records],
+                         ['chunk', 'chunk', 'summary', 'chunk', 'chunk', 'summary', 'done'])
+        self.assertEqual(records[-2]['chunks'], {'4': 2, '6': 2})
+        self.assertEqual(set(records[-2]['exponents']), {'area'})
+        for query in ('/ensemble?runs=0', '/ensemble?topology=torus', '/sweep?sizes=4,x',
+                      '/sweep?observables=mass', '/sweep?observables=duration,waves'):
+            self.assertEqual(client.get(query).status_code, 400)
+
+class TestMetrics(unittest.TestCase):
+    def test_render(self):
+        from metrics import Registry
+        registry = Registry()
+        requests = registry.counter('requests_total', 'Requests', ('path',))
+        requests.inc(path='/a')
+        requests.inc(2, path='say "hi"')
+        registry.gauge('depth', 'Queue depth').set(3)
+        latency = registry.histogram('seconds', 'Latency', buckets=(0.1, 1))
+        for value in (0.05, 0.5, 5):
+            latency.observe(value)
+        registry.gauge('pool', 'States', ('size',), function=lambda: {('10x10',): 4})
+        self.assertEqual(registry.render(), '\n'.join([
+            '# HELP requests_total Requests',
+            '# TYPE requests_total counter',
+            'requests_total{path="/a"} 1',
+            'requests_total{path="say \\"hi\\""} 2',
+            '# HELP depth Queue depth',
+            '# TYPE depth gauge',
+            'depth 3',
+            '# HELP seconds Latency',
+            '# TYPE seconds histogram',
+            'seconds_bucket{le="0.1"} 1',
+            'seconds_bucket{le="1"} 2',
+            'seconds_bucket{le="+Inf"} 3',
+            'seconds_count 3',
+            'seconds_sum 5.55',
+            '# HELP pool States',
+            '# TYPE pool gauge',
+            'pool{size="10x10"} 4',
+            '']))
+        with self.assertRaises(ValueError):
+            requests.inc(method='GET')
+
+    def test_routes(self):
+        import app
+        # The metrics belong to the process, so compare them with their values beforehand
+        plots = app.REQUESTS.value(endpoint='send_plot', status=200)
+        hits = app.CACHE.value(cache='state_pool', result='hit')
+        misses = app.CACHE.value(cache='state_pool', result='miss')
+        with tempfile.TemporaryDirectory() as root, \
+                mock.patch.object(app, 'POOL', StatePool(root)):
+            client = app.app.test_client()
+            grids = [client.get('/plots').get_json() for _ in range(2)]
+            self.assertEqual(grids[0], grids[1])
+            self.assertEqual(app.REQUESTS.value(endpoint='send_plot', status=200), plots + 2)
+            self.assertGreaterEqual(app.CACHE.value(cache='plots', result='hit'), 1)
+            for _ in range(2):
+                client.get('/critical?topology=open&width=6&height=5')
+                app.POOL.wait('open', 6, 5)
+            self.assertEqual(app.CACHE.value(cache='state_pool', result='hit'), hits + 1)
+            self.assertEqual(app.CACHE.value(cache='state_pool', result='miss'), misses + 1)
+            self.assertEqual(client.get('/healthz').get_json()['status'], 'ok')
+            response = client.get('/metrics')
+            self.assertEqual(response.content_type, 'text/plain; version=0.0.4; charset=utf-8')
+            text = response.get_data(as_text=True)
+            for line in ('sandpile_requests_total{endpoint="send_plot",status="200"} %d' % (plots + 2),
+                         'sandpile_pool_states{topology="open",size="6x5"} 4',
+                         'sandpile_requests_in_progress{endpoint="send_metrics"} 1',
+                         'sandpile_pool_refills_running 0'):
+                self.assertIn(line, text)
+            self.assertIn('sandpile_simulation_seconds_count{topology="open",size="6x5",method="pool"}',
+                          text)
+            self.assertIn('# TYPE sandpile_response_bytes histogram', text)
+
+
+class TestStochastic(unittest.TestCase):
+    def sequential(self, grid, rule, seed, periodic, sinks, order):
+        """Topple one random unstable site at a time with the same streams."""
+        grid, counters = grid.copy(), np.zeros(grid.shape, dtype=np.int64)
+        width, height = grid.shape
+        while True:
+            thresholds = rule.thresholds(seed, np.arange(grid.size),
+                                         counters.ravel()) * np.ones(grid.size, dtype=int)
+            unstable = np.flatnonzero((grid.ravel() >= thresholds) & ~sinks.ravel())
+            if len(unstable) == 0:
+                return grid, counters
+            site = order.choice(unstable)
+            x, y = divmod(site, height)
+            hashes = stochastic.counter_hash(seed, stochastic.TOPPLE, [site], counters[x, y])
+            grid[x, y] -= rule.lost
+            counters[x, y] += 1
+            for direction in rule.directions(hashes):
+                tx = x + stochastic.DX[int(direction[0])]
+                ty = y + stochastic.DY[int(direction[0])]
+                tx, ty = (tx % width if periodic[0] else tx), (ty % height if periodic[1] else ty)
+                if 0 <= tx < width and 0 <= ty < height and not sinks[tx, ty]:
+                    grid[tx, ty] += 1
+
+    def test_abelian(self):
+        # The vectorized sweeps and any sequential order end in the same state
+        state = np.random.RandomState(1)
+        for rule in (stochastic.Manna(), stochastic.RandomThreshold(),
+                     stochastic.RandomThreshold(4, 6, annealed=False)):
+            for topology in ('open', 'cylindrical', 'hourglass'):
+                pile = stochastic.StochasticSandPile(9, 8, rule, topology, seed=5)
+                pile.grid[...] = state.randint(0, 2 * rule.threshold, pile.grid.shape)
+                pile.grid[pile.sink_mask()] = 0
+                expected = self.sequential(pile.grid, rule, 5, pile.periodic,
+                                           pile.sink_mask(), state)
+                pile.stabilize()
+                np.testing.assert_array_equal(pile.grid, expected[0])
+                np.testing.assert_array_equal(pile.counters, expected[1])
+
+    def test_reproducible(self):
+        for rule in (stochastic.Manna(), stochastic.RandomThreshold()):
+            piles = [stochastic.StochasticSandPile(12, 12, rule, seed=seed, random=True)
+                     for seed in (7, 7, 8)]
+            for pile in piles:
+                pile.simulate(400)
+            self.assertEqual(piles[0].topples_history, piles[1].topples_history)
+            self.assertNotEqual(piles[0].topples_history, piles[2].topples_history)
+            # Streaming the avalanches gives the same results
+            pile = stochastic.StochasticSandPile(12, 12, rule, seed=7, random=True)
+            chunks = list(pile.iter_avalanches(400, duration=True))
+            self.assertEqual(list(np.concatenate(chunks)['topples']), piles[0].topples_history)
+            np.testing.assert_array_equal(pile.grid, piles[0].grid)
+
+    def test_avalanches(self):
+        pile = stochastic.StochasticSandPile(10, 10, stochastic.Manna(), seed=2)
+        pile.grid[...] = 1
+        pile.track(duration=True)
+        pile.drop_sand(site=(5, 5))
+        topples, area, length = (pile.topples_history[-1], pile.area_history[-1],
+                                 pile.length_history[-1])
+        self.assertEqual(topples, pile.counters.sum())
+        self.assertEqual(area, np.count_nonzero(pile.counters))
+        self.assertGreater(pile.duration_history[-1], 0)
+        x, y = np.nonzero(pile.counters)
+        self.assertEqual(length, (abs(x - 5) + abs(y - 5)).max())
+        self.assertLessEqual(pile.grid.max(), 1)
+        with self.assertRaises(ValueError):
+            stochastic.StochasticSandPile(10, 10).track(waves=True)
+        with self.assertRaises(TypeError):
+            stochastic.StochasticSandPile.recurrent(10, 10)
+
+    def test_sink(self):
+        # Grains dropped into the hourglass hole leave the pile
+        for rule in (stochastic.Manna(), stochastic.RandomThreshold()):
+            pile = stochastic.StochasticSandPile(9, 9, rule, 'hourglass', seed=1)
+            pile.simulate(3000)
+            self.assertEqual(pile.grid[pile.sink_mask()].sum(), 0)
+            self.assertEqual(pile.mass_history[-1], pile.grid.sum())
+
+    def test_thresholds(self):
+        rule = stochastic.RandomThreshold(5, 6, annealed=False)
+        sites = np.arange(1000)
+        thresholds = rule.thresholds(3, sites, np.full(1000, 9))
+        self.assertEqual(set(thresholds), {5, 6})
+        np.testing.assert_array_equal(thresholds, rule.thresholds(3, sites, 0))
+        annealed = stochastic.RandomThreshold(5, 6).thresholds(3, sites, np.full(1000, 9))
+        self.assertFalse((annealed == stochastic.RandomThreshold(5, 6).thresholds(
+            3, sites, 0)).all())
+        with self.assertRaises(ValueError):
+            stochastic.RandomThreshold(3, 6)
+        self.assertIs(stochastic.RULES['manna'], stochastic.Manna)
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_run_case(self):
+        result = benchmark.run_case('open', 6, 'critical', 30, seed=3)
+        self.assertEqual(result['drops'], 30)
+        self.assertGreater(result['drops_per_sec'], 0)
+        self.assertGreater(result['peak_memory_bytes'], 0)
+        # Critical states come from the bulk stabilizer, the same as the queue's
+        pile = benchmark.make_pile('hourglass', 12, 'critical', 3)
+        reference = benchmark.overfull_pile('hourglass', 12, 3)
+        reference.stabilize()
+        self.assertEqual(np.array_equal(pile.grid, reference.grid), True)
+        timed = benchmark.run_case('cylindrical', 12, 'stabilization', 30, seed=3)
+        self.assertGreater(timed['stabilization_seconds'], 0)
+        self.assertIsNone(benchmark.run_case('numba', 6, 'stabilization', 30)
+                          ['stabilization_seconds'])
+
+        # Fixed seeds make the amount of work reproducible
+        again = benchmark.run_case('open', 6, 'critical', 30, seed=3, memory=False)
+        self.assertEqual(again['topples'], result['topples'])
+
+    def test_compare(self):
+        case = {'engine': 'open', 'size': 20, 'state': 'critical',
+                'drops_per_sec': 100.0, 'topples_per_sec': 1000.0,
+                'peak_memory_bytes': 5000, 'stabilization_seconds': None}
+        slower = dict(case, drops_per_sec=50.0, peak_memory_bytes=5100)
+        history = {'runs': [{'results': [case]}, {'results': [slower]}]}
+        regressions = benchmark.compare(history, tolerance=0.1)
+        self.assertEqual([r['metric'] for r in regressions], ['drops_per_sec'])
+        self.assertEqual(benchmark.compare({'runs': [{'results': [case]}]}), [])
+
+class TestProfiler(unittest.TestCase):
+    def test_counts(self):
+        np.random.seed(2)
+        pile = SandPile(10, 10, random=True)
+        stream = io.StringIO()
+        profiler = Profiler(progress_interval=0, stream=stream).attach(pile)
+        pile.simulate(200)
+        report = profiler.report()
+
+        counters = report['counters']
+        self.assertEqual(counters['drops'], 200)
+        self.assertEqual(counters['topples'], sum(pile.topples_history))
+        self.assertEqual(counters['queue_pushes'], counters['queue_pops'])
+        self.assertEqual(report['phases']['history']['calls'], 200)
+        self.assertIn('drops/s', stream.getvalue())
+
+        # Detaching restores the class methods and the results are unchanged
+        profiler.detach()
+        self.assertNotIn('topple', pile.__dict__)
+        np.random.seed(2)
+        plain = SandPile(10, 10, random=True)
+        plain.simulate(200)
+        self.assertEqual(plain.topples_history, pile.topples_history)
+
+class TestImportBudget(unittest.TestCase):
+    # Seconds the core modules may add on top of importing numpy itself.
+    # The plotting stack alone costs well over a second, so this leaves
+    # plenty of headroom while still catching an eager matplotlib/scipy import
+    CORE_IMPORT_BUDGET = 0.25
+
+    def test_core_import(self):
+        script = '''
+import json, sys, time
+start = time.perf_counter()
+import numpy
+numpy_time = time.perf_counter() - start
+start = time.perf_counter()
+import sandpile, cylindrical, hourglass
+core_time = time.perf_counter() - start
+heavy = [name for name in ('matplotlib', 'scipy') if name in sys.modules]
+print(json.dumps({'core': core_time, 'numpy': numpy_time, 'heavy': heavy}))
+'''
+        output = subprocess.run([sys.executable, '-c', script], check=True,
+                                capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        report = json.loads(output)
+        self.assertEqual(report['heavy'], [])
+        self.assertLess(report['core'], self.CORE_IMPORT_BUDGET)
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,33 @@
+#################################################
+#   Author: Caleb Smith
+#   Student ID: 1027644
+#   November 9,2020
+#################################################
+"""
+Lookup table from topology names to the sandpile classes implementing them,
+so scripts and services can select a boundary condition by name.
+"""
+from sandpile import SandPile
+from cylindrical import CylindricalSandPile
+from hourglass import HourGlassSandPile
+
+TOPOLOGIES = {
+    SandPile.topology: SandPile,
+    CylindricalSandPile.topology: CylindricalSandPile,
+    HourGlassSandPile.topology: HourGlassSandPile,
+}
+
+
+def get_topology(name):
+    """
+    Return the sandpile class for the topology called `name`.
+
+    Parameters
+    ==========
+    name: str, one of the keys of TOPOLOGIES
+    """
+    try:
+        return TOPOLOGIES[name]
+    except KeyError:
+        raise ValueError('Unknown topology {!r}; expected one of {}'.format(
+            name, ', '.join(sorted(TOPOLOGIES))))
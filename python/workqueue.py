@@ -0,0 +1,464 @@
+#!/usr/bin/env python3
+#################################################
+#   Author: Caleb Smith
+#   Student ID: 1027644
+#   November 9,2020
+#################################################
+"""Work queue
+Shards ensemble and sweep runs across several hosts through a directory
+they all share (for example over NFS). A job is split into shards, each
+described by a small JSON file, and any number of workers on any number of
+hosts take shards from the queue, run them and write their results back:
+
+    <root>/job.json               what the job is and how many shards it has
+    <root>/pending/<id>.json      shards waiting for a worker
+    <root>/leased/<id>.json       shards being run, and <id>.lease, touched
+                                  by the worker every few seconds
+    <root>/done/<id>.npz          results of the finished shards, next to
+                                  their <id>.json
+
+A shard is claimed by renaming it from pending/ to leased/, which is atomic,
+so no two workers get the same shard. A worker which crashes stops touching
+its lease; once the lease is older than the lease time the shard is moved
+back to pending/ and another worker runs it. Shards are seeded from the job
+seed and their index, so running one twice gives the same result. The
+hosts' clocks must agree to well within the lease time.
+
+Once every shard is done, reduce() merges the results: an ensemble gives
+the same pile SandPile.ensemble_simulate returns, and a sweep gives a
+scaling.ScalingSweep with the histograms of every chunk, ready to fit.
+
+Example usage:
+    queue = WorkQueue('queue')
+    queue.submit_ensemble('open', 20, 20, 10000, shards=20)
+    queue.work()                    # on every host, as many times as wanted
+    pile = queue.reduce()
+
+    python workqueue.py --root queue submit-sweep open 16 32 64 --chunks 8
+    python workqueue.py --root queue work --wait
+    python workqueue.py --root queue reduce
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import uuid
+
+import numpy as np
+
+from topologies import TOPOLOGIES, get_topology
+
+DEFAULT_ROOT = os.environ.get('SANDPILE_WORK_QUEUE', 'work_queue')
+# Seconds without a heartbeat after which a shard is handed to another worker
+DEFAULT_LEASE = 300
+ENSEMBLE_OBSERVABLES = ('topples', 'area', 'length', 'mass')
+
+
+def ensemble_shard(topology, width, height, runs, n=1, site=None, seed=0):
+    """
+    Run `runs` members of an ensemble: as SandPile.ensemble_simulate, each
+    one drops `n` grains on a uniformly random recurrent state. Returns the
+    topples, area, length and mass after the drop of every member.
+    """
+    cls = get_topology(topology)
+    seeds = np.random.SeedSequence(seed).generate_state(runs + 1)
+    # Drop sites of the call's own, so shards run side by side in threads
+    # (as the streamed ensembles of app.py) do not change each other's
+    rng = np.random.RandomState(seeds[-1])
+    results = {name: np.zeros(runs, dtype=np.int64) for name in ENSEMBLE_OBSERVABLES}
+    for run in range(runs):
+        pile = cls.recurrent(width, height, seed=int(seeds[run]))
+        pile.rng = rng
+        pile.simulate(1, n, site)
+        for name in ENSEMBLE_OBSERVABLES:
+            results[name][run] = getattr(pile, name + '_history')[-1]
+    return results
+
+
+def sweep_shard(topology, size, drops, seed, observables):
+    """
+    Run one chunk of a finite-size scaling sweep (see scaling.run_chunk),
+    with its histograms flattened into arrays.
+    """
+    from scaling import run_chunk
+    histograms, seconds = run_chunk(topology, size, drops, seed, observables)
+    results = {'seconds': np.array(seconds)}
+    for name, (values, counts) in histograms.items():
+        results[name + '_values'] = values
+        results[name + '_counts'] = counts
+    return results
+
+
+# Functions a shard can run, by the name stored in its JSON file
+TASKS = {'ensemble': ensemble_shard, 'sweep': sweep_shard}
+
+
+def _write_json(path, data):
+    """Write a JSON file under a temporary name and move it into place."""
+    temporary = '{}.tmp-{}'.format(path, uuid.uuid4().hex)
+    with open(temporary, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(temporary, path)
+
+
+class WorkQueue:
+    """
+    A job split into shards in a shared directory, and the workers and
+    reducer operating on it.
+    """
+
+    def __init__(self, root=None, lease=DEFAULT_LEASE):
+        """
+        Parameters
+        ==========
+        root: directory of the queue; defaults to $SANDPILE_WORK_QUEUE or
+            ./work_queue
+        lease: float, seconds after its last heartbeat at which a shard is
+            considered abandoned and handed to another worker
+        """
+        self.root = root if root is not None else DEFAULT_ROOT
+        self.lease = lease
+        self.pending = os.path.join(self.root, 'pending')
+        self.leased = os.path.join(self.root, 'leased')
+        self.done = os.path.join(self.root, 'done')
+
+    def _ids(self, directory, suffix):
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return []
+        return sorted(name[:-len(suffix)] for name in names if name.endswith(suffix))
+
+    def job(self):
+        """The description of the job the queue holds."""
+        with open(os.path.join(self.root, 'job.json')) as f:
+            return json.load(f)
+
+    def submit(self, kind, shards, **job):
+        """
+        Start a job: write one pending shard per entry of `shards`, each a
+        dict of arguments of TASKS[kind]. Extra keyword arguments are kept
+        in job.json for the reducer. Returns the shard ids.
+        """
+        if kind not in TASKS:
+            raise ValueError('Unknown task {!r}; expected one of {}'.format(
+                kind, ', '.join(TASKS)))
+        if os.path.exists(os.path.join(self.root, 'job.json')):
+            raise FileExistsError('{} already holds a job'.format(self.root))
+        for directory in (self.pending, self.leased, self.done):
+            os.makedirs(directory, exist_ok=True)
+        ids = ['{:06d}'.format(index) for index in range(len(shards))]
+        for shard_id, arguments in zip(ids, shards):
+            _write_json(os.path.join(self.pending, shard_id + '.json'),
+                        {'id': shard_id, 'task': kind, 'arguments': arguments})
+        # Written last: workers and reducers know the job once it exists
+        _write_json(os.path.join(self.root, 'job.json'),
+                    dict(job, kind=kind, shards=len(ids)))
+        return ids
+
+    def submit_ensemble(self, topology, width, height, number_runs, shards, n=1,
+                        site=None, seed=0):
+        """
+        Split an ensemble of `number_runs` members (see
+        SandPile.ensemble_simulate) into `shards` shards of nearly equal size.
+        """
+        get_topology(topology)
+        runs = np.diff(np.linspace(0, number_runs, shards + 1).astype(int))
+        arguments = [{'topology': topology, 'width': width, 'height': height,
+                      'runs': int(count), 'n': n,
+                      'site': None if site is None else list(site),
+                      'seed': [seed, index]} for index, count in enumerate(runs)]
+        return self.submit('ensemble', arguments, topology=topology, width=width,
+                           height=height, number_runs=number_runs)
+
+    def submit_sweep(self, sweep, chunks):
+        """
+        Submit `chunks` chunks of every size of a scaling.ScalingSweep, with
+        the seeds the sweep would give them itself. The sizes cannot stop
+        early at the sweep's tolerance: every chunk is submitted up front.
+        """
+        arguments = []
+        for size in sweep.sizes:
+            for _ in range(chunks):
+                topology, size, drops, seed, observables = sweep._arguments(size)
+                arguments.append({'topology': topology, 'size': size, 'drops': drops,
+                                  'seed': seed, 'observables': list(observables)})
+        return self.submit('sweep', arguments, topology=sweep.topology, sizes=sweep.sizes,
+                           observables=list(sweep.observables), seed=sweep.seed)
+
+    def status(self):
+        """Number of pending, leased and finished shards."""
+        return {'pending': len(self._ids(self.pending, '.json')),
+                'leased': len(self._ids(self.leased, '.json')),
+                'done': len(self._ids(self.done, '.npz'))}
+
+    def finished(self):
+        """Whether every shard of the job has its results."""
+        return self.status()['done'] >= self.job()['shards']
+
+    def expire(self):
+        """Move the shards whose lease has run out back to pending/."""
+        expired = 0
+        now = time.time()
+        for shard_id in self._ids(self.leased, '.json'):
+            lease = os.path.join(self.leased, shard_id + '.lease')
+            try:
+                age = now - os.path.getmtime(lease)
+            except FileNotFoundError:
+                # Claimed but its lease not written yet, or just finished
+                continue
+            if age <= self.lease:
+                continue
+            source = os.path.join(self.leased, shard_id + '.json')
+            if os.path.exists(os.path.join(self.done, shard_id + '.npz')):
+                target = '{}.finished-{}'.format(source, uuid.uuid4().hex)
+            else:
+                target = os.path.join(self.pending, shard_id + '.json')
+            try:
+                os.rename(source, target)
+            except FileNotFoundError:
+                # Finished or expired by someone else meanwhile
+                continue
+            if target.startswith(source):
+                os.remove(target)
+            else:
+                expired += 1
+            try:
+                os.remove(lease)
+            except FileNotFoundError:
+                pass
+        return expired
+
+    def claim(self, worker=None):
+        """
+        Take one pending shard and lease it to `worker` (a name recorded in
+        the lease). Returns the shard as a dict, or None if none is pending.
+        """
+        worker = worker or '{}:{}'.format(socket.gethostname(), os.getpid())
+        for shard_id in self._ids(self.pending, '.json'):
+            source = os.path.join(self.pending, shard_id + '.json')
+            target = os.path.join(self.leased, shard_id + '.json')
+            try:
+                os.rename(source, target)
+            except FileNotFoundError:
+                # Another worker got there first; try the next shard
+                continue
+            if os.path.exists(os.path.join(self.done, shard_id + '.npz')):
+                # Finished by a worker whose lease had expired
+                os.remove(target)
+                continue
+            with open(os.path.join(self.leased, shard_id + '.lease'), 'w') as f:
+                json.dump({'worker': worker, 'claimed': time.time()}, f)
+            with open(target) as f:
+                return json.load(f)
+        return None
+
+    def heartbeat(self, shard):
+        """Renew the lease of a shard being run."""
+        os.utime(os.path.join(self.leased, shard['id'] + '.lease'))
+
+    def release(self, shard):
+        """Give a leased shard back without results, e.g. after an error."""
+        try:
+            os.rename(os.path.join(self.leased, shard['id'] + '.json'),
+                      os.path.join(self.pending, shard['id'] + '.json'))
+        except FileNotFoundError:
+            pass
+
+    def complete(self, shard, results):
+        """Store the results (a dict of arrays) of a shard and drop its lease."""
+        path = os.path.join(self.done, shard['id'])
+        _write_json(path + '.json', shard)
+        temporary = '{}.tmp-{}.npz'.format(path, uuid.uuid4().hex)
+        np.savez(temporary, **results)
+        # Running a shard twice gives the same results, so a worker whose
+        # lease expired may still finish: the last copy written is kept
+        os.replace(temporary, path + '.npz')
+        for suffix in ('.json', '.lease'):
+            try:
+                os.remove(os.path.join(self.leased, shard['id'] + suffix))
+            except FileNotFoundError:
+                pass
+
+    def run(self, shard):
+        """Run one shard, renewing its lease until it is done."""
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(self.lease / 4):
+                try:
+                    self.heartbeat(shard)
+                except FileNotFoundError:
+                    return
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            arguments = dict(shard['arguments'])
+            if arguments.get('site') is not None:
+                arguments['site'] = tuple(arguments['site'])
+            return TASKS[shard['task']](**arguments)
+        finally:
+            stop.set()
+            thread.join()
+
+    def work(self, worker=None, wait=False, poll=1.0, max_shards=None, log=None):
+        """
+        Claim and run shards until none is left. Returns how many were run.
+
+        Parameters
+        ==========
+        worker: name recorded in the leases; defaults to host:pid
+        wait: bool, keep polling while other workers hold leases, to take
+            over their shards if they crash, until the whole job is done
+        poll: float, seconds between polls when waiting
+        max_shards: int or None, stop after running this many shards
+        log: file-like object to report finished shards to, or None
+        """
+        count = 0
+        while max_shards is None or count < max_shards:
+            self.expire()
+            shard = self.claim(worker)
+            if shard is None:
+                if not wait or self.finished():
+                    break
+                time.sleep(poll)
+                continue
+            start = time.perf_counter()
+            try:
+                results = self.run(shard)
+            except BaseException:
+                self.release(shard)
+                raise
+            self.complete(shard, results)
+            count += 1
+            if log is not None:
+                log.write('shard {} {:.1f}s\n'.format(shard['id'], time.perf_counter() - start))
+                log.flush()
+        return count
+
+    def results(self):
+        """Yield the description and results of every finished shard, in order."""
+        for shard_id in self._ids(self.done, '.npz'):
+            path = os.path.join(self.done, shard_id)
+            with open(path + '.json') as f:
+                shard = json.load(f)
+            with np.load(path + '.npz') as data:
+                yield shard, {name: data[name] for name in data.files}
+
+    def reduce(self):
+        """
+        Merge the results of every shard: the pile of an ensemble (as
+        returned by SandPile.ensemble_simulate) or the ScalingSweep of a
+        sweep. Raises a RuntimeError if some shards are not finished.
+        """
+        job = self.job()
+        status = self.status()
+        if status['done'] < job['shards']:
+            raise RuntimeError('{} of {} shards of {} are not finished'.format(
+                job['shards'] - status['done'], job['shards'], self.root))
+        if job['kind'] == 'ensemble':
+            return self._reduce_ensemble(job)
+        return self._reduce_sweep(job)
+
+    def _reduce_ensemble(self, job):
+        columns = {name: [] for name in ENSEMBLE_OBSERVABLES}
+        for _, results in self.results():
+            for name in ENSEMBLE_OBSERVABLES:
+                columns[name].append(results[name])
+        columns = {name: np.concatenate(values).tolist() for name, values in columns.items()}
+        pile = get_topology(job['topology'])(job['width'], job['height'])
+        pile.pre_critical = False
+        pile.length_history = columns['length']
+        pile.area_history = columns['area']
+        pile.topples_history = columns['topples']
+        # A 0 at the beginning so the mass changes line up with the others
+        pile.mass_history = [0] + columns['mass']
+        return pile
+
+    def _reduce_sweep(self, job):
+        from scaling import ScalingSweep
+        sweep = ScalingSweep(job['topology'], job['sizes'], job['observables'],
+                             seed=job['seed'])
+        for shard, results in self.results():
+            histograms = {name: (results[name + '_values'], results[name + '_counts'])
+                          for name in sweep.observables}
+            arguments = shard['arguments']
+            sweep.add_chunk(arguments['size'], histograms, arguments['drops'],
+                            float(results['seconds']))
+        return sweep
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--root', default=None,
+                        help='queue directory (default $SANDPILE_WORK_QUEUE or ./work_queue)')
+    parser.add_argument('--lease', type=float, default=DEFAULT_LEASE,
+                        help='seconds without a heartbeat before a shard is reassigned')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    ensemble = commands.add_parser('submit-ensemble', help='split an ensemble into shards')
+    ensemble.add_argument('topology', choices=sorted(TOPOLOGIES))
+    ensemble.add_argument('width', type=int)
+    ensemble.add_argument('height', type=int)
+    ensemble.add_argument('number_runs', type=int)
+    ensemble.add_argument('--shards', type=int, default=10)
+    ensemble.add_argument('--grains', type=int, default=1)
+    ensemble.add_argument('--seed', type=int, default=0)
+
+    sweep = commands.add_parser('submit-sweep', help='split a scaling sweep into shards')
+    sweep.add_argument('topology', choices=sorted(TOPOLOGIES))
+    sweep.add_argument('sizes', nargs='+', type=int)
+    sweep.add_argument('--chunks', type=int, default=8, help='chunks per size')
+    sweep.add_argument('--drops', type=int, default=None,
+                       help='grains per chunk (default 4 L^2)')
+    sweep.add_argument('--seed', type=int, default=0)
+
+    work = commands.add_parser('work', help='run shards until none is left')
+    work.add_argument('--wait', action='store_true',
+                      help='wait for the other workers, taking over crashed shards')
+
+    commands.add_parser('status', help='show how many shards are pending, leased and done')
+
+    reduce = commands.add_parser('reduce', help='merge the results of a finished job')
+    reduce.add_argument('--output', default='results/ensemble/',
+                        help='directory for the plots of an ensemble')
+    reduce.add_argument('--bootstrap', type=int, default=100)
+
+    args = parser.parse_args(argv)
+    queue = WorkQueue(args.root, args.lease)
+    if args.command == 'submit-ensemble':
+        ids = queue.submit_ensemble(args.topology, args.width, args.height, args.number_runs,
+                                    args.shards, args.grains, seed=args.seed)
+        print('Submitted {} shards to {}'.format(len(ids), queue.root))
+    elif args.command == 'submit-sweep':
+        from scaling import ScalingSweep
+        ids = queue.submit_sweep(ScalingSweep(args.topology, args.sizes, chunk_drops=args.drops,
+                                              seed=args.seed), args.chunks)
+        print('Submitted {} shards to {}'.format(len(ids), queue.root))
+    elif args.command == 'work':
+        count = queue.work(wait=args.wait, log=sys.stderr)
+        print('Ran {} shards'.format(count))
+    elif args.command == 'status':
+        status = queue.status()
+        print('{pending} pending, {leased} leased, {done} done'.format(**status),
+              'of {}'.format(queue.job()['shards']))
+    else:
+        result = queue.reduce()
+        if queue.job()['kind'] == 'ensemble':
+            result.graph(args.output, no_grid=True)
+            print('Plots of {} members written to {}'.format(
+                len(result.topples_history), args.output))
+        else:
+            for observable in result.observables:
+                fit = result.fit(observable, args.bootstrap)
+                print('{observable}: tau = {tau:.3f} +- {tau_error:.3f}, '
+                      'D = {D:.3f} +- {D_error:.3f}'.format(**fit))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())